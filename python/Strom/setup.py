@@ -2,4 +2,8 @@ from setuptools import setup, find_packages
 setup(
     name = "strom",
     packages = find_packages(),
+    extras_require = {
+        # numeric partition predicates in one pass, see strom.dstream.predicate
+        "numexpr": ["numexpr>=2.6.1"],
+    },
 )
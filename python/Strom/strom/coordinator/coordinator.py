@@ -6,7 +6,7 @@ Handles the main data transformation & (asynchronous) storage process in
 `process_data_async` method.
 Creates Bstream objects from Dstream lists by calling Bstream class aggregate method.
 Applies transformations to Bstreams by calling relevant Bstream class methods.
-Handles Bstream data storage via StorageThread classes at appropriate steps.
+Hands events and Bstream data to a sink (HTTP or queue to the server) for emitting and storage.
 """
 import json
 import pickle
@@ -17,23 +17,43 @@ import pandas as pd
 import requests
 
 from strom.dstream.bstream import BStream
+from strom.dstream.transform_plan import PlanCache
+from .sink import HTTPSink, post_dataframe, post_event
 from strom.utils.configer import configer as config
 from strom.utils.logger.logger import logger
+from strom.utils.profiler import BATCH, elapsed_ms
 
 __version__ = "0.1"
 __author__ = "Molly <molly@tura.io>"
 
 
 class Coordinator(object):
-    def __init__(self):
+    def __init__(self, sink=None, plans=None, state=None, windows=None, profiler=None):
+        """
+        :param sink: where events and measures of processed batches go, defaults to posting them to the API
+        :type sink: HTTPSink or QueueSink
+        :param plans: cache of compiled template transform plans, a new one if None
+        :type plans: PlanCache
+        :param state: carry state of streaming transforms across batches, None to process batches independently
+        :type state: TransformState
+        :param windows: queue the window rule rows of processed batches are put on as (template_id, rows,
+        stream_token), None to ignore window rules
+        :type windows: Queue
+        :param profiler: records the cost of every rule and batch, None to not profile
+        :type profiler: RuleProfiler
+        """
         self.threads = []
+        self.sink = sink if sink is not None else HTTPSink()
+        self.plans = plans if plans is not None else PlanCache(BStream.select_transform)
+        self.state = state
+        self.windows = windows
+        self.profiler = profiler
 
     def _post_parsed_events(self, bstream):
-        """Wrapper on `_parse_events` + `_post_events`- parses individual events & posts to API"""
+        """Wrapper on `_parse_events` + sink- parses individual events & sends them in one go"""
         events = self._parse_events(bstream)
         if len(events) >= 1:
-            for event in events:
-                self._post_events(event)
+            self.sink.send_events(events)
         else:
             logger.warning("No events detected")
 
@@ -53,36 +73,48 @@ class Coordinator(object):
 
         # self._post_template(temp_dstream)
 
-    def process_data(self, dstream_list, token):
+    def process_data(self, dstream_list, token, template=None, overlap=0):
         """
         Wrapper method for asynchronously processing data.
-        :param dstream_list: list of dstreams with raw data
-        :type dstream_list: list of dicts
+        :param dstream_list: list of dstreams with raw data, or batch of columns from engine buffer
+        :type dstream_list: list of dicts or dict
         :param token: stream token
         :type token: string
+        :param template: dstream template, defaults to first dstream in list
+        :type template: dict
+        :param overlap: number of leading records already processed with the previous batch, they
+        are context for the transforms only and are not stored or evented again
+        :type overlap: int
         """
         logger.debug("process_data_async")
-        st = time.time()
+        st = time.perf_counter()
 
         # retrieve most recent versioned dstream template
-        template = dstream_list[0]
+        if template is None:
+            template = dstream_list[0]
 
         # create bstream for dstream list
         bstream = self._list_to_bstream(template, dstream_list)
 
-        # filter bstream data
-        bstream.apply_filters()
-
-        # apply derived param transforms
-        bstream.apply_dparam_rules()
-
-        # apply event transforms
-        bstream.find_events()
+        # filter bstream data, apply derived param transforms, apply event transforms
+        plan = self.plans.get(template)
+        bstream.apply_plan(plan, self.state, overlap, self.profiler)
+
+        # drop roll over records carried from the previous batch
+        bstream.drop_overlap(overlap)
+        # hand window rule rows to the engine, windows span all streams of the template
+        if self.windows is not None:
+            window_rows = plan.window_rows(bstream)
+            if window_rows:
+                self.windows.put((template["template_id"], window_rows, bstream["stream_token"]))
         # post events to server
         self._post_parsed_events(bstream)
-        self._post_dataframe(bstream["stream_token"], bstream["measures"])
+        self.sink.store(bstream["stream_token"], bstream["measures"])
 
-        print("whoop WHOOOOP", time.time() - st, len(bstream["timestamp"]))
+        records = len(bstream["timestamp"])
+        if self.profiler is not None:
+            self.profiler.observe(template["template_id"], BATCH, elapsed_ms(st), records + overlap, records)
+        logger.debug(f"Processed batch of {records} records in {time.perf_counter() - st:.3f} s")
 
 
     @staticmethod
@@ -92,7 +124,7 @@ class Coordinator(object):
         :param template: dstream template
         :type template: dict
         :param dstreams: dstreams with raw data to be transformed
-        :type dstreams: list of dicts
+        :type dstreams: list of dicts or dict of columns
         :return: aggregated bstream
         :rtype: dict
         """
@@ -112,17 +144,31 @@ class Coordinator(object):
         """
         logger.fatal("Parsing event")
         context_data = bstream["measures"]
-        parsed_events = [
-            {
-                "event": "{}_{}".format(event_name.replace(" ", ""), str(bstream["stream_token"])),
-            "data": single_row.to_json()
-            }
-            for event_name, event_df in bstream[config['event_coll_suf']].items()
-            for single_ind, single_row in context_data.join(event_df['event_name'], how="right").iterrows()
-        ]
+        parsed_events = []
+        for event_name, event_df in bstream[config['event_coll_suf']].items():
+            event = "{}_{}".format(event_name.replace(" ", ""), str(bstream["stream_token"]))
+            # state change events say which edge they are
+            event_rows = context_data.join(event_df[[column for column in ("event_name", "edge") if column in event_df]], how="right")
+            parsed_events.extend({"event": event, "data": row} for row in Coordinator._rows_to_json(event_rows))
 
         return parsed_events
 
+    @staticmethod
+    def _rows_to_json(data_frame):
+        """
+        Serializes every row of a DataFrame to a JSON object in one go, same output as calling to_json
+        on each row of data_frame.iterrows()
+        :param data_frame: rows to serialize
+        :type data_frame: pandas DataFrame
+        :return: one JSON string per row
+        :rtype: list of str
+        """
+        if data_frame.shape[0] == 0:
+            return []
+        # iterrows hands out each row as a Series of the common dtype of all columns, upcast the same way
+        rows = pd.DataFrame(data_frame.values, index=data_frame.index, columns=data_frame.columns)
+        return rows.to_json(orient="records", lines=True).rstrip("\n").split("\n")
+
     @staticmethod
     def _post_events(event_data):
         """
@@ -132,12 +178,7 @@ class Coordinator(object):
         :return: request status
         :rtype: string
         """
-        endpoint = 'http://{}:{}/new_event'.format(config['server_host'],
-                                                   config['server_port'])
-        logger.debug(event_data)
-        r = requests.post(endpoint, json=event_data)
-
-        return {'request_status': r.status_code}
+        return post_event(event_data)
 
     @staticmethod
     def _post_template(template):
@@ -192,9 +233,4 @@ class Coordinator(object):
         :return: request status
         :rtype: string
         """
-        endpoint = 'http://{}:{}/data_storage'.format(config['server_host'],
-                                                   config['server_port'])
-        logger.debug(dataframe)
-        r = requests.post(endpoint, data=pickle.dumps((stream_token, dataframe)))
-
-        return {'request_status': r.status_code}
+        return post_dataframe(stream_token, dataframe)
@@ -0,0 +1,341 @@
+"""
+Sink Module
+
+Where the coordinator sends the results of a processed batch: detected events (for socket.io) and the
+measures DataFrame (for storage).
+
+Contains...
+- class EventDispatcher:
+posts the events of a batch in one request over a keep alive session, retries, dead letter spool
+- class EventLedger:
+server side count of the events of every chunk already emitted, so retried chunks are not emitted twice
+- class HTTPSink:
+posts events to /new_event and DataFrames to /data_storage of the API server
+- class QueueSink:
+puts events and DataFrames on a multiprocessing queue read by the server process, no HTTP involved
+- class SinkReader:
+server side thread draining a QueueSink queue into the storage queue and socket.io
+"""
+import json
+import os
+import pickle
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock, Thread
+
+import requests
+
+from strom.utils.configer import configer as config
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+SPOOL_DIR = os.path.expanduser("~/.strom/dead_letter")
+
+
+def dead_letter_path(name):
+    """Absolute path of the dead letter spool of one sender (processor, engine), in SPOOL_DIR"""
+    return os.path.join(SPOOL_DIR, "{}.jsonl".format(name))
+
+
+def post_event(event_data):
+    """
+    Sends post request containing event data to API
+    :param event_data: event data (individual event)
+    :type event_data: dict
+    :return: request status
+    :rtype: dict
+    """
+    endpoint = 'http://{}:{}/new_event'.format(config['server_host'], config['server_port'])
+    logger.debug(event_data)
+    r = requests.post(endpoint, json=event_data)
+    return {'request_status': r.status_code}
+
+
+def post_dataframe(stream_token, dataframe):
+    """
+    Sends post request containing measures DataFrame to API
+    :param stream_token: stream token
+    :type stream_token: str
+    :param dataframe: measures of a processed batch
+    :type dataframe: pandas DataFrame
+    :return: request status
+    :rtype: dict
+    """
+    endpoint = 'http://{}:{}/data_storage'.format(config['server_host'], config['server_port'])
+    logger.debug(dataframe)
+    r = requests.post(endpoint, data=pickle.dumps((stream_token, dataframe)))
+    return {'request_status': r.status_code}
+
+
+class EventDispatcher(object):
+    """
+    Delivers the events of a batch to /new_event as one list per request, over a keep alive session
+    (one per dispatcher, so one connection pool per processor). Connection errors and 5xx answers are
+    retried with backoff, events that still can not be delivered are appended to a dead letter spool
+    file as json lines and sent again by `replay`, every replay_interval seconds while the spool has
+    events.
+
+    Every list of events goes with an idempotency key that stays the same over its retries and
+    replays. The server (EventLedger) only emits the events of a key it has not emitted yet, so a
+    5xx after part of a list was emitted does not emit that part twice.
+    """
+
+    def __init__(self, endpoint=None, retries=3, backoff=0.2, timeout=5, max_events=500, spool_path=None, replay_interval=60):
+        """
+        :param endpoint: url of the event endpoint, defaults to /new_event of the configured server
+        :type endpoint: str
+        :param retries: attempts after the first one
+        :type retries: int
+        :param backoff: seconds before the first retry, doubled for every further one
+        :type backoff: float
+        :param timeout: seconds per request
+        :type timeout: float
+        :param max_events: most events per request
+        :type max_events: int
+        :param spool_path: dead letter file, one per dispatcher, defaults to a file per process in SPOOL_DIR,
+        False to only log undeliverable events
+        :type spool_path: str
+        :param replay_interval: seconds between replays of the spool, None to only replay by calling `replay`
+        :type replay_interval: float
+        """
+        if endpoint is None:
+            endpoint = 'http://{}:{}/new_event'.format(config['server_host'], config['server_port'])
+        self.endpoint = endpoint
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_events = max_events
+        if spool_path is None:
+            spool_path = dead_letter_path("pid{}".format(os.getpid()))
+        self.spool_path = os.path.abspath(spool_path) if spool_path else None
+        self.replay_interval = replay_interval
+        self.spool_lock = Lock()
+        self.replayer = None
+        self.session = requests.Session()
+        self.sent = 0
+        self.failed = 0
+        if self.spool_path is not None and os.path.exists(self.spool_path):
+            # left over from a previous run
+            self._start_replayer()
+
+    def _start_replayer(self):
+        if self.replay_interval is None or self.replayer is not None:
+            return
+        self.replayer = Thread(target=self._run_replayer, name="dead-letter-replay", daemon=True)
+        self.replayer.start()
+
+    def _run_replayer(self):
+        while True:
+            time.sleep(self.replay_interval)
+            try:
+                self.replay()
+            except Exception as ex:
+                logger.warning(f"Replaying {self.spool_path} failed - {ex}")
+
+    def _post(self, events, key):
+        """Posts one list of events, returns None on success or the reason it failed"""
+        delay = self.backoff
+        reason = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            try:
+                r = self.session.post(self.endpoint, json=events, timeout=self.timeout, headers={IDEMPOTENCY_HEADER: key})
+            except requests.RequestException as ex:
+                reason = str(ex)
+                continue
+            if r.status_code < 400:
+                return None
+            reason = f"HTTP {r.status_code}"
+            if r.status_code < 500:
+                # the server will not take these no matter how often they are sent
+                break
+        return reason
+
+    def _spool(self, events, key, reason):
+        logger.warning(f"Could not deliver {len(events)} events - {reason}")
+        if self.spool_path is None:
+            return
+        with self.spool_lock:
+            os.makedirs(os.path.dirname(self.spool_path), exist_ok=True)
+            with open(self.spool_path, "a") as spool:
+                for event in events:
+                    spool.write(json.dumps({"time": time.time(), "reason": reason, "key": key, "event": event}) + "\n")
+        self._start_replayer()
+
+    def _deliver(self, chunks):
+        """Posts (key, events) chunks, spooling those that fail, returns the number of events delivered"""
+        delivered = 0
+        for key, chunk in chunks:
+            reason = self._post(chunk, key)
+            if reason is None:
+                delivered += len(chunk)
+            else:
+                self.failed += len(chunk)
+                self._spool(chunk, key, reason)
+        self.sent += delivered
+        return delivered
+
+    def send(self, events):
+        """
+        Delivers a list of events
+        :param events: events as {"event": name, "data": data}
+        :type events: list of dicts
+        :return: number of events delivered
+        :rtype: int
+        """
+        return self._deliver((uuid.uuid4().hex, events[start:start + self.max_events]) for start in range(0, len(events), self.max_events))
+
+    def replay(self):
+        """
+        Sends the events in the dead letter spool again, events that fail again stay spooled
+        :return: number of events delivered
+        :rtype: int
+        """
+        with self.spool_lock:
+            if self.spool_path is None or not os.path.exists(self.spool_path):
+                return 0
+            replay_path = self.spool_path + ".replay"
+            os.replace(self.spool_path, replay_path)
+        with open(replay_path) as spool:
+            lines = [json.loads(line) for line in spool if line.strip()]
+        os.remove(replay_path)
+        # events go again in the chunks they were sent in, under the same keys
+        chunks = OrderedDict()
+        for line in lines:
+            chunks.setdefault(line.get("key") or uuid.uuid4().hex, []).append(line["event"])
+        return self._deliver(chunks.items())
+
+
+class EventLedger(object):
+    """
+    Number of events of every chunk posted to /new_event that were emitted, by idempotency key. A
+    chunk that comes again (retried after a 5xx or a timeout, replayed from a spool) only emits the
+    events that were not emitted the first time. The most recent `size` keys are kept.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.emitted = OrderedDict()
+        self.lock = Lock()
+
+    def emit(self, key, events, emit):
+        """
+        Emits the events of a chunk not emitted before
+        :param key: idempotency key of the chunk, None to emit every event
+        :type key: str
+        :param events: events of the chunk
+        :type events: list
+        :param emit: emits one event
+        :type emit: callable
+        :return: number of events emitted
+        :rtype: int
+        """
+        if key is None:
+            for event in events:
+                emit(event)
+            return len(events)
+        with self.lock:
+            done = self.emitted.get(key, 0)
+        for position in range(done, len(events)):
+            emit(events[position])
+            with self.lock:
+                self.emitted[key] = position + 1
+                self.emitted.move_to_end(key)
+                if len(self.emitted) > self.size:
+                    self.emitted.popitem(last=False)
+        return max(len(events) - done, 0)
+
+
+class HTTPSink(object):
+    """Sends results through the API server, for processors that do not run under the server"""
+
+    def __init__(self, dispatcher=None):
+        """
+        :param dispatcher: event dispatcher, a default one for the configured server if None
+        :type dispatcher: EventDispatcher
+        """
+        self.dispatcher = dispatcher if dispatcher is not None else EventDispatcher()
+
+    def send_event(self, event_data):
+        return self.dispatcher.send([event_data])
+
+    def send_events(self, events):
+        return self.dispatcher.send(events)
+
+    def store(self, stream_token, dataframe):
+        endpoint = 'http://{}:{}/data_storage'.format(config['server_host'], config['server_port'])
+        r = self.dispatcher.session.post(endpoint, data=pickle.dumps((stream_token, dataframe)), timeout=self.dispatcher.timeout)
+        return {'request_status': r.status_code}
+
+
+class QueueSink(object):
+    """Sends results straight to the server process over a multiprocessing queue"""
+
+    def __init__(self, queue):
+        """
+        :param queue: queue read by a SinkReader in the server process
+        :type queue: multiprocessing Queue
+        """
+        self.q = queue
+
+    def send_event(self, event_data):
+        self.q.put(("event", event_data["event"], event_data["data"]))
+        return {'request_status': 200}
+
+    def send_events(self, events):
+        self.q.put(("events", [(e["event"], e["data"]) for e in events]))
+        return len(events)
+
+    def store(self, stream_token, dataframe):
+        # pickled here rather than in the queue's feeder thread, measures may still be views on a
+        # shared memory slot that is released once the batch is done
+        self.q.put(("bstream", stream_token, pickle.dumps(dataframe)))
+        return {'request_status': 200}
+
+
+class SinkReader(Thread):
+    """
+    Server end of a QueueSink. DataFrames go to the storage queue as ('bstream', token, df), events
+    (single or lists of a batch) are emitted the way /new_event emits them. None on the queue stops
+    the reader.
+    """
+
+    def __init__(self, queue, storage_queue, emit):
+        """
+        :param queue: queue QueueSinks write to
+        :type queue: multiprocessing Queue
+        :param storage_queue: queue of StorageWorker
+        :type storage_queue: Queue
+        :param emit: socket.io emit function, emit(event, data)
+        :type emit: callable
+        """
+        super().__init__()
+        self.daemon = True
+        self.q = queue
+        self.storage_queue = storage_queue
+        self.emit = emit
+
+    def run(self):
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+            try:
+                if item[0] == "bstream":
+                    self.storage_queue.put(("bstream", item[1], pickle.loads(item[2])))
+                elif item[0] == "event":
+                    self.emit(item[1], json.dumps(item[2]))
+                elif item[0] == "events":
+                    for event, data in item[1]:
+                        self.emit(event, json.dumps(data))
+                else:
+                    logger.warning(f"Invalid sink item {item[0]}")
+            except Exception as ex:
+                logger.warning(f"Sink reader failed on {item[0]} item - {ex}")
@@ -2,6 +2,9 @@ import json
 import unittest
 from copy import deepcopy
 
+import numpy as np
+import pandas as pd
+
 from strom.coordinator.coordinator import Coordinator
 from strom.dstream.bstream import BStream
 
@@ -35,6 +38,22 @@ class TestCoordinator(unittest.TestCase):
             self.assertIn(event_dict["event"], [event_names.replace(" ","")+"_"+str(self.bstream["stream_token"]) for event_names in self.bstream["event_rules"].keys()])
             self.assertIsInstance(event_dict["data"], str)
 
+    def test_parse_events_rows(self):
+        parsed_events = self.coordinator._parse_events(self.bstream)
+        expected = [
+            single_row.to_json()
+            for event_name, event_df in self.bstream["events"].items()
+            for single_ind, single_row in self.bstream["measures"].join(event_df['event_name'], how="right").iterrows()
+        ]
+        self.assertEqual([e["data"] for e in parsed_events], expected)
+
+    def test_rows_to_json(self):
+        data_frame = pd.DataFrame({"id": [1, 2], "speed": [0.5, np.nan], "tags": ["a\nb", None]})
+        self.assertEqual(self.coordinator._rows_to_json(data_frame), [row.to_json() for i, row in data_frame.iterrows()])
+        numeric = data_frame[["id", "speed"]]
+        self.assertEqual(self.coordinator._rows_to_json(numeric), ['{"id":1.0,"speed":0.5}', '{"id":2.0,"speed":null}'])
+        self.assertEqual(self.coordinator._rows_to_json(numeric.iloc[:0]), [])
+
     def test_post_events(self):
         parsed_events = self.coordinator._parse_events(self.bstream)
         status = self.coordinator._post_events(parsed_events[0])
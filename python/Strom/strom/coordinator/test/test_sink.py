@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Queue as ProcessQueue
+from queue import Queue
+from threading import Thread
+from time import sleep
+
+from strom.coordinator.coordinator import Coordinator
+from strom.coordinator.sink import IDEMPOTENCY_HEADER, SPOOL_DIR, EventDispatcher, EventLedger, QueueSink, SinkReader
+
+
+class EventHandler(BaseHTTPRequestHandler):
+    statuses = []
+    received = []
+    keys = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.keys.append(self.headers[IDEMPOTENCY_HEADER])
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status == 200:
+            self.received.append(json.loads(body))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestQueueSink(unittest.TestCase):
+    def setUp(self):
+        demo_data_dir = "demo_data/"
+        self.dstream_template = json.load(open(demo_data_dir + "demo_template_unit_test.txt"))
+        self.dstream_template["stream_token"] = "abc123"
+        self.dstream_template["template_id"] = "chadwick666"
+        self.dstreams = json.load(open(demo_data_dir + "demo_trip26.txt"))
+        self.sink_queue = ProcessQueue()
+        self.storage_queue = Queue()
+        self.emitted = []
+        self.reader = SinkReader(self.sink_queue, self.storage_queue, lambda event, data: self.emitted.append((event, data)))
+        self.reader.start()
+
+    def tearDown(self):
+        self.sink_queue.put(None)
+        self.reader.join()
+
+    def test_process_data(self):
+        coordinator = Coordinator(QueueSink(self.sink_queue))
+        coordinator.process_data(self.dstreams, "abc123", self.dstream_template)
+        sleep(0.5)
+        kind, token, measures = self.storage_queue.get(timeout=1)
+        self.assertEqual((kind, token), ("bstream", "abc123"))
+        self.assertEqual(measures.shape[0], len(self.dstreams))
+        self.assertGreater(len(self.emitted), 0)
+        for event, data in self.emitted:
+            self.assertTrue(event.endswith("_abc123"))
+            self.assertIsInstance(json.loads(json.loads(data)), dict)
+
+
+class TestEventDispatcher(unittest.TestCase):
+    def setUp(self):
+        EventHandler.statuses = []
+        EventHandler.received = []
+        EventHandler.keys = []
+        self.server = HTTPServer(("localhost", 0), EventHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.spool = os.path.join(tempfile.mkdtemp(), "dead_letter.jsonl")
+        self.dispatcher = EventDispatcher("http://localhost:{}/new_event".format(self.server.server_port), retries=2, backoff=0.01, max_events=3, spool_path=self.spool)
+        self.events = [{"event": "speeding_abc123", "data": json.dumps({"speed": i})} for i in range(5)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batched(self):
+        self.assertEqual(self.dispatcher.send(self.events), 5)
+        self.assertEqual(EventHandler.received, [self.events[:3], self.events[3:]])
+
+    def test_retry(self):
+        EventHandler.statuses = [503, 503]
+        self.assertEqual(self.dispatcher.send(self.events[:2]), 2)
+        self.assertEqual(EventHandler.received, [self.events[:2]])
+        # retries go under the key of the first attempt
+        self.assertEqual(len(set(EventHandler.keys)), 1)
+
+    def test_dead_letter(self):
+        EventHandler.statuses = [400]
+        self.assertEqual(self.dispatcher.send(self.events[:2]), 0)
+        self.assertEqual(EventHandler.received, [])
+        with open(self.spool) as spool:
+            spooled = [json.loads(line) for line in spool]
+        self.assertEqual([s["event"] for s in spooled], self.events[:2])
+        self.assertEqual(spooled[0]["reason"], "HTTP 400")
+        self.assertEqual(self.dispatcher.replay(), 2)
+        self.assertEqual(EventHandler.received, [self.events[:2]])
+        self.assertEqual(EventHandler.keys[0], EventHandler.keys[1])
+        self.assertFalse(os.path.exists(self.spool))
+
+    def test_timed_replay(self):
+        dispatcher = EventDispatcher("http://localhost:{}/new_event".format(self.server.server_port), retries=0, spool_path=self.spool, replay_interval=0.2)
+        EventHandler.statuses = [503]
+        self.assertEqual(dispatcher.send(self.events[:2]), 0)
+        sleep(1)
+        self.assertEqual(EventHandler.received, [self.events[:2]])
+        self.assertFalse(os.path.exists(self.spool))
+
+    def test_spool_path(self):
+        dispatcher = EventDispatcher("http://localhost:1/new_event")
+        self.assertTrue(os.path.isabs(dispatcher.spool_path))
+        self.assertEqual(os.path.dirname(dispatcher.spool_path), SPOOL_DIR)
+        self.assertIsNone(EventDispatcher("http://localhost:1/new_event", spool_path=False).spool_path)
+
+    def test_ledger(self):
+        ledger = EventLedger(size=2)
+        emitted = []
+
+        def flaky(event):
+            if event == 2 and 2 not in failed:
+                failed.append(event)
+                raise RuntimeError("socket gone")
+            emitted.append(event)
+
+        failed = []
+        self.assertRaises(RuntimeError, ledger.emit, "k1", [1, 2, 3], flaky)
+        # the retry only emits what the first post did not
+        self.assertEqual(ledger.emit("k1", [1, 2, 3], flaky), 2)
+        self.assertEqual(ledger.emit("k1", [1, 2, 3], flaky), 0)
+        self.assertEqual(emitted, [1, 2, 3])
+        self.assertEqual(ledger.emit(None, [1], flaky), 1)
+        ledger.emit("k2", [4], flaky)
+        ledger.emit("k3", [5], flaky)
+        self.assertNotIn("k1", ledger.emitted)
+
+    def test_unreachable(self):
+        dispatcher = EventDispatcher("http://localhost:1/new_event", retries=1, backoff=0.01, spool_path=self.spool)
+        self.assertEqual(dispatcher.send(self.events[:1]), 0)
+        self.assertEqual(dispatcher.failed, 1)
+        self.assertTrue(os.path.exists(self.spool))
+
+
+if __name__ == "__main__":
+    unittest.main()
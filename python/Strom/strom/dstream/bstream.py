@@ -1,7 +1,10 @@
 """
 B-stream class
 
-Initializes a Bstream dict off Dstream, using a Dstream template to initialize all keys, static values. The Bstream contains methods to aggregate measures, timestamps, user ids, fields and tags, as well as a wrapper aggregate method.
+Initializes a Bstream dict off Dstream, using a Dstream template to initialize all keys, static values. The Bstream aggregates the measures, timestamps, user ids, fields and tags of its dstreams with aggregate.
+
+aggregate goes over the dstreams once, filling typed arrays (template dtypes, geo measures as (N, 2)
+float blocks) into a ColumnStore. The measures DataFrame is only built when BStream["measures"] is read.
 """
 import json
 
@@ -9,6 +12,8 @@ from strom.transform.derive_param import *
 from strom.transform.detect_event import *
 from strom.transform.filter_data import *
 from strom.utils.logger.logger import logger
+from .column_store import ColumnStore, column_array, measure_dtype, object_array
+from .predicate import compile_predicate
 from .dstream import DStream
 
 __version__ = "0.1"
@@ -22,9 +27,50 @@ def dummy_function(input, dummy_param):
     return input
 
 
+available_transforms = {
+    "filter_data": {
+        "ButterLowpass": ButterLowpass,
+        "WindowAverage": WindowAverage,
+        "dummy": dummy_function,
+    },
+    "derive_param": {
+        "DeriveSlope": DeriveSlope,
+        "DeriveChange": DeriveChange,
+        "DeriveCumsum": DeriveCumsum,
+        "DeriveDistance": DeriveDistance,
+        "DeriveHeading": DeriveHeading,
+        "DeriveWindowSum": DeriveWindowSum,
+        "DeriveScaled": DeriveScaled,
+        "DeriveInBox": DeriveInBox,
+        "DeriveThreshold": DeriveThreshold,
+        "DeriveLogicalCombination": DeriveLogicalCombination,
+    },
+    "detect_event": {"DetectThreshold": DetectThreshold, "DetectStateChange": DetectStateChange},
+}
+
+# variants carrying state across the batches of a stream, run by the engine processors
+streaming_transforms = {
+    "filter_data": {
+        "ButterLowpass": ButterLowpassStream,
+        "WindowAverage": WindowAverageStream,
+    },
+    "derive_param": {
+        "DeriveChange": DeriveChangeStream,
+        "DeriveCumsum": DeriveCumsumStream,
+        "DeriveDistance": DeriveDistanceStream,
+        "DeriveHeading": DeriveHeadingStream,
+        "DeriveWindowSum": DeriveWindowSumStream,
+    },
+    "detect_event": {
+        "DetectStateChange": DetectStateChangeStream,
+    },
+}
+
+
 class BStream(DStream):
     def __init__(self, template, dstreams):
         logger.debug("init BStream")
+        self.store = None
         super().__init__()
         self.dstreams = dstreams
         self["template_id"] = template["template_id"]
@@ -37,40 +83,80 @@ class BStream(DStream):
                 self[key] = dictionary[key]
                 logger.debug("added key %s" % key)
 
-    def _aggregate_uids(self):
-        logger.debug("aggregating uids")
-        uids = [s["user_ids"] for s in self.dstreams]
-        self["user_ids"] = {
-            uidkey: [i[uidkey] for i in uids] for uidkey, v in self["user_ids"].items()
-        }
-
-    def _aggregate_ts(self):
-        logger.debug("aggregating timestamps")
-        self["timestamp"] = [s["timestamp"] for s in self.dstreams]
-
-    def _aggregate_fields(self):
-        logger.debug("aggregating fields")
-        self["fields"] = [json.dumps(s["fields"]) for s in self.dstreams]
-
-
-    def _aggregate_tags(self):
-        logger.debug("aggregating tags")
-        self["tags"] = [json.dumps(s["tags"]) for s in self.dstreams]
-
-    def _measure_df(self):
-        logger.debug("aggregating into DataFrame")
-        all_measures = [s["measures"] for s in self.dstreams]
-        self["measures"] = {
-            m: [i[m]['val'] for i in all_measures] for m, v in self["measures"].items()
-        }
-        self["measures"]["timestamp"] = self["timestamp"]
+    def __getitem__(self, key):
+        if key == "measures" and self.store is not None and self.store.dirty:
+            self.materialize()
+        return super().__getitem__(key)
+
+    def _measure_columns(self, measure_values):
+        """Typed arrays of the measures, dtype and geo from the template measures"""
+        columns = {}
+        for measure, values in measure_values.items():
+            measure_info = dict.__getitem__(self, "measures").get(measure)
+            dtype = measure_info.get("dtype") if isinstance(measure_info, dict) else None
+            columns[measure] = column_array(values, measure_dtype(dtype), geo=str(dtype).lower() == "geo")
+        return columns
+
+    def _build_store(self, length, measure_values):
+        """Column store of measures, timestamp, user ids and (json encoded on first use) tags and fields"""
+        columns = self._measure_columns(measure_values)
+        columns["timestamp"] = column_array(self["timestamp"])
         for user_id, value in self["user_ids"].items():
-            self["measures"][user_id] = value
-
-        self["measures"]["tags"] = self["tags"]
-        self["measures"]["fields"] = self["fields"]
-
-        self["measures"] = pd.DataFrame.from_dict(self["measures"])
+            columns[user_id] = column_array(value)
+        tags, fields = self["tags"], self["fields"]
+        columns["tags"] = lambda: object_array([json.dumps(t) for t in tags])
+        columns["fields"] = lambda: object_array([json.dumps(f) for f in fields])
+        self.store = ColumnStore.from_columns(length, columns)
+
+    def _aggregate_records(self):
+        logger.debug("aggregating dstreams into typed columns")
+        measure_names = list(dict.__getitem__(self, "measures").keys())
+        uid_names = list(self["user_ids"].keys())
+        timestamps, tags, fields = [], [], []
+        measure_values = {m: [] for m in measure_names}
+        uids = {u: [] for u in uid_names}
+        for dstream in self.dstreams:
+            timestamps.append(dstream["timestamp"])
+            measures = dstream["measures"]
+            for m in measure_names:
+                measure_values[m].append(measures[m]["val"])
+            user_ids = dstream["user_ids"]
+            for u in uid_names:
+                uids[u].append(user_ids[u])
+            tags.append(dstream["tags"])
+            fields.append(dstream["fields"])
+        self["timestamp"] = timestamps
+        self["user_ids"] = uids
+        self["tags"] = tags
+        self["fields"] = fields
+        self._build_store(len(timestamps), measure_values)
+
+    def _aggregate_columns(self):
+        logger.debug("aggregating columnar batch")
+        columns = self.dstreams
+        self["timestamp"] = columns["timestamp"]
+        self["user_ids"] = {uidkey: columns["user_ids"][uidkey].tolist() for uidkey in self["user_ids"].keys()}
+        self["fields"] = columns["fields"]
+        self["tags"] = columns["tags"]
+        measure_values = {m: columns["measures"][m] for m in dict.__getitem__(self, "measures").keys()}
+        self._build_store(len(columns["timestamp"]), measure_values)
+
+    def drop_overlap(self, overlap):
+        """
+        Drops the leading `overlap` rows of measures and the events found in them. Overlap rows are the
+        tail of the previous batch, kept only so transforms stay continuous across batches.
+        :param overlap: number of leading rows to drop
+        :type overlap: int
+        """
+        if not overlap:
+            return
+        logger.debug("dropping {} overlap rows".format(overlap))
+        self.materialize()
+        self.store = None
+        self["measures"] = self["measures"].iloc[overlap:]
+        self["timestamp"] = self["timestamp"][overlap:]
+        for event_name, event_df in self.get("events", {}).items():
+            self["events"][event_name] = event_df[event_df.index >= overlap]
 
     def prune_dstreams(self):
         logger.debug("removing input dstreams to save space")
@@ -79,12 +165,12 @@ class BStream(DStream):
     @property
     def aggregate(self):
         logger.debug("aggregating everything")
-        self._aggregate_uids()
-        self._aggregate_ts()
-        self._aggregate_fields()
-        self._aggregate_tags()
-        self._measure_df()
-
+        self.store = None
+        if isinstance(self.dstreams, dict):
+            # batch of columns from the engine buffer
+            self._aggregate_columns()
+        else:
+            self._aggregate_records()
         return self
 
     def partition_rows(self, parition_key, partition_value, comparison_operator="=="):
@@ -94,64 +180,60 @@ class BStream(DStream):
         logger.debug("Finding the row indices that meet the partition condition")
         comparisons= {"==":np.equal, "!=":np.not_equal, ">=":np.greater_equal, "<=":np.less_equal, ">":np.greater, "<":np.less}
         cur_comp = comparisons[comparison_operator]
-        return cur_comp(self["measures"][parition_key], partition_value)
+        return cur_comp(self.measure_store()[parition_key], partition_value)
 
-    def partition_data(self, list_of_partitions, logical_comparison="AND"):
+    def partition_mask(self, list_of_partitions, logical_comparison="AND"):
         """This function takes a list of tuples of partition parameters used by partition_rows() and
-        returns all rows from the measure DataFrame that meet the logical AND or logical OR of those conditions"""
+        returns the boolean index of the rows that meet the logical AND or logical OR of those conditions"""
         logger.debug("building parition rows")
-        if logical_comparison == "AND":
-            start_bools = np.ones((self["measures"].shape[0],),dtype=bool)
-        elif logical_comparison == "OR":
-            start_bools = np.zeros((self["measures"].shape[0],), dtype=bool)
-        else:
-            raise ValueError("{} is not a supported logical comparison".format(logical_comparison))
-
-        for partition in list_of_partitions:
-            new_inds = self.partition_rows(partition[0], partition[1], partition[2])
-            if logical_comparison == "AND":
-                start_bools = np.logical_and(start_bools, new_inds)
-            elif logical_comparison == "OR":
-                start_bools = np.logical_or(start_bools, new_inds)
-            else:
-                raise ValueError("{} is not a supported logical comparison".format(logical_comparison))
+        start_bools = compile_predicate(list_of_partitions, logical_comparison).mask(self.measure_store())
+        if start_bools is None:
+            return np.ones((len(self.measure_store()),), dtype=bool)
+        return start_bools
 
+    def partition_data(self, list_of_partitions, logical_comparison="AND"):
+        """Returns all rows from the measure DataFrame that meet the partition conditions, see partition_mask()"""
+        start_bools = compile_predicate(list_of_partitions, logical_comparison).mask(self.measure_store())
+        self.materialize()
+        if start_bools is None:
+            # empty partition list, every row, nothing copied
+            return self["measures"]
         return self["measures"][start_bools]
 
     @staticmethod
     def select_transform(transform_type, transform_name):
         """Method to grab the transform function from the correct module"""
         logger.debug("Selecting transform function")
-        available_transforms = {}
-        available_transforms["filter_data"] = {
-                                               "ButterLowpass":ButterLowpass,
-                                               "WindowAverage":WindowAverage,
-                                               "dummy":dummy_function
-                                               }
-        available_transforms["derive_param"] = {
-                                                "DeriveSlope":DeriveSlope,
-                                                "DeriveChange":DeriveChange,
-                                                "DeriveCumsum":DeriveCumsum,
-                                                "DeriveDistance":DeriveDistance,
-                                                "DeriveHeading":DeriveHeading,
-                                                "DeriveWindowSum":DeriveWindowSum,
-                                                "DeriveScaled":DeriveScaled,
-                                                "DeriveInBox":DeriveInBox,
-                                                "DeriveThreshold":DeriveThreshold,
-                                                "DeriveLogicalCombination":DeriveLogicalCombination,
-                                                }
-        available_transforms["detect_event"] = {"DetectThreshold":DetectThreshold}
         return available_transforms[transform_type][transform_name]
 
+    def measure_store(self):
+        """Column store of the measures, transforms read from and write to it until materialize()"""
+        if self.store is None:
+            self.store = ColumnStore(self["measures"])
+        return self.store
+
+    @staticmethod
+    def select_stream_transform(transform_type, transform_name):
+        """Streaming variant of a transform, None if it has none"""
+        return streaming_transforms.get(transform_type, {}).get(transform_name)
+
     def add_columns(self, new_data_frame):
-        self["measures"] = self["measures"].join(new_data_frame, rsuffix="_r", lsuffix="_l")
+        """Writes transform output into the column store, existing columns of the same name are replaced"""
+        self.measure_store().write(new_data_frame)
+
+    def materialize(self):
+        """Builds the measures DataFrame from the column store once transforms added columns"""
+        if self.store is not None and self.store.dirty:
+            logger.debug("materializing measures")
+            self["measures"] = self.store.frame()
 
     def apply_transform(self, partition_list, measure_list, transform_type, transform_name, param_dict, logical_comparison="AND"):
         """This function takes uses the inputs to partition the measures DataFrame, apply the specified
         transform to the specified columns with the supplied parameters and joins the results to the
         measures DataFrame"""
         logger.debug("Applying transform")
-        selected_data = self.partition_data(partition_list, logical_comparison)[measure_list] #partition rows then select columns
+        store = self.measure_store()
+        selected_data = store.select(measure_list, compile_predicate(partition_list, logical_comparison).mask(store)) #partition rows then select columns
         tranformer = self.select_transform(transform_type,transform_name) #grab your transformer
         transformed_data = tranformer(selected_data, param_dict) #Return data, either as array or DataFrame
         #Concatonate data with self["measures"]
@@ -167,6 +249,7 @@ class BStream(DStream):
         for filter_rule in self["filters"]:
             # logger.debug("applying filter {}".format(filter_rule["param_dict"]["filter_name"]))
             self.apply_transform(filter_rule["partition_list"], filter_rule["measure_list"], filter_rule["transform_type"], filter_rule["transform_name"], filter_rule["param_dict"], filter_rule["logical_comparison"])
+        self.materialize()
 
 
     def apply_dparam_rules(self):
@@ -175,7 +258,15 @@ class BStream(DStream):
         for dparam_rule in self["dparam_rules"]:
             # print("deriving {}".format(dparam_rule["param_dict"]["measure_rules"]["output_name"]))
             self.apply_transform(dparam_rule["partition_list"], dparam_rule["measure_list"], dparam_rule["transform_type"], dparam_rule["transform_name"], dparam_rule["param_dict"], dparam_rule["logical_comparison"])
+        self.materialize()
+
 
+    def apply_plan(self, plan, state=None, overlap=0, profiler=None):
+        """Applies filters, dparam rules and event rules from a compiled TransformPlan of the template,
+        streaming transforms carry their state in `state` (a TransformState) if one is given and the
+        cost of every rule is recorded in `profiler` (a RuleProfiler) if one is given"""
+        logger.debug("applying transform plan")
+        return plan.run(self, state, overlap, profiler)
 
     def find_events(self):
         logger.debug("finding events")
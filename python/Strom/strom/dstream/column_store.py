@@ -0,0 +1,235 @@
+"""
+Column store
+
+Measures of a BStream while transforms run on them: one NumPy array per column, all aligned on the
+index of the aggregated measures DataFrame. Transform outputs are written straight into the store as
+new arrays, nothing already in the store is copied, and a DataFrame is only built once all rules ran.
+
+Geo measures are held as one (N, 2) float64 block instead of a column of [lon, lat] lists. Rules get
+the block as a complex128 column (a view of the block, lon + 1j * lat) that spatial transforms turn
+back into the block without converting a value, see derive_param.spatial_block. Only the measures
+DataFrame built for storage has [lon, lat] lists again. Columns can be lazy: tags and fields are json encoded the
+first time a rule selects them or the DataFrame is built, not when the batch is aggregated. That only
+saves the encoding for batches whose measures DataFrame is never built: the coordinator stores every
+processed batch, so on the engine path they are encoded once per batch either way.
+
+An output with the name of a column already in the store replaces that column (with a warning)
+instead of being renamed with a _l/_r suffix the way DataFrame.join does.
+
+Contains...
+- class ColumnStore:
+dict of column arrays with row selection and DataFrame output
+- function measure_dtype:
+numpy dtype of a template measure dtype
+- function column_array:
+typed 1-D (or geo (N, 2)) array from a list of values
+"""
+import numpy as np
+import pandas as pd
+
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+numeric_dtypes = {
+    "float": np.float64,
+    "double": np.float64,
+    "decimal": np.float64,
+    "numeric": np.float64,
+    "real": np.float64,
+    "int": np.int64,
+    "integer": np.int64,
+    "bigint": np.int64,
+    "smallint": np.int64,
+}
+
+
+def measure_dtype(dtype):
+    """
+    Maps a template measure dtype (sql style, ie "float", "varchar(60)") to the numpy dtype of its
+    column, in the engine buffers and the BStream column store. Anything that is not numeric is object.
+    :param dtype: measure dtype from template
+    :type dtype: str
+    :return: numpy dtype
+    """
+    if dtype is None:
+        return np.dtype(object)
+    base = str(dtype).split("(")[0].strip().lower()
+    return np.dtype(numeric_dtypes.get(base, object))
+
+
+def missing_dtype(dtype):
+    """dtype able to hold NaN for rows a transform did not return, the dtype DataFrame.join would give"""
+    if dtype.kind in "fc":
+        return dtype
+    if dtype.kind in "iu":
+        return np.float64
+    return object
+
+
+def object_array(values):
+    """1-D object array holding the values as they are, lists included"""
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+def column_array(values, dtype=None, geo=False):
+    """
+    Typed array of the values of one column
+    :param values: column values
+    :type values: list or numpy array
+    :param dtype: numpy dtype from the template, None to infer numeric/bool columns
+    :type dtype: numpy dtype
+    :param geo: try an (N, 2) float64 block first, only for measures with the "geo" template dtype, any
+    other column of pairs stays a column of lists
+    :type geo: bool
+    :return: typed array, object array if the values do not fit
+    :rtype: numpy array
+    """
+    if isinstance(values, np.ndarray):
+        if values.dtype != object and not geo:
+            return values if dtype is None or values.dtype == dtype else column_array(values.tolist(), dtype)
+        values = values.tolist()
+    if geo:
+        try:
+            block = np.array(values, dtype=np.float64)
+            if block.shape == (len(values), 2):
+                return block
+        except (TypeError, ValueError):
+            pass
+    if dtype is not None and dtype != object:
+        for candidate in (dtype, np.float64):
+            try:
+                array = np.array(values, dtype=candidate)
+            except (TypeError, ValueError):
+                continue
+            if array.ndim == 1:
+                return array
+    elif dtype is None and not (values and isinstance(values[0], str)):
+        try:
+            array = np.array(values)
+            if array.ndim == 1 and array.dtype.kind in "biuf":
+                return array
+        except (TypeError, ValueError):
+            pass
+    return object_array(values)
+
+
+class ColumnStore(object):
+    """Measure columns as NumPy arrays sharing one index"""
+
+    def __init__(self, data_frame=None):
+        """
+        :param data_frame: aggregated measures, None for an empty store (see from_columns)
+        :type data_frame: pandas DataFrame
+        """
+        self.index = data_frame.index if data_frame is not None else pd.RangeIndex(0)
+        self.columns = {column: data_frame[column].to_numpy() for column in data_frame.columns} if data_frame is not None else {}
+        self.lazy = {}
+        self.dirty = False
+        self.overwritten = 0
+
+    @classmethod
+    def from_columns(cls, length, columns):
+        """
+        Store over arrays already aligned on a RangeIndex, the DataFrame is yet to be built
+        :param length: rows
+        :type length: int
+        :param columns: column arrays, or callables returning one for lazy columns
+        :type columns: dict
+        :rtype: ColumnStore
+        """
+        store = cls()
+        store.index = pd.RangeIndex(length)
+        for column, values in columns.items():
+            if callable(values):
+                store.columns[column] = None
+                store.lazy[column] = values
+            else:
+                store.columns[column] = values
+        store.dirty = True
+        return store
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __getitem__(self, column):
+        if column in self.lazy:
+            self.columns[column] = self.lazy.pop(column)()
+        return self.columns[column]
+
+    @staticmethod
+    def _values(array, mask=None):
+        if mask is not None:
+            array = array[mask]
+        if array.ndim == 1:
+            return array
+        # one complex per row, the same memory as the block
+        return np.ascontiguousarray(array).view(np.complex128).ravel()
+
+    @staticmethod
+    def _stored_values(array):
+        if array.ndim == 1:
+            return array
+        # geo blocks go into a DataFrame as one [lon, lat] list per row, missing coordinates as None
+        missing = np.isnan(array)
+        if missing.any():
+            array = array.astype(object)
+            array[missing] = None
+        return array.tolist()
+
+    def keys(self):
+        return self.columns.keys()
+
+    def select(self, columns, mask=None):
+        """
+        DataFrame of some columns, only rows in mask if one is given
+        :param columns: column names
+        :type columns: list
+        :param mask: boolean row mask, None for all rows
+        :type mask: numpy array
+        :rtype: pandas DataFrame
+        """
+        if mask is None:
+            # every row, the DataFrame is a view on the store arrays (transforms return new frames)
+            return pd.DataFrame({column: self._values(self[column]) for column in columns}, index=self.index, columns=columns, copy=False)
+        return pd.DataFrame({column: self._values(self[column], mask) for column in columns}, index=self.index[mask], columns=columns)
+
+    def write(self, data_frame):
+        """
+        Adds the columns of a transform output, rows missing from the output are NaN
+        :param data_frame: transform output, indexed by a subset of the store index
+        :type data_frame: pandas DataFrame
+        """
+        if data_frame.index.equals(self.index):
+            positions = None
+        else:
+            positions = self.index.get_indexer(data_frame.index)
+            found = positions >= 0
+        for column in data_frame.columns:
+            values = data_frame[column].to_numpy()
+            if positions is not None:
+                full = np.full(len(self.index), np.nan, dtype=missing_dtype(values.dtype))
+                full[positions[found]] = values[found]
+                values = full
+            self.lazy.pop(column, None)
+            if column in self.columns:
+                logger.warning(f"Transform output {column} overwrites the existing column")
+                self.overwritten += 1
+            self.columns[column] = values
+        self.dirty = True
+
+    def reorder(self, columns):
+        """Puts columns in the given order, columns not listed keep their place after the listed ones"""
+        ordered = {column: self.columns[column] for column in columns if column in self.columns}
+        ordered.update(self.columns)
+        self.columns = ordered
+
+    def frame(self):
+        """All columns as a DataFrame"""
+        self.dirty = False
+        return pd.DataFrame({column: self._stored_values(self[column]) for column in self.columns}, index=self.index)
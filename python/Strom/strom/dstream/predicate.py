@@ -0,0 +1,118 @@
+"""
+Predicate compiler
+
+Turns the partition_list of a rule into one compiled predicate over the measure columns. With numexpr
+installed, predicates on numeric columns are evaluated as a single numexpr expression, one pass over
+the rows without a temporary mask per comparison. Without it (or for string, bool and object columns)
+the comparisons are combined in place into one NumPy mask.
+
+An empty partition list compiles to a predicate without a mask: the rule takes its columns as they
+are, no all True mask is built and no rows are copied by fancy indexing.
+
+Predicates are cached per partition list and logical comparison, rules with the same partitions
+share one.
+
+Contains...
+- class Predicate:
+compiled partition list, evaluates to a boolean row mask
+- function compile_predicate:
+cached Predicate of a partition list
+"""
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:  # optional, predicates fall back to NumPy
+    numexpr = None
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+comparisons = {"==": np.equal, "!=": np.not_equal, ">=": np.greater_equal, "<=": np.less_equal, ">": np.greater, "<": np.less}
+MAX_PREDICATES = 1024
+
+
+def predicate_key(partition_list, logical_comparison="AND"):
+    """Hashable key of a partition list, values by repr as they may be lists"""
+    return logical_comparison, tuple((column, repr(value), operator) for column, value, operator in partition_list)
+
+
+class Predicate(object):
+    """Partition list compiled to a single boolean expression"""
+
+    def __init__(self, partition_list, logical_comparison="AND"):
+        """
+        :param partition_list: (column, value, operator) tuples of a rule
+        :type partition_list: list
+        :param logical_comparison: "AND" or "OR" of the comparisons
+        :type logical_comparison: str
+        """
+        if logical_comparison not in ("AND", "OR"):
+            raise ValueError("{} is not a supported logical comparison".format(logical_comparison))
+        for _, _, operator in partition_list:
+            if operator not in comparisons:
+                raise ValueError("{} is not a supported comparison operator".format(operator))
+        self.logical_comparison = logical_comparison
+        self.key = predicate_key(partition_list, logical_comparison)
+        self.terms = tuple((column, value, operator) for column, value, operator in partition_list)
+        self.columns = list(dict.fromkeys(column for column, _, _ in self.terms))
+        names = {column: "c{}".format(position) for position, column in enumerate(self.columns)}
+        joiner = " & " if logical_comparison == "AND" else " | "
+        self.expression = joiner.join("({} {} v{})".format(names[column], operator, position)
+                                      for position, (column, _, operator) in enumerate(self.terms))
+        self.names = names
+        # numexpr only takes numbers, values are checked once here and column dtypes per batch
+        self.numeric = all(isinstance(value, (int, float, np.number)) and not isinstance(value, (bool, np.bool_))
+                           for _, value, _ in self.terms)
+
+    @property
+    def empty(self):
+        return not self.terms
+
+    def mask(self, measures, length=None):
+        """
+        Boolean mask of the rows meeting the predicate
+        :param measures: measure columns, anything indexed by column name (ColumnStore, DataFrame)
+        :type measures: ColumnStore
+        :param length: rows, for the mask of an empty OR predicate
+        :type length: int
+        :return: row mask, None if every row is taken (empty AND predicate)
+        :rtype: numpy array
+        """
+        if self.empty:
+            if self.logical_comparison == "AND":
+                return None
+            return np.zeros((len(measures) if length is None else length,), dtype=bool)
+        arrays = {column: np.asarray(measures[column]) for column in self.columns}
+        if numexpr is not None and self.numeric and all(array.dtype.kind in "iuf" for array in arrays.values()):
+            local_dict = {self.names[column]: array for column, array in arrays.items()}
+            local_dict.update(("v{}".format(position), value) for position, (_, value, _) in enumerate(self.terms))
+            return numexpr.evaluate(self.expression, local_dict=local_dict)
+        combine = np.logical_and if self.logical_comparison == "AND" else np.logical_or
+        column, value, operator = self.terms[0]
+        mask = np.asarray(comparisons[operator](arrays[column], value), dtype=bool)
+        for column, value, operator in self.terms[1:]:
+            combine(mask, comparisons[operator](arrays[column], value), out=mask)
+        return mask
+
+
+predicates = {}
+
+
+def compile_predicate(partition_list, logical_comparison="AND"):
+    """
+    Predicate of a partition list, compiled once and shared by every rule with the same partitions
+    :param partition_list: (column, value, operator) tuples of a rule
+    :type partition_list: list
+    :param logical_comparison: "AND" or "OR"
+    :type logical_comparison: str
+    :rtype: Predicate
+    """
+    key = predicate_key(partition_list, logical_comparison)
+    predicate = predicates.get(key)
+    if predicate is None:
+        if len(predicates) >= MAX_PREDICATES:
+            predicates.clear()
+        predicate = predicates[key] = Predicate(partition_list, logical_comparison)
+    return predicate
@@ -25,28 +25,26 @@ class TestBStream(unittest.TestCase):
         self.assertEqual(self.bstream["stream_name"], self.dstream_template["stream_name"])
 
     def test_aggregate_uids(self):
-        self.bstream._aggregate_uids()
+        self.bstream.aggregate
         for uuid in self.dstream_template["user_ids"]:
             self.assertIn(uuid, self.bstream["user_ids"])
             self.assertIsInstance(self.bstream["user_ids"][uuid], list)
-            self.assertEqual(len(self.bstream["user_ids"][uuid]), len(self.dstreams))
+            self.assertEqual(self.bstream.store[uuid].tolist(), [d["user_ids"][uuid] for d in self.dstreams])
 
     def test_aggregate_ts(self):
-        self.bstream._aggregate_ts()
+        self.bstream.aggregate
         self.assertIsInstance(self.bstream["timestamp"], list)
-        self.assertEqual(len(self.bstream["timestamp"]), len(self.dstreams))
+        self.assertEqual(self.bstream.store["timestamp"].tolist(), [d["timestamp"] for d in self.dstreams])
 
     def test_aggregate_fields(self):
-        self.bstream._aggregate_fields()
+        self.bstream.aggregate
         self.assertEqual(len(self.bstream["fields"]), len(self.dstreams))
+        self.assertEqual(self.bstream.store["fields"].tolist(), [json.dumps(d["fields"]) for d in self.dstreams])
 
     def test_aggregate_tags(self):
-        self.bstream._aggregate_tags()
-
-        for tag in self.dstream_template["tags"]:
-            self.assertIn(tag, self.bstream["tags"])
-            self.assertIsInstance(self.bstream["tags"][tag], list)
-            self.assertEqual(len(self.bstream["tags"][tag]), len(self.dstreams))
+        self.bstream.aggregate
+        self.assertEqual(len(self.bstream["tags"]), len(self.dstreams))
+        self.assertEqual(self.bstream.store["tags"].tolist(), [json.dumps(d["tags"]) for d in self.dstreams])
     #
     def test_aggregate(self):
         b = self.bstream.aggregate
@@ -68,6 +66,27 @@ class TestBStream(unittest.TestCase):
         self.assertEqual(b, self.bstream)
 
 
+    def test_aggregate_store(self):
+        # measures DataFrame as the dstreams give it, column by column
+        columns = {m: [d["measures"][m]["val"] for d in self.dstreams] for m in self.dstream_template["measures"]}
+        columns["timestamp"] = [d["timestamp"] for d in self.dstreams]
+        for uuid in self.dstream_template["user_ids"]:
+            columns[uuid] = [d["user_ids"][uuid] for d in self.dstreams]
+        columns["tags"] = [json.dumps(d["tags"]) for d in self.dstreams]
+        columns["fields"] = [json.dumps(d["fields"]) for d in self.dstreams]
+        expected = {"measures": pd.DataFrame(columns)}
+        self.bstream.aggregate
+        # location is varchar in this template, its [lon, lat] lists stay lists
+        self.assertEqual(self.bstream.store["location"].shape, (len(self.dstreams),))
+        self.assertIn("tags", self.bstream.store.lazy)
+        self.assertTrue(self.bstream["measures"].equals(expected["measures"]))
+        geo_template = deepcopy(self.dstream_template)
+        geo_template["measures"]["location"]["dtype"] = "geo"
+        geo = BStream(geo_template, self.dstreams)
+        geo.aggregate
+        self.assertEqual(geo.store["location"].shape, (len(self.dstreams), 2))
+        self.assertTrue(geo["measures"].equals(expected["measures"]))
+
     def test_prune_dstreams(self):
         self.assertIsInstance(self.bstream.dstreams, list)
         self.bstream.prune_dstreams()
@@ -101,6 +120,19 @@ class TestBStream(unittest.TestCase):
             self.assertIn(cur_name, bstream["events"])
             self.assertIsInstance(bstream["events"][cur_name], pd.DataFrame)
 
+    def test_drop_overlap(self):
+        bstream = deepcopy(self.bstream)
+        bstream.aggregate
+        bstream.apply_filters()
+        bstream.apply_dparam_rules()
+        bstream.find_events()
+        bstream.drop_overlap(10)
+        self.assertEqual(bstream["measures"].shape[0], len(self.dstreams) - 10)
+        self.assertEqual(bstream["measures"].index[0], 10)
+        self.assertEqual(len(bstream["timestamp"]), len(self.dstreams) - 10)
+        for event_df in bstream["events"].values():
+            self.assertTrue((event_df.index >= 10).all())
+
 
 if __name__ == "__main__":
     unittest.main()
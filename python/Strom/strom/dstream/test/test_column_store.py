@@ -0,0 +1,82 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from strom.dstream.column_store import ColumnStore, column_array, measure_dtype
+
+
+class TestColumnStore(unittest.TestCase):
+    def setUp(self):
+        self.measures = pd.DataFrame({"speed": [1.0, 2.0, 4.0, 8.0], "count": [1, 2, 3, 4], "location": [[0, 1], [1, 1], [2, 1], [3, 1]]})
+        self.store = ColumnStore(self.measures)
+
+    def test_frame(self):
+        self.assertFalse(self.store.dirty)
+        self.assertTrue(self.store.frame().equals(self.measures))
+
+    def test_select(self):
+        mask = np.array([False, True, True, False])
+        selected = self.store.select(["speed", "location"], mask)
+        self.assertEqual(list(selected.index), [1, 2])
+        self.assertEqual(selected["location"].tolist(), [[1, 1], [2, 1]])
+        self.assertEqual(list(self.store.select(["count"]).columns), ["count"])
+
+    def test_write(self):
+        diffed = pd.DataFrame({"change": np.diff(self.store["count"])}, index=self.measures.index[:-1])
+        self.store.write(diffed)
+        self.assertTrue(self.store.dirty)
+        expected = self.measures.join(diffed)
+        self.assertTrue(self.store.frame().equals(expected))
+
+        flags = pd.DataFrame({"fast": [True, False]}, index=[0, 3])
+        self.store.write(flags)
+        self.assertTrue(self.store.frame()["fast"].equals(self.measures.join(flags)["fast"]))
+
+    def test_overwrite(self):
+        with self.assertLogs("stromLogger", level="WARNING"):
+            self.store.write(pd.DataFrame({"speed": [0.0, 0.0, 0.0, 0.0]}))
+        frame = self.store.frame()
+        self.assertEqual(list(frame.columns), ["speed", "count", "location"])
+        self.assertEqual(frame["speed"].tolist(), [0.0] * 4)
+        self.assertEqual(self.store.overwritten, 1)
+
+    def test_measure_dtype(self):
+        self.assertEqual(measure_dtype("float"), np.float64)
+        self.assertEqual(measure_dtype("int"), np.int64)
+        self.assertEqual(measure_dtype("varchar(60)"), object)
+        self.assertEqual(measure_dtype(None), object)
+
+    def test_column_array(self):
+        geo = column_array([[0.5, 1], [None, None]], geo=True)
+        self.assertEqual(geo.shape, (2, 2))
+        self.assertTrue(np.isnan(geo[1]).all())
+        # pairs of a column that is not a geo measure stay lists
+        pairs = column_array([[0.5, 1], [2, 3]])
+        self.assertEqual((pairs.shape, pairs[0]), ((2,), [0.5, 1]))
+        self.assertEqual(column_array([1, 2], np.dtype(np.float64)).dtype, np.float64)
+        self.assertEqual(column_array([1, None], np.dtype(np.int64)).dtype, np.float64)
+        self.assertEqual(column_array(["a", "b"]).dtype, object)
+        self.assertEqual(column_array([[1, 2, 3]]).dtype, object)
+        self.assertEqual(column_array(np.array([[1, 2], [3, 4]], dtype=object), geo=True).dtype, np.float64)
+
+    def test_lazy(self):
+        calls = []
+        store = ColumnStore.from_columns(2, {"location": column_array([[0, 1], [None, None]], geo=True), "tags": lambda: calls.append(1) or np.array(["{}", "{}"], dtype=object)})
+        location = store.select(["location"])["location"]
+        self.assertEqual(location.dtype, np.complex128)
+        self.assertEqual(location[0], 0 + 1j)
+        self.assertEqual(calls, [])
+        frame = store.frame()
+        self.assertEqual(frame["location"].tolist(), [[0.0, 1.0], [None, None]])
+        self.assertEqual(frame["tags"].tolist(), ["{}", "{}"])
+        self.assertEqual(calls, [1])
+
+    def test_reorder(self):
+        self.store.write(pd.DataFrame({"a": [1, 2, 3, 4], "b": [4, 3, 2, 1]}))
+        self.store.reorder(["b", "speed"])
+        self.assertEqual(list(self.store.keys()), ["b", "speed", "count", "location", "a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
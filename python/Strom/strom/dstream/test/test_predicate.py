@@ -0,0 +1,76 @@
+import json
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from strom.dstream import predicate
+from strom.dstream.bstream import BStream
+from strom.dstream.predicate import Predicate, compile_predicate
+
+
+class TestPredicate(unittest.TestCase):
+    def setUp(self):
+        self.measures = pd.DataFrame({"speed": [1.0, 5.0, 7.0, 9.0], "driver": ["a", "b", "a", "b"], "count": [1, 2, 3, 4]})
+
+    def test_mask(self):
+        between = Predicate([["speed", 4, ">"], ["speed", 9, "<"]])
+        self.assertEqual(between.mask(self.measures).tolist(), [False, True, True, False])
+        either = Predicate([["driver", "a", "=="], ["count", 4, ">="]], "OR")
+        self.assertEqual(either.mask(self.measures).tolist(), [True, False, True, True])
+        self.assertEqual(either.expression, "(c0 == v0) | (c1 >= v1)")
+        self.assertTrue(between.numeric)
+        self.assertFalse(either.numeric)
+        self.assertRaises(ValueError, lambda: Predicate([], "XOR"))
+        self.assertRaises(ValueError, lambda: Predicate([["speed", 1, "=>"]]))
+
+    def test_empty(self):
+        self.assertIsNone(Predicate([]).mask(self.measures))
+        self.assertEqual(Predicate([], "OR").mask(self.measures).tolist(), [False] * 4)
+
+    def test_numpy_fallback(self):
+        numexpr, predicate.numexpr = predicate.numexpr, None
+        try:
+            mask = Predicate([["speed", 4, ">"], ["count", 4, "<"]]).mask(self.measures)
+        finally:
+            predicate.numexpr = numexpr
+        self.assertEqual(mask.tolist(), [False, True, True, False])
+
+    @unittest.skipIf(predicate.numexpr is None, "numexpr not installed")
+    def test_numexpr(self):
+        partition_lists = [([["speed", 4, ">"], ["speed", 9, "<"]], "AND"), ([["speed", 5.0, "=="], ["count", 4, ">="]], "OR"),
+                           ([["count", 2, "!="]], "AND"), ([["speed", 1, "<="], ["count", 3, ">"]], "OR")]
+        evaluated = []
+        evaluate = predicate.numexpr.evaluate
+        predicate.numexpr.evaluate = lambda *args, **kwargs: evaluated.append(args[0]) or evaluate(*args, **kwargs)
+        try:
+            masks = [Predicate(partition_list, logical_comparison).mask(self.measures) for partition_list, logical_comparison in partition_lists]
+        finally:
+            predicate.numexpr.evaluate = evaluate
+        self.assertEqual(len(evaluated), len(partition_lists))
+        # numpy gives the same masks
+        numexpr, predicate.numexpr = predicate.numexpr, None
+        try:
+            expected = [Predicate(partition_list, logical_comparison).mask(self.measures) for partition_list, logical_comparison in partition_lists]
+        finally:
+            predicate.numexpr = numexpr
+        for mask, numpy_mask in zip(masks, expected):
+            self.assertEqual(mask.dtype, bool)
+            self.assertEqual(mask.tolist(), numpy_mask.tolist())
+
+    def test_cache(self):
+        self.assertIs(compile_predicate([["speed", 4, ">"]]), compile_predicate([["speed", 4, ">"]]))
+        self.assertIsNot(compile_predicate([["speed", 4, ">"]]), compile_predicate([["speed", 4, ">"]], "OR"))
+
+    def test_partition_data(self):
+        bstream = BStream(json.load(open("demo_data/demo_template_unit_test.txt")), json.load(open("demo_data/demo_trip26.txt"))).aggregate
+        # empty partitions take the measures as they are
+        self.assertIs(bstream.partition_data([]), bstream["measures"])
+        self.assertTrue(bstream.partition_mask([]).all())
+        start_time = int(bstream["measures"]["timestamp"].iloc[10])
+        expected = bstream["measures"][np.greater(bstream["measures"]["timestamp"].values, start_time)]
+        self.assertTrue(bstream.partition_data([["timestamp", start_time, ">"]]).equals(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
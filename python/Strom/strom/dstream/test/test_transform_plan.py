@@ -0,0 +1,185 @@
+import json
+import unittest
+from copy import deepcopy
+
+import numpy as np
+
+from strom.dstream.bstream import BStream
+from strom.dstream.transform_plan import PlanCache, TransformPlan
+from strom.dstream.transform_state import TransformState
+from strom.utils.profiler import RuleProfiler
+
+
+class TestTransformPlan(unittest.TestCase):
+    def setUp(self):
+        demo_data_dir = "demo_data/"
+        self.dstream_template = json.load(open(demo_data_dir + "demo_template_unit_test.txt"))
+        self.dstream_template["template_id"] = "chadwick666"
+        self.dstreams = json.load(open(demo_data_dir + "demo_trip26.txt"))
+        self.bstream = BStream(self.dstream_template, self.dstreams).aggregate
+
+    def test_run(self):
+        expected = deepcopy(self.bstream)
+        expected.apply_filters()
+        expected.apply_dparam_rules()
+        expected.find_events()
+        plan = TransformPlan(self.dstream_template, BStream.select_transform)
+        self.bstream.apply_plan(plan)
+        self.assertTrue(self.bstream["measures"].equals(expected["measures"]))
+        self.assertEqual(self.bstream["events"].keys(), expected["events"].keys())
+        for event_name, event_df in expected["events"].items():
+            self.assertTrue(self.bstream["events"][event_name].equals(event_df))
+
+    def test_partition(self):
+        plan = TransformPlan(self.dstream_template, BStream.select_transform)
+        slope = plan.dparam_rules[0]
+        self.bstream.apply_filters()
+        expected = self.bstream.partition_data(self.dstream_template["dparam_rules"][0]["partition_list"])
+        self.assertTrue(slope.select(self.bstream.measure_store()).equals(expected[slope.measure_list]))
+        self.assertIsNone(plan.dparam_rules[1].partition_mask(self.bstream.measure_store()))
+
+    def test_schedule(self):
+        plan = TransformPlan(self.dstream_template, BStream.select_transform)
+        self.assertEqual(len(plan.levels), 2)
+        # slope reads timestamp_winning, the output of the WindowAverage filter
+        self.assertEqual([rule.param_dict["measure_rules"]["output_name"] for rule in plan.levels[1]], ["time_slope"])
+        self.assertEqual(len(plan.levels[0]), 11)
+
+        # same output written twice, the second write has to wait for the first
+        template = deepcopy(self.dstream_template)
+        template["dparam_rules"].append(deepcopy(template["dparam_rules"][1]))
+        plan = TransformPlan(template, BStream.select_transform)
+        self.assertEqual(len(plan.levels), 2)
+        self.assertIs(plan.levels[1][-1], plan.dparam_rules[-1])
+
+    def test_shared_partitions(self):
+        template = deepcopy(self.dstream_template)
+        template["dparam_rules"][1]["partition_list"] = deepcopy(template["dparam_rules"][0]["partition_list"])
+        plan = TransformPlan(template, BStream.select_transform)
+        self.assertEqual(plan.dparam_rules[0].partition_key, plan.dparam_rules[1].partition_key)
+        masks = {}
+        filtered = deepcopy(self.bstream)
+        filtered.apply_filters()
+        measures = filtered.measure_store()
+        plan.dparam_rules[1].select(measures, masks)
+        mask = masks[plan.dparam_rules[1].partition_key]
+        plan.dparam_rules[0].select(measures, masks)
+        self.assertIs(masks[plan.dparam_rules[0].partition_key], mask)
+
+        expected = deepcopy(self.bstream)
+        expected["dparam_rules"] = template["dparam_rules"]
+        expected.apply_filters()
+        expected.apply_dparam_rules()
+        self.bstream.apply_plan(plan)
+        self.assertTrue(self.bstream["measures"].equals(expected["measures"]))
+
+    def test_stale_partitions(self):
+        def scaled(target, output_name, scalar, partition_list):
+            return {"partition_list": partition_list, "measure_list": [target], "transform_type": "derive_param", "transform_name": "DeriveScaled",
+                    "param_dict": {"func_params": {"scalar": scalar}, "measure_rules": {"target_measure": target, "output_name": output_name}},
+                    "logical_comparison": "AND"}
+        middle = float(np.median(self.bstream["timestamp"]))
+        late = [["timestamp", middle, ">"]]
+        template = deepcopy(self.dstream_template)
+        template["filters"] = []
+        template["event_rules"] = {}
+        # the first level negates timestamp, the second partitions on it again with the same partition list
+        template["dparam_rules"] = [scaled("timestamp", "late", 1, late), scaled("timestamp", "timestamp", -1, []), scaled("late", "later", 1, late)]
+        plan = TransformPlan(template, BStream.select_transform)
+        self.assertEqual([len(level) for level in plan.levels], [2, 1])
+        self.bstream.apply_plan(plan)
+        self.assertTrue((self.bstream["measures"]["timestamp"] < 0).all())
+        self.assertTrue(self.bstream["measures"]["late"].notna().any())
+        # the mask of the first level is evaluated again on the negated timestamps, no row is late any more
+        self.assertTrue(self.bstream["measures"]["later"].isna().all())
+
+    def test_dead_columns(self):
+        template = deepcopy(self.dstream_template)
+        template["storage_rules"] = {"store_raw": True, "store_filtered": False, "store_derived": False}
+        plan = TransformPlan(template, BStream.select_transform)
+        # only head1 feeds the event rule
+        self.assertEqual([rule.outputs for level in plan.levels for rule in level], [{"head1"}])
+        self.bstream.apply_plan(plan)
+        self.assertIn("head1", self.bstream["measures"])
+        self.assertNotIn("time_slope", self.bstream["measures"])
+        self.assertNotIn("timestamp_winning", self.bstream["measures"])
+        self.assertIn("nice_event", self.bstream["events"]["test_event"]["event_name"].values)
+
+        # storing derived measures keeps slope and so the filter it reads
+        template["storage_rules"]["store_derived"] = True
+        plan = TransformPlan(template, BStream.select_transform)
+        self.assertEqual([rule.param_dict["filter_name"] for rule in plan.skipped], ["_buttery"])
+
+    def test_stream_state(self):
+        plan = TransformPlan(self.dstream_template, BStream.select_transform, BStream.select_stream_transform)
+        self.assertIsNotNone(plan.filters[0].stream_transform)
+        self.assertIsNone(plan.dparam_rules[0].stream_transform)
+        whole = deepcopy(self.bstream).apply_plan(plan, TransformState())["measures"]
+        state = TransformState()
+        first = BStream(self.dstream_template, self.dstreams[:150]).aggregate.apply_plan(plan, state)
+        # overlap rows of the second batch do not advance the filters again
+        second = BStream(self.dstream_template, self.dstreams[140:]).aggregate.apply_plan(plan, state, overlap=10)
+        second.drop_overlap(10)
+        for column in ["timestamp_buttery", "timestamp_winning", "time_change", "time_sum", "time_window_sum", "dist1", "dist2", "head1", "head2"]:
+            joined = np.concatenate((first["measures"][column].values, second["measures"][column].values)).astype(float)
+            self.assertTrue(np.allclose(joined, whole[column].values.astype(float), equal_nan=True), column)
+        self.assertEqual(len(state.export("abc123")), 9)
+
+    def test_window_rows(self):
+        template = deepcopy(self.dstream_template)
+        template["storage_rules"]["store_derived"] = False
+        template["window_rules"] = {"in_box": {
+            "partition_list": [["boxy", True, "=="]], "measure_list": ["id", "boxy"], "logical_comparison": "AND",
+            "param_dict": {"window": {"type": "tumbling", "size": 60000}, "group_by": None, "measure": "id",
+                           "aggregate": "distinct", "comparison_operator": ">", "threshold_value": 5}}}
+        plan = TransformPlan(template, BStream.select_transform)
+        # boxy is not stored but the window rule reads it
+        self.assertNotIn("boxy", [output for rule in plan.skipped for output in rule.outputs])
+        rows = plan.window_rows(self.bstream.apply_plan(plan))["in_box"]
+        in_box = self.bstream["measures"]["boxy"].values.astype(bool)
+        self.assertEqual(rows["timestamp"].tolist(), self.bstream["measures"]["timestamp"].values[in_box].tolist())
+        self.assertEqual(set(rows["key"]), {"chadwick666"})
+        self.assertEqual(set(rows["value"]), {26})
+        self.assertEqual(TransformPlan(self.dstream_template, BStream.select_transform).window_rows(self.bstream), {})
+
+    def test_profile(self):
+        plan = TransformPlan(self.dstream_template, BStream.select_transform)
+        profiler = RuleProfiler()
+        self.bstream.apply_plan(plan, profiler=profiler)
+        rules = profiler.templates["chadwick666"]
+        self.assertEqual(len(rules), 13)
+        self.assertEqual(rules["ButterLowpass:_buttery"].rows_in, len(self.bstream["measures"]))
+        self.assertEqual(rules["ButterLowpass:_buttery"].rows_out, len(self.bstream["measures"]))
+        self.assertLess(rules["DeriveSlope:time_slope"].rows_in, len(self.bstream["measures"]))
+        self.assertGreater(rules["DeriveSlope:time_slope"].bytes, 0)
+        self.assertIn("DetectThreshold:test_event", rules)
+        # processors send what they observed, the engine adds it up
+        engine = RuleProfiler()
+        engine.merge(profiler.export())
+        engine.merge(deepcopy(engine).export())
+        self.assertIsNone(profiler.export())
+        self.assertEqual(engine.templates["chadwick666"]["ButterLowpass:_buttery"].count, 2)
+        report = engine.report()["chadwick666"]["ButterLowpass:_buttery"]
+        self.assertEqual(sum(report["histogram"].values()), 2)
+        self.assertEqual(len(engine.summary(top=3)), 3)
+
+    def test_cache(self):
+        cache = PlanCache(BStream.select_transform, maxsize=2)
+        plan = cache.get(self.dstream_template)
+        self.assertIs(cache.get(self.dstream_template), plan)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        new_version = deepcopy(self.dstream_template)
+        new_version["version"] += 1
+        self.assertIsNot(cache.get(new_version), plan)
+        self.assertNotIn(("chadwick666", 0), cache.plans)
+        for template_id in ["tempA", "tempB"]:
+            other = deepcopy(self.dstream_template)
+            other["template_id"] = template_id
+            cache.get(other)
+        self.assertEqual(list(cache.plans.keys()), [("tempA", 0), ("tempB", 0)])
+        cache.invalidate("tempA")
+        self.assertEqual(list(cache.plans.keys()), [("tempB", 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,376 @@
+"""
+Transform plan
+
+A template's filters, dparam_rules and event_rules compiled once into an execution plan: transform
+callables resolved, partition lists compiled into shared predicates (see predicate.py) and rule
+parameters read out of the template. Running the plan on a BStream gives the same result as
+apply_filters, apply_dparam_rules and find_events.
+
+Filter and dparam rules are scheduled as a DAG. A rule depends on the rules that produce the columns
+in its measure_list or partition_list (output columns are known from filter_name and output_name), the
+rules are grouped into levels of rules that do not depend on each other and the outputs of a level
+are written to the BStream column store after the level. Partition masks are evaluated once per distinct
+partition_list, and again after a level overwrites one of the columns they test. Rules whose outputs are
+neither stored (storage_rules) nor consumed by a later rule or an event rule are not run at all.
+
+Given a TransformState (in the engine processors), rules with a streaming variant of their transform
+run that variant with the carried state of the stream.
+
+Given a RuleProfiler, the wall time, rows and bytes of every rule run are recorded under the
+rule's label, see strom.utils.profiler.
+
+Window rules (template "window_rules") are aggregated by the engine over all streams of the template,
+see strom.engine.window. The plan only picks out their rows of a processed batch with window_rows.
+
+Plans are cached per (template_id, version) in a PlanCache, a new version of a template evicts the
+plans of its older versions.
+"""
+from collections import OrderedDict
+from time import perf_counter
+
+import numpy as np
+
+from strom.utils.logger.logger import logger
+from strom.utils.profiler import elapsed_ms
+from .column_store import ColumnStore
+from .predicate import compile_predicate
+from .transform_state import rule_key
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+class CompiledRule(object):
+    """Single filter, dparam or event rule with its transform and partition predicate resolved"""
+
+    def __init__(self, rule, transform, event_name=None, stream_transform=None):
+        """
+        :param rule: rule from template
+        :type rule: dict
+        :param transform: transform callable
+        :type transform: function
+        :param event_name: key of rule in event_rules, None for filters and dparam rules
+        :type event_name: str
+        :param stream_transform: streaming variant of transform, None if it has none
+        :type stream_transform: function
+        """
+        self.event_name = event_name
+        self.transform_type = rule["transform_type"]
+        self.transform = transform
+        self.stream_transform = stream_transform
+        self.key = rule_key(rule)
+        self.measure_list = list(rule["measure_list"])
+        self.param_dict = rule["param_dict"]
+        self.logical_comparison = rule.get("logical_comparison", "AND")
+        self.predicate = compile_predicate(rule["partition_list"], self.logical_comparison)
+        self.partition_key = self.predicate.key
+        self.inputs = set(self.measure_list) | {column for column, _, _ in rule["partition_list"]}
+        self.outputs = self._outputs()
+        self.label = self._label(rule.get("transform_name"))
+
+    def _label(self, transform_name):
+        """Name of the rule in profiles, transform and what it writes"""
+        if self.event_name is not None:
+            return "{}:{}".format(transform_name, self.event_name)
+        if self.transform_type == "filter_data":
+            return "{}:{}".format(transform_name, self.param_dict.get("filter_name"))
+        return "{}:{}".format(transform_name, self.param_dict.get("measure_rules", {}).get("output_name"))
+
+    def _outputs(self):
+        """Columns the rule adds to measures, None if they are only known once the transform has run"""
+        if self.transform_type == "filter_data":
+            suffix = self.param_dict.get("filter_name")
+            return None if suffix is None else {measure + suffix for measure in self.measure_list}
+        if self.transform_type == "derive_param":
+            output_name = self.param_dict.get("measure_rules", {}).get("output_name")
+            return None if output_name is None else {output_name}
+        return set()
+
+    def partition_mask(self, measures):
+        """
+        Boolean mask of the rows in the partition, None if the rule takes every row
+        :param measures: measures column store
+        :type measures: ColumnStore
+        """
+        return self.predicate.mask(measures, len(measures))
+
+    def select(self, measures, masks=None):
+        """
+        Rows in partition, columns in measure_list
+        :param measures: measures column store
+        :type measures: ColumnStore
+        :param masks: partition masks already evaluated, by partition_key, filled in by this rule
+        :type masks: dict
+        """
+        if masks is None:
+            mask = self.partition_mask(measures)
+        else:
+            if self.partition_key not in masks:
+                masks[self.partition_key] = self.partition_mask(measures)
+            mask = masks[self.partition_key]
+        return measures.select(self.measure_list, mask)
+
+    def apply(self, measures, masks, state=None, stream_token=None, overlap=0):
+        """
+        Runs the transform on the rows and columns of the rule
+        :param measures: measures column store
+        :type measures: ColumnStore
+        :param masks: partition masks already evaluated, by partition_key
+        :type masks: dict
+        :param state: carry state of streaming transforms, None to run the batch transform
+        :type state: TransformState
+        :param stream_token: stream the batch belongs to
+        :type stream_token: str
+        :param overlap: leading rows already processed with the previous batch
+        :type overlap: int
+        :return: transform output
+        :rtype: pandas DataFrame
+        """
+        selected = self.select(measures, masks)
+        if state is None or self.stream_transform is None:
+            return self.transform(selected, self.param_dict)
+        mask = masks[self.partition_key]
+        skip = overlap if mask is None else int(np.count_nonzero(mask[:overlap]))
+        return self.stream_transform(selected, self.param_dict, state.get(stream_token, self.key), skip)
+
+
+def live_rules(rules, event_rules, storage_rules):
+    """
+    Filter and dparam rules whose outputs are needed, in template order. Outputs are needed if they are
+    stored or read by a needed rule or an event rule. Rules with outputs unknown up front are kept.
+    :param rules: filter and dparam rules in template order
+    :type rules: list of CompiledRule
+    :param event_rules: event rules
+    :type event_rules: list of CompiledRule
+    :param storage_rules: storage_rules of the template
+    :type storage_rules: dict
+    :rtype: list of CompiledRule
+    """
+    stored = {"filter_data": storage_rules.get("store_filtered", True), "derive_param": storage_rules.get("store_derived", True)}
+    needed = set()
+    for rule in event_rules:
+        needed |= rule.inputs
+    live = []
+    for rule in reversed(rules):
+        if rule.outputs is None or stored.get(rule.transform_type, True) or rule.outputs & needed:
+            live.append(rule)
+            needed |= rule.inputs
+    return live[::-1]
+
+
+def schedule(rules):
+    """
+    Groups rules into levels, a rule only depends on rules of earlier levels. A rule comes after the
+    rules that write the columns it reads or writes, and not before rules that read the columns it
+    writes. Rules with unknown outputs get a level of their own after every earlier rule.
+    :param rules: filter and dparam rules in template order
+    :type rules: list of CompiledRule
+    :return: levels, rules of a level in template order
+    :rtype: list of lists of CompiledRule
+    """
+    levels = []
+    written = {}
+    read = {}
+    floor = 0
+    for rule in rules:
+        if rule.outputs is None:
+            level = len(levels)
+        else:
+            level = max([floor]
+                        + [written[column] + 1 for column in rule.inputs | rule.outputs if column in written]
+                        + [read[column] for column in rule.outputs if column in read])
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(rule)
+        for column in rule.inputs:
+            read[column] = max(read.get(column, 0), level)
+        if rule.outputs is None:
+            floor = level + 1
+        else:
+            for column in rule.outputs:
+                written[column] = level
+    return levels
+
+
+class TransformPlan(object):
+    """Compiled rules of one template version, scheduled in dependency levels"""
+
+    def __init__(self, template, select_transform, select_stream_transform=None):
+        """
+        :param template: dstream template
+        :type template: dict
+        :param select_transform: select_transform(transform_type, transform_name) -> transform callable
+        :type select_transform: function
+        :param select_stream_transform: same for streaming variants, returns None for transforms without one
+        :type select_stream_transform: function
+        """
+        self.template_id = template.get("template_id")
+        self.version = template.get("version")
+
+        def compile_rule(rule, event_name=None):
+            stream_transform = None
+            if select_stream_transform is not None:
+                stream_transform = select_stream_transform(rule["transform_type"], rule["transform_name"])
+            return CompiledRule(rule, select_transform(rule["transform_type"], rule["transform_name"]), event_name, stream_transform)
+
+        self.filters = [compile_rule(rule) for rule in template.get("filters", [])]
+        self.dparam_rules = [compile_rule(rule) for rule in template.get("dparam_rules", [])]
+        self.event_rules = [compile_rule(rule, name) for name, rule in template.get("event_rules", {}).items()]
+        labels = {}
+        for rule in self.filters + self.dparam_rules + self.event_rules:
+            # rules doing the same thing under the same name are told apart by their position
+            labels[rule.label] = labels.get(rule.label, 0) + 1
+            if labels[rule.label] > 1:
+                rule.label = "{}#{}".format(rule.label, labels[rule.label])
+        self.window_rules = [CompiledRule(dict(rule, transform_type="window_aggregate"), None, name)
+                             for name, rule in (template.get("window_rules") or {}).items()]
+        rules = self.filters + self.dparam_rules
+        live = live_rules(rules, self.event_rules + self.window_rules, template.get("storage_rules") or {})
+        self.skipped = [rule for rule in rules if rule not in live]
+        self.levels = schedule(live)
+        self.order = {id(rule): position for position, rule in enumerate(rules)}
+        # columns each partition mask tests, masks are evaluated again once a level writes one of them
+        self.partition_columns = {rule.partition_key: set(rule.predicate.columns) for rule in rules + self.event_rules}
+        logger.debug(f"Plan {self.template_id}: {len(live)} rules in {len(self.levels)} levels, {len(self.skipped)} skipped")
+
+    def _observe(self, profiler, rule, store, masks, output, start):
+        """Records the run of a rule that started at perf_counter() reading `start`"""
+        ms = elapsed_ms(start)
+        mask = masks.get(rule.partition_key)
+        rows_in = len(store) if mask is None else int(np.count_nonzero(mask))
+        nbytes = int(output.memory_usage(index=False).sum())
+        if mask is not None and len(store):
+            # partitioned rows are copied out of the store, without a partition the rule gets a view
+            nbytes += sum(store[column].nbytes for column in rule.measure_list) * rows_in // len(store)
+        profiler.observe(self.template_id, rule.label, ms, rows_in, len(output), nbytes)
+
+    def run(self, bstream, state=None, overlap=0, profiler=None):
+        """
+        Applies filters, dparam rules and event rules to an aggregated bstream
+        :param bstream: aggregated bstream
+        :type bstream: BStream
+        :param state: carry state of streaming transforms, None to run batch transforms only
+        :type state: TransformState
+        :param overlap: leading rows already processed with the previous batch
+        :type overlap: int
+        :param profiler: records the cost of every rule, None to not profile
+        :type profiler: RuleProfiler
+        """
+        bstream["filter_measures"] = {}
+        bstream["derived_measures"] = {}
+        masks = {}
+        store = bstream.measure_store()
+        base_columns = list(store.keys())
+        added = {}
+        for level in self.levels:
+            # every rule of a level reads the store as the previous level left it
+            outputs = []
+            for rule in level:
+                start = perf_counter()
+                outputs.append((rule, rule.apply(store, masks, state, bstream["stream_token"], overlap)))
+                if profiler is not None:
+                    self._observe(profiler, rule, store, masks, outputs[-1][1], start)
+            written = set()
+            for rule, transformed_data in outputs:
+                added[self.order[id(rule)]] = list(transformed_data.columns)
+                written.update(transformed_data.columns)
+                store.write(transformed_data)
+            for partition_key in [key for key in masks if self.partition_columns[key] & written]:
+                del masks[partition_key]
+        # levels add columns out of template order, put them back in the order rule by rule application gives
+        store.reorder(base_columns + [column for position in sorted(added) for column in added[position]])
+        bstream.materialize()
+        bstream["events"] = {}
+        for rule in self.event_rules:
+            start = perf_counter()
+            bstream["events"][rule.event_name] = rule.apply(store, masks, state, bstream["stream_token"], overlap)
+            if profiler is not None:
+                self._observe(profiler, rule, store, masks, bstream["events"][rule.event_name], start)
+        return bstream
+
+    def window_rows(self, bstream):
+        """
+        Rows of a processed bstream the window rules aggregate, for WindowAggregator.add
+        :param bstream: bstream after run (and drop_overlap)
+        :type bstream: BStream
+        :return: {"params", "timestamp", "key", "value"} by rule name, empty without window rules
+        :rtype: dict
+        """
+        if not self.window_rules:
+            return {}
+        measures = ColumnStore(bstream["measures"])
+        masks = {}
+        rows = {}
+        for rule in self.window_rules:
+            if rule.partition_key not in masks:
+                masks[rule.partition_key] = rule.partition_mask(measures)
+            mask = masks[rule.partition_key]
+
+            def column(name):
+                return measures[name] if mask is None else measures[name][mask]
+
+            timestamps = column("timestamp")
+            group_by = rule.param_dict.get("group_by")
+            if group_by is None or group_by == "stream_token":
+                keys = np.full(timestamps.shape[0], self.template_id if group_by is None else bstream["stream_token"], dtype=object)
+            else:
+                keys = column(group_by)
+            measure = rule.param_dict.get("measure")
+            values = np.ones(timestamps.shape[0]) if measure is None else column(measure)
+            rows[rule.event_name] = {"params": rule.param_dict, "timestamp": timestamps, "key": keys, "value": values}
+        return rows
+
+
+class PlanCache(object):
+    """LRU cache of TransformPlans keyed by (template_id, version)"""
+
+    def __init__(self, select_transform, maxsize=64, select_stream_transform=None):
+        """
+        :param select_transform: select_transform(transform_type, transform_name) -> transform callable
+        :type select_transform: function
+        :param maxsize: most plans kept
+        :type maxsize: int
+        :param select_stream_transform: same for streaming variants, see TransformPlan
+        :type select_stream_transform: function
+        """
+        self.select_transform = select_transform
+        self.select_stream_transform = select_stream_transform
+        self.maxsize = maxsize
+        self.plans = OrderedDict()
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, template):
+        """
+        Plan for a template, compiled on first use of a template version
+        :param template: dstream template
+        :type template: dict
+        :rtype: TransformPlan
+        """
+        template_id, version = template.get("template_id"), template.get("version")
+        key = (template_id, version)
+        plan = self.plans.get(key)
+        if plan is not None:
+            self.hits += 1
+            self.plans.move_to_end(key)
+            return plan
+        self.misses += 1
+        previous = self.versions.get(template_id)
+        if previous is not None and previous != version:
+            # new version published, the old plan will not be asked for again
+            logger.debug(f"Template {template_id} version {previous} replaced by {version}")
+            self.plans.pop((template_id, previous), None)
+        plan = self.plans[key] = TransformPlan(template, self.select_transform, self.select_stream_transform)
+        self.versions[template_id] = version
+        if len(self.plans) > self.maxsize:
+            (old_id, old_version), _ = self.plans.popitem(last=False)
+            if self.versions.get(old_id) == old_version:
+                del self.versions[old_id]
+        return plan
+
+    def invalidate(self, template_id):
+        """Drops every cached plan of a template"""
+        for key in [key for key in self.plans if key[0] == template_id]:
+            del self.plans[key]
+        self.versions.pop(template_id, None)
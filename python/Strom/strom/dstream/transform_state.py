@@ -0,0 +1,51 @@
+"""
+Transform state
+
+Carry state of the streaming transforms, per stream and rule, kept by a processor from one batch of a
+stream to the next. A rule is identified by its content rather than its position in the template, so
+state survives new template versions that leave the rule unchanged and starts over for rules that
+changed.
+
+When the engine moves a stream to another processor the state moves with it: the batch before the
+move asks the processor to report the state of the stream with its stats, the engine hands it to the
+processor the stream moves to with its next batch and the previous processor drops its copy.
+"""
+import json
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+def rule_key(rule):
+    """Key of a template rule for its state"""
+    return json.dumps(rule, sort_keys=True, default=str)
+
+
+class TransformState(object):
+    """State dicts of streaming transforms by stream token and rule key"""
+
+    def __init__(self):
+        self.streams = {}
+
+    def get(self, stream_token, key):
+        """
+        State of one rule on one stream, an empty dict the transform fills in on its first batch
+        :param stream_token: stream token
+        :type stream_token: str
+        :param key: rule key
+        :type key: str
+        :rtype: dict
+        """
+        return self.streams.setdefault(stream_token, {}).setdefault(key, {})
+
+    def export(self, stream_token):
+        """State of every rule of a stream, None if the stream has none"""
+        return self.streams.get(stream_token) or None
+
+    def load(self, stream_token, states):
+        """Replaces the state of a stream with one exported by another processor"""
+        self.streams[stream_token] = states
+
+    def drop(self, stream_token):
+        """Forgets the state of a stream that moved to another processor"""
+        self.streams.pop(stream_token, None)
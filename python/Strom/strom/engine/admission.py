@@ -0,0 +1,211 @@
+"""
+Admission Module
+
+Bounds the records an engine holds. Records are counted per stream while they wait in the stream
+input queue, and globally while they wait in any stream queue or sit in a batch that is queued for or
+running on a processor. Each count has a high and a low watermark: crossing the high watermark
+switches the stream (or the engine) to overloaded, it only switches back once the count falls to
+the low watermark.
+
+What happens to records arriving while overloaded depends on the policy
+- "block": the writer (the engine's intake thread, never the pipe thread) waits until the count is
+back at the low watermark
+- "drop_oldest": records are queued and the oldest queued records of the stream are dropped
+- "reject": records are refused, the engine answers the server's load with the number rejected so
+it can answer HTTP 429
+
+Contains...
+- class Watermark:
+high/low watermark state with crossing counter
+- class AdmissionControl:
+record counts, watermarks and policy for all streams of an engine
+"""
+from threading import Condition
+
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+POLICIES = ("block", "drop_oldest", "reject")
+GLOBAL = None
+
+
+class Watermark(object):
+    """High/low watermark pair with hysteresis"""
+
+    def __init__(self, high, low):
+        """
+        :param high: count at which the watermark is crossed
+        :type high: int
+        :param low: count at which it is cleared again
+        :type low: int
+        """
+        if not 0 <= low < high:
+            raise ValueError(f"Invalid watermarks high {high} low {low}")
+        self.high = high
+        self.low = low
+        self.over = False
+        self.crossings = 0
+
+    def update(self, count):
+        """Returns True if the count switched the watermark on or off"""
+        if not self.over and count >= self.high:
+            self.over = True
+            self.crossings += 1
+            return True
+        if self.over and count <= self.low:
+            self.over = False
+            return True
+        return False
+
+
+class AdmissionControl(object):
+    """
+    Record counts and watermarks of an engine. Stream queues call admit/enqueued/dequeued, the engine
+    calls dispatched/processed for batches handed to processors.
+    """
+
+    def __init__(self, policy, stream_watermarks, global_watermarks, notify=None, block_timeout=1):
+        """
+        :param policy: "block", "drop_oldest" or "reject"
+        :type policy: str
+        :param stream_watermarks: (high, low) records waiting per stream
+        :type stream_watermarks: tuple
+        :param global_watermarks: (high, low) records waiting or in flight in the whole engine
+        :type global_watermarks: tuple
+        :param notify: called as notify(stream_token, overloaded) when a watermark switches, stream_token
+        is None for the global watermark
+        :type notify: callable
+        :param block_timeout: seconds between checks of `running` while blocked
+        :type block_timeout: float
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown admission policy {policy}, expected one of {POLICIES}")
+        self.policy = policy
+        self.stream_watermarks = stream_watermarks
+        self.global_watermark = Watermark(*global_watermarks)
+        self.notify = notify
+        self.block_timeout = block_timeout
+        self.running = True
+        self.cond = Condition()
+        self.depth = {}
+        self.watermarks = {}
+        self.in_flight = 0
+        self.total = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.blocked = 0
+
+    def _watermark(self, stream_token):
+        if stream_token not in self.watermarks:
+            self.watermarks[stream_token] = Watermark(*self.stream_watermarks)
+            self.depth[stream_token] = 0
+        return self.watermarks[stream_token]
+
+    def _check(self, stream_token=GLOBAL):
+        """Updates stream (if given) and global watermarks, must hold cond"""
+        switched = []
+        if stream_token is not GLOBAL:
+            watermark = self._watermark(stream_token)
+            if watermark.update(self.depth[stream_token]):
+                switched.append((stream_token, watermark.over))
+        if self.global_watermark.update(self.total):
+            switched.append((GLOBAL, self.global_watermark.over))
+        for token, over in switched:
+            logger.warning(f"Admission watermark {'crossed' if over else 'cleared'} for {token or 'engine'}")
+            if self.notify is not None:
+                self.notify(token, over)
+        if switched:
+            self.cond.notify_all()
+
+    def overloaded(self, stream_token):
+        with self.cond:
+            return self._watermark(stream_token).over or self.global_watermark.over
+
+    def admit(self, stream_token, count):
+        """
+        Applies the policy to `count` records arriving for a stream, blocks under the block policy
+        :return: number of records to queue, 0 if they were rejected
+        :rtype: int
+        """
+        with self.cond:
+            watermark = self._watermark(stream_token)
+            if self.policy == "reject":
+                if watermark.over or self.global_watermark.over:
+                    self.rejected += count
+                    return 0
+            elif self.policy == "block":
+                if watermark.over or self.global_watermark.over:
+                    self.blocked += 1
+                while self.running and (watermark.over or self.global_watermark.over):
+                    self.cond.wait(self.block_timeout)
+            return count
+
+    def enqueued(self, stream_token, count):
+        """
+        Counts records put in a stream queue
+        :return: number of oldest queued records to drop, only ever > 0 under the drop_oldest policy
+        :rtype: int
+        """
+        with self.cond:
+            self._watermark(stream_token)
+            self.depth[stream_token] += count
+            self.total += count
+            self._check(stream_token)
+            if self.policy != "drop_oldest":
+                return 0
+            excess = 0
+            if self.watermarks[stream_token].over:
+                excess = self.depth[stream_token] - self.watermarks[stream_token].low
+            if self.global_watermark.over:
+                excess = max(excess, self.total - self.global_watermark.low)
+            return min(excess, self.depth[stream_token])
+
+    def dequeued(self, stream_token, count, dropped=False):
+        """Counts records taken out of a stream queue, into the buffer or dropped"""
+        with self.cond:
+            self._watermark(stream_token)
+            self.depth[stream_token] -= count
+            self.total -= count
+            if dropped:
+                self.dropped += count
+            self._check(stream_token)
+
+    def dispatched(self, count):
+        """Counts records of a batch handed to a processor"""
+        with self.cond:
+            self.in_flight += count
+            self.total += count
+            self._check()
+
+    def processed(self, count):
+        """Counts records of a batch a processor is done with"""
+        with self.cond:
+            self.in_flight -= count
+            self.total -= count
+            self._check()
+
+    def close(self):
+        """Releases blocked writers"""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            return {
+                "policy": self.policy,
+                "stream_watermarks": list(self.stream_watermarks),
+                "global_watermarks": [self.global_watermark.high, self.global_watermark.low],
+                "records": self.total,
+                "records_in_flight": self.in_flight,
+                "engine_overloaded": self.global_watermark.over,
+                "streams_overloaded": sorted(t for t, w in self.watermarks.items() if w.over),
+                "global_crossings": self.global_watermark.crossings,
+                "stream_crossings": sum(w.crossings for w in self.watermarks.values()),
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+                "blocked": self.blocked,
+            }
@@ -2,12 +2,100 @@
 Buffer Module
 
 Buffer class stores dstreams.
+ColumnarBuffer stores dstreams as typed columns, one ring array per measure, built from the
+stream template. Rings start small and double as batches need more room, up to their capacity.
 """
+import numpy as np
+
+from strom.dstream.column_store import measure_dtype
+from strom.utils.logger.logger import logger
+from .timestamps import template_date_format, timestamp_parser
 
 __version__ = "0.1"
 __author__ = "Molly <molly@tura.io>"
 
 
+INITIAL_CAPACITY = 64
+
+
+def buffer_schema(template):
+    """
+    Builds the column layout for a stream from its template (or any dstream of the stream).
+    Columns are (group, name, dtype) tuples- group is the dstream key, name the measure/user id
+    within it. Templates without measures get a single object column holding whole records.
+    Timestamps are kept as they come (object) when the template has a date_format, they are parsed
+    per batch.
+    :param template: dstream template
+    :type template: dict
+    :return: list of column tuples
+    :rtype: list
+    """
+    if not isinstance(template, dict) or not isinstance(template.get("measures"), dict):
+        return [("records", None, np.dtype(object))]
+    if template_date_format(template) is not None:
+        schema = [("timestamp", None, np.dtype(object))]
+    else:
+        schema = [("timestamp", None, np.dtype(np.float64))]
+    for measure, measure_info in template["measures"].items():
+        dtype = measure_info.get("dtype") if isinstance(measure_info, dict) else None
+        schema.append(("measures", measure, measure_dtype(dtype)))
+    for uid in (template.get("user_ids") or {}).keys():
+        schema.append(("user_ids", uid, np.dtype(object)))
+    schema.append(("tags", None, np.dtype(object)))
+    schema.append(("fields", None, np.dtype(object)))
+    return schema
+
+
+def _extract(record, group, name):
+    if group == "records":
+        return record
+    value = record.get(group)
+    if name is None:
+        return value
+    try:
+        if group == "measures":
+            return value[name]["val"]
+        return value[name]
+    except (KeyError, TypeError):
+        return None
+
+
+def batch_records(columns, template=None):
+    """
+    Rebuilds dstream shaped dicts from a batch of columns, the inverse of ColumnarBuffer.write
+    :param columns: batch returned by ColumnarBuffer.batch
+    :type columns: dict
+    :param template: template (or first dstream) of the stream, its other keys (stream_token, template_id,
+    version...) and measure dtypes are put back in every record, None for the buffered keys only
+    :type template: dict
+    :return: records in batch
+    :rtype: list of dicts
+    """
+    if "records" in columns:
+        return list(columns["records"])
+    template = template if isinstance(template, dict) else {}
+    template_measures = template.get("measures") if isinstance(template.get("measures"), dict) else {}
+    timestamps = columns["timestamp"].tolist()
+    measures = {m: col.tolist() for m, col in columns["measures"].items()}
+    user_ids = {u: col.tolist() for u, col in columns["user_ids"].items()}
+    tags = columns["tags"].tolist()
+    fields = columns["fields"].tolist()
+    records = []
+    for i, ts in enumerate(timestamps):
+        buffered = {
+            "timestamp": ts,
+            "measures": {m: dict(template_measures.get(m) or {}, val=vals[i]) for m, vals in measures.items()},
+            "user_ids": {u: vals[i] for u, vals in user_ids.items()},
+            "tags": tags[i],
+            "fields": fields[i],
+        }
+        # keys in the order of the template, like the dstreams were loaded
+        record = {key: buffered.pop(key) if key in buffered else value for key, value in template.items()}
+        record.update(buffered)
+        records.append(record)
+    return records
+
+
 class Buffer(list):
     def __init__(self, rolling_window=0):
         super().__init__()
@@ -17,4 +105,177 @@ class Buffer(list):
             self.rolling_window = None
 
     def reset(self):
-        del self[:self.rolling_window]
\ No newline at end of file
+        del self[:self.rolling_window]
+
+
+class ColumnarBuffer(object):
+    """
+    Typed columnar buffer for a single stream.
+
+    Every column is a ring of records, so records are written straight into measure arrays instead of
+    being held as dict pointers. Rings start at INITIAL_CAPACITY records and double whenever the
+    current batch outgrows them, up to `max_capacity`, so idle or slow streams don't hold rings sized
+    for the largest batch. Positions are monotonic record counts, taken modulo capacity when indexing.
+    A batch is the range [batch_start - overlap, head): the first `overlap` records are the tail of the
+    previous batch (buffer_roll), shared by index rather than copied forward.
+    """
+
+    def __init__(self, template, capacity):
+        """
+        :param template: dstream template (or first dstream) of the stream
+        :type template: dict
+        :param capacity: most records the ring grows to, at least the max records per batch
+        :type capacity: int
+        """
+        self.template = template
+        self.timestamp_parser = timestamp_parser(template_date_format(template))
+        self.max_capacity = capacity
+        self.capacity = min(capacity, INITIAL_CAPACITY)
+        self.head = 0
+        self.batch_start = 0
+        self.overlap = 0
+        self.deadline = None
+        self.schema = buffer_schema(template)
+        self.schema_keys = [(group, name) for group, name, dtype in self.schema]
+        self.columns = {(group, name): np.empty(self.capacity, dtype=dtype) for group, name, dtype in self.schema}
+
+    def schema_changed(self, template):
+        """True if a template version adds, drops or retypes measures (or changes the timestamp format)"""
+        return buffer_schema(template) != self.schema
+
+    def set_template(self, template):
+        """
+        Swaps in new template version. When its column layout differs the columns are rebuilt empty,
+        the current batch has to be queued (and next_batch started) first, overlap records are dropped.
+        :param template: new dstream template of the stream
+        :type template: dict
+        """
+        self.template = template
+        self.timestamp_parser = timestamp_parser(template_date_format(template))
+        if not self.schema_changed(template):
+            return
+        if self.new_records:
+            logger.warning(f"Buffer layout changed with {self.new_records} records unbatched, dropping them")
+        self.batch_start = self.head
+        self.overlap = 0
+        self.deadline = None
+        self.capacity = min(self.max_capacity, INITIAL_CAPACITY)
+        self.schema = buffer_schema(template)
+        self.schema_keys = [(group, name) for group, name, dtype in self.schema]
+        self.columns = {(group, name): np.empty(self.capacity, dtype=dtype) for group, name, dtype in self.schema}
+
+    @property
+    def is_columnar(self):
+        return ("records", None) not in self.columns
+
+    @property
+    def new_records(self):
+        """Records written since the current batch started, not counting overlap"""
+        return self.head - self.batch_start
+
+    @property
+    def batch_len(self):
+        """Records in the current batch, overlap included"""
+        return self.overlap + self.head - self.batch_start
+
+    def _spans(self, start, end):
+        """Splits the record range [start, end) into at most two (ring, slice) spans"""
+        first = start % self.capacity
+        length = end - start
+        if first + length <= self.capacity:
+            return [(slice(first, first + length), slice(0, length))]
+        split = self.capacity - first
+        return [(slice(first, self.capacity), slice(0, split)), (slice(0, length - split), slice(split, length))]
+
+    def _reserve(self, count):
+        """Grows the rings so the current batch, overlap included, takes `count` more records"""
+        needed = self.batch_len + count
+        if needed <= self.capacity or self.capacity >= self.max_capacity:
+            return
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        capacity = min(capacity, self.max_capacity)
+        start = self.batch_start - self.overlap
+        old_spans = self._spans(start, self.head)
+        self.capacity = capacity
+        new_spans = self._spans(start, self.head)
+        for key, column in self.columns.items():
+            live = np.concatenate([column[ring] for ring, part in old_spans])
+            grown = np.empty(capacity, dtype=column.dtype)
+            for ring, part in new_spans:
+                grown[ring] = live[part]
+            self.columns[key] = grown
+        logger.debug(f"Buffer rings grown to {capacity} records")
+
+    def _write_value(self, key, position, value):
+        column = self.columns[key]
+        index = position % self.capacity
+        try:
+            column[index] = value
+        except (TypeError, ValueError):
+            if value is None and column.dtype.kind == "f":
+                column[index] = np.nan
+            else:
+                logger.warning(f"Buffer column {key} could not store {value!r}, promoting to object")
+                column = self.columns[key] = column.astype(object)
+                column[index] = value
+
+    def write(self, record):
+        """Appends single dstream to every column"""
+        self._reserve(1)
+        for key in self.schema_keys:
+            self._write_value(key, self.head, _extract(record, *key))
+        self.head += 1
+
+    def write_many(self, records):
+        """Appends list of dstreams, column by column"""
+        self._reserve(len(records))
+        spans = self._spans(self.head, self.head + len(records))
+        for key in self.schema_keys:
+            column = self.columns[key]
+            values = [_extract(record, *key) for record in records]
+            if column.dtype != object:
+                try:
+                    for ring, part in spans:
+                        column[ring] = values[part]
+                    continue
+                except (TypeError, ValueError):
+                    # missing or odd values, fall back to cell by cell writes
+                    pass
+            for n, value in enumerate(values):
+                self._write_value(key, self.head + n, value)
+        self.head += len(records)
+
+    def next_batch(self, roll=0):
+        """
+        Starts a new batch at head, reusing the last `roll` records of the current batch as overlap
+        :param roll: overlap records, 0 for none
+        :type roll: int
+        """
+        self.overlap = min(roll, self.batch_len)
+        self.batch_start = self.head
+
+    def batch(self, copy=True):
+        """
+        Returns the current batch, overlap included, as columns with string timestamps parsed to epoch
+        seconds in one go. A batch that wraps around the end of the ring is always copied.
+        :param copy: if False return views on the ring, only safe to use until it is overwritten
+        :type copy: bool
+        :return: dict of column arrays, grouped like a dstream
+        :rtype: dict
+        """
+        spans = self._spans(self.batch_start - self.overlap, self.head)
+        batch = {"measures": {}, "user_ids": {}} if self.is_columnar else {}
+        for (group, name), column in self.columns.items():
+            if len(spans) == 1:
+                values = column[spans[0][0]].copy() if copy else column[spans[0][0]]
+            else:
+                values = np.concatenate([column[ring] for ring, part in spans])
+            if group == "timestamp" and self.timestamp_parser is not None:
+                values = self.timestamp_parser.parse(values)
+            if name is None:
+                batch[group] = values
+            else:
+                batch[group][name] = values
+        return batch
@@ -0,0 +1,157 @@
+"""
+Dispatcher Module
+
+Routes batches to processors. Every processor has its own queue and every stream is owned by one
+processor at a time, so the batches of a stream are processed one after the other, in order, by the
+same process (which keeps its compiled rules and per stream state warm).
+
+A stream hashes to a home processor. When a stream has nothing in flight it is at a batch boundary
+and may move, the next batch goes to the least loaded processor if that is less loaded than the
+current owner. This is the only point work is stolen, so a stream never runs on two processors at once.
+Streams with processor side state move in two steps: the batch at the boundary still goes to the
+current owner, marked to export the state of the stream with its stats, and the stream moves at the
+next boundary, taking that state along.
+
+Processors can be added, retired and activated again at runtime. A retired processor takes no new
+streams and keeps the batches of streams already in flight on it, the engine parks it once it has
+nothing left in flight.
+
+Contains...
+- class StreamDispatcher:
+stream to processor assignment, in flight accounting
+"""
+import zlib
+from threading import Lock
+
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+class StreamDispatcher(object):
+    """Assigns stream batches to processor queues, keeping batches of one stream on one processor"""
+
+    def __init__(self, queues):
+        """
+        :param queues: input queue of every processor, by processor index
+        :type queues: list of JoinableQueue
+        """
+        self.queues = list(queues)
+        self.active = set(range(len(self.queues)))
+        self.owner = {}
+        self.in_flight = {}
+        self.load = [0] * len(self.queues)
+        self.steals = 0
+        # streams whose owner exports their state, they move at their next boundary
+        self.moving = set()
+        self.lock = Lock()
+
+    def home(self, stream_token):
+        """Processor a stream hashes to, stable across runs with the same active processors"""
+        active = sorted(self.active)
+        return active[zlib.crc32(str(stream_token).encode()) % len(active)]
+
+    def assign(self, stream_token):
+        """
+        Picks the processor for the next batch of a stream and counts the batch as in flight
+        :param stream_token: stream token
+        :type stream_token: str
+        :return: processor index
+        :rtype: int
+        """
+        return self._assign(stream_token)[0]
+
+    def _assign(self, stream_token, handoff=False):
+        """assign, with handoff a stream only moves once its owner exported its state, returns (processor, export)"""
+        with self.lock:
+            owner = self.owner.get(stream_token)
+            if owner is None:
+                owner = self.home(stream_token)
+            export = False
+            if self.in_flight.get(stream_token, 0) == 0:
+                # stream boundary, nothing of this stream is queued or running anywhere
+                least = min(self.active, key=self.load.__getitem__)
+                if owner not in self.active or self.load[least] < self.load[owner]:
+                    if handoff and stream_token in self.owner and stream_token not in self.moving:
+                        # one more batch on the owner, it hands back the state of the stream
+                        self.moving.add(stream_token)
+                        export = True
+                    else:
+                        if stream_token in self.owner:
+                            self.steals += 1
+                            logger.debug(f"Stream {stream_token} moved from processor {owner} to {least}")
+                        self.moving.discard(stream_token)
+                        owner = least
+                else:
+                    self.moving.discard(stream_token)
+            elif stream_token in self.moving:
+                export = True
+            self.owner[stream_token] = owner
+            self.in_flight[stream_token] = self.in_flight.get(stream_token, 0) + 1
+            self.load[owner] += 1
+            return owner, export
+
+    def dispatch(self, stream_token, batch, moved=None):
+        """
+        Queues batch on the processor that owns its stream
+        :param moved: for streams with state, called as moved(batch, previous processor) before the batch is
+        queued if the stream changes processor with it. The stream moves in two steps, the batch before
+        goes to the previous processor with batch["export_state"] set
+        :type moved: callable
+        :return: processor index
+        :rtype: int
+        """
+        previous = self.owner.get(stream_token)
+        processor, export = self._assign(stream_token, moved is not None)
+        if export:
+            batch["export_state"] = True
+        if moved is not None and previous is not None and processor != previous:
+            moved(batch, previous)
+        self.queues[processor].put(batch)
+        return processor
+
+    def add(self, queue):
+        """Adds a processor queue, returns its processor index"""
+        with self.lock:
+            self.queues.append(queue)
+            self.load.append(0)
+            self.active.add(len(self.queues) - 1)
+            return len(self.queues) - 1
+
+    def retire(self, processor):
+        """Stops giving new streams to a processor, the last active processor is never retired"""
+        with self.lock:
+            if processor not in self.active or len(self.active) == 1:
+                return False
+            self.active.discard(processor)
+            return True
+
+    def activate(self, processor):
+        """Gives new streams to a retired processor again"""
+        with self.lock:
+            self.active.add(processor)
+
+    def idle(self, processor):
+        """True if nothing is in flight on a processor"""
+        with self.lock:
+            return self.load[processor] == 0
+
+    def least_loaded(self):
+        """Active processor with the fewest batches in flight"""
+        with self.lock:
+            return min(self.active, key=self.load.__getitem__)
+
+    def done(self, stream_token, processor):
+        """Marks one batch of a stream as processed"""
+        with self.lock:
+            self.in_flight[stream_token] -= 1
+            self.load[processor] -= 1
+
+    def status(self):
+        with self.lock:
+            return {
+                "processor_load": {n: self.load[n] for n in sorted(self.active)},
+                "streams_in_flight": sum(1 for n in self.in_flight.values() if n > 0),
+                "steals": self.steals,
+            }
@@ -5,21 +5,43 @@ It is an engine, it runs. Puts piped data in buffer, spawns processes for the ag
 
 Contains...
 - class EngineThread:
-manages buffer, moves data from buffer to processing queue
+manages typed columnar buffers, moves batches of columns from buffer to processing queue
+- class FlushScheduler:
+services stream buffers with a fixed pool of threads, pushes partial batches on their deadline
 - class Processor:
 loads json from data messages to python, runs data transformation + storage process
+- class StreamDispatcher:
+routes batches to per processor queues, one processor per stream at a time
+- class SharedSlab:
+shared memory slots batches are handed to processors in
+- class BatchSizer:
+adapts batch size and timeout to processor load
+- class ProcessorScaler:
+adds and retires processors with backlog and CPU load
+- class AdmissionControl:
+high/low watermarks per stream and engine wide, block/drop_oldest/reject policies
+- class WindowAggregator:
+tumbling, sliding and session window aggregates over all streams of a template, threshold events
 """
 
-from multiprocessing import Process, JoinableQueue
-from queue import Queue
-from threading import Thread
-from time import time
-from datetime import datetime
-import numpy as np
+from multiprocessing import Process, JoinableQueue, Queue
+from queue import Empty, SimpleQueue
+from threading import RLock, Thread
+from time import sleep, time
+from .admission import AdmissionControl
+from .buffer import ColumnarBuffer
+from .dispatcher import StreamDispatcher
 from .processor import Processor
+from .scaler import ProcessorScaler, cpu_load
+from .scheduler import FlushScheduler, StreamQueue
+from .sizer import BatchSizer
+from .transport import SharedSlab, shared_memory
+from .window import WindowAggregator
 from .data_puller import DataPuller
+from strom.coordinator.sink import EventDispatcher, HTTPSink, QueueSink, dead_letter_path
 from strom.dstream.dstream import DStream
 from strom.utils.logger.logger import logger
+from strom.utils.profiler import RuleProfiler
 
 __version__ = "0.1"
 __author__ = "Molly <molly@tura.io>"
@@ -33,12 +55,40 @@ class Engine(Process):
     Contains buffer, queue for processors, processors, ConsumerThread.
     """
 
-    def __init__(self, engine_conn, processors=4, buffer_roll=0, buffer_max_batch=50, buffer_max_seconds=1, test_mode=False, test_outfile='engine_test_output/engine_test_output'):
+    def __init__(self, engine_conn, processors=4, buffer_roll=0, buffer_max_batch=50, buffer_max_seconds=1, test_mode=False, test_outfile='engine_test_output/engine_test_output', shared_slots=2, shared_slot_bytes=1 << 20, flush_workers=4, batch_bounds=None, seconds_bounds=None, sizer_interval=1, processor_bounds=None, admission_policy=None, stream_watermarks=(10000, 5000), global_watermarks=(100000, 50000), admission_conn=None, sink_queue=None, profile_log_interval=60):
         """
         Initializes with empty buffer & queue,
          set # of processors...
         :param processors: number of processors to start
         :type processors: int
+        :param processor_bounds: (min, max) processors to scale between at runtime, None for a fixed pool. All max
+        processors are started with the engine, those not needed wait parked
+        :type processor_bounds: tuple
+        :param admission_policy: "block", "drop_oldest" or "reject" records over the watermarks, None for no limits
+        :type admission_policy: str
+        :param stream_watermarks: (high, low) records waiting per stream
+        :type stream_watermarks: tuple
+        :param global_watermarks: (high, low) records waiting or in flight in the engine
+        :type global_watermarks: tuple
+        :param admission_conn: pipe end watermark switches are sent on as ("admission", stream_token, overloaded),
+        stream_token is None for the engine wide watermark
+        :type admission_conn: Connection
+        :param sink_queue: queue processors hand events and measures to the server on, None to post them over HTTP
+        :type sink_queue: Queue
+        :param shared_slots: shared memory batch slots per processor, 0 to pickle batches through queue
+        :type shared_slots: int
+        :param shared_slot_bytes: size of each shared memory batch slot
+        :type shared_slot_bytes: int
+        :param flush_workers: number of threads servicing stream buffers
+        :type flush_workers: int
+        :param batch_bounds: (min, max) records per batch for adaptive sizing, None for fixed buffer_max_batch
+        :type batch_bounds: tuple
+        :param seconds_bounds: (min, max) batch timeout for adaptive sizing, None for fixed buffer_max_seconds
+        :type seconds_bounds: tuple
+        :param sizer_interval: seconds between batch size adjustments
+        :type sizer_interval: float
+        :param profile_log_interval: seconds between rule profile summaries in the log, None for no summaries
+        :type profile_log_interval: float
         """
         logger.info("Initializing EngineThread")
         super().__init__()
@@ -46,46 +96,141 @@ class Engine(Process):
         self.test_outfile = test_outfile
         self.test_batches = {}
         self.pipe_conn = engine_conn
-        self.buffers_out_q = JoinableQueue()
+        self.processor_qs = []
+        self.dispatcher = None
+        self.batch_stats_q = Queue()
+        # (state, time) of streams about to move, exported by their processor on the dispatcher's request
+        self.transform_state = {}
+        self.state_ttl = 300
+        self.stats_thread = None
+        self.window_q = Queue()
+        self.window_tick = 1.0
+        self.windows = WindowAggregator()
+        self.windows_thread = None
+        self.profiler = RuleProfiler()
+        self.profile_lock = RLock()
+        self.profile_log_interval = profile_log_interval
         self.number_of_processors = processors
         self.processors = []
+        self.pool_lock = RLock()
+        self.admission_conn = admission_conn
+        self.sink_queue = sink_queue
+        if admission_policy is not None:
+            self.admission = AdmissionControl(admission_policy, stream_watermarks, global_watermarks, self._admission_notify)
+        else:
+            self.admission = None
+        # under the block policy records are put in the stream queues by the intake thread, a blocked
+        # put never holds up the pipe (status, profile and stop requests)
+        self.intake_q = SimpleQueue() if admission_policy == "block" else None
+        self.intake_thread = None
+        self.retiring = set()
+        # running processors taking no batches, see _init_processors
+        self.parked = []
+        if processor_bounds is not None:
+            self.scaler = ProcessorScaler(*processor_bounds)
+            self.max_processors = max(processor_bounds[1], processors)
+        else:
+            self.scaler = None
+            self.max_processors = processors
+        self.shared_slots = shared_slots
+        self.shared_slot_bytes = shared_slot_bytes
+        self.slab = None
+        # seconds to wait for a free slot before sending a batch pickled
+        self.slab_timeout = 1.0
         self.run_engine = False
-        self.buffer_record_limit = int(buffer_max_batch)
-        self.buffer_time_limit_s = float(buffer_max_seconds)
+        self.sizer = BatchSizer(buffer_max_batch, buffer_max_seconds, batch_bounds, seconds_bounds, processors)
+        self.sizer_interval = sizer_interval
+        self.sizer_thread = None
         self.buffers = {}
         self.buffer_in_qs = {}
-        self.buffer_workers = {}
+        self.flush_workers = flush_workers
+        self.scheduler = None
         self.data_pullers = {}
-        self.buffer_roll = -buffer_roll
-        if buffer_roll > 0:
-            self.buffer_roll_index = -buffer_roll
-        else:
-            self.buffer_roll_index = None
+        if not 0 <= buffer_roll < self.sizer.min_batch:
+            raise ValueError(f"buffer_roll must be at least 0 and less than the smallest batch size, got {buffer_roll}")
+        self.buffer_roll = int(buffer_roll)
 
     def _init_processors(self):
-        """Initializes + starts set number of processors"""
-        for n in range(self.number_of_processors):
-            processor = Processor(self.buffers_out_q, self.test_run)
+        """
+        Starts processors up to the most the engine may scale to, the ones over the set number are parked.
+        All are forked here, before the engine starts any thread: forking a process that runs threads can
+        leave locks held in the child (logging, queue feeders) and deadlock it. The price is an idle process
+        per parked processor.
+        """
+        if self.shared_slots > 0 and shared_memory is not None:
+            self.slab = SharedSlab(self.shared_slots * self.max_processors, self.shared_slot_bytes)
+        self.dispatcher = StreamDispatcher([])
+        for n in range(self.max_processors):
+            self._start_processor()
+        for n in range(self.number_of_processors, self.max_processors):
+            self.dispatcher.retire(n)
+            self.parked.append(n)
+        self.sizer.processors = self._active_processors()
+
+    def _start_processor(self):
+        """Starts a processor with its own queue and hands it to the dispatcher"""
+        with self.pool_lock:
+            processor_q = JoinableQueue()
+            processor = Processor(processor_q, self.test_run, self.slab, self.batch_stats_q, len(self.processors), self.sink_queue, window_queue=self.window_q)
             processor.start()
+            self.processor_qs.append(processor_q)
             self.processors.append(processor)
+            self.dispatcher.add(processor_q)
+            logger.info(f"Started processor {processor.processor_id}")
+
+    def _add_processor(self):
+        """Gives streams to a parked processor again, processors are never forked once the engine runs"""
+        with self.pool_lock:
+            if not self.parked:
+                logger.warning("No parked processor left to add")
+                return
+            n = self.parked.pop()
+            self.dispatcher.activate(n)
+            self.sizer.processors = self._active_processors()
+            logger.info(f"Unparked processor {n}, {self.sizer.processors} active")
 
-    def _new_buffer(self, partition_key):
+    def _retire_processor(self):
+        """Retires the least loaded processor, it is parked once its in flight batches are done"""
+        with self.pool_lock:
+            n = self.dispatcher.least_loaded()
+            if self.dispatcher.retire(n):
+                self.retiring.add(n)
+                self.sizer.processors = self._active_processors()
+                logger.info(f"Retiring processor {n}, {self.sizer.processors} active")
+
+    def _reap_processors(self):
+        """Parks retired processors with nothing left in flight, they keep running idle until added again"""
+        with self.pool_lock:
+            for n in list(self.retiring):
+                if not self.dispatcher.idle(n):
+                    continue
+                self.retiring.discard(n)
+                self.parked.append(n)
+                logger.info(f"Processor {n} retired")
+
+    def _active_processors(self):
+        return len(self.processors) - len(self.retiring) - len(self.parked)
+
+    def _scale_processors(self, utilization):
+        with self.pool_lock:
+            # engine may have stopped while waiting for the pool
+            if not self.run_engine:
+                return
+            change = self.scaler.decide(self._active_processors(), self._queue_depth(), utilization, cpu_load())
+            if change > 0:
+                self._add_processor()
+            elif change < 0:
+                self._retire_processor()
+
+    def _new_buffer(self, partition_key, template):
         if partition_key not in self.buffers:
-            self.buffers[partition_key] = np.array(
-                [{0: 0}] * (self.buffer_record_limit * self.number_of_processors)).reshape(
-                self.number_of_processors, self.buffer_record_limit)
+            self.buffers[partition_key] = ColumnarBuffer(template, self.max_processors * self.sizer.max_batch)
             if self.test_run:
                 self.test_batches[partition_key] = 1
             if partition_key not in self.buffer_in_qs:
-                self.buffer_in_qs[partition_key] = Queue()
+                self.buffer_in_qs[partition_key] = StreamQueue(partition_key, self.scheduler, self.admission)
             else:
                 logger.warn(f"New buffer, existing buffer_in_q for stream {partition_key}")
-            if partition_key not in self.buffer_workers:
-                self.buffer_workers[partition_key] = Thread(target=self.run_buffer,
-                                                            args=[partition_key])
-                self.buffer_workers[partition_key].start()
-            else:
-                logger.warn(f"New buffer, existing buffer_worker for stream {partition_key}")
             return True
         else:
             return False
@@ -103,138 +248,353 @@ class Engine(Process):
 
     def run(self):
         """
-        Sets up numpy array buffer and puts stuff in and gets stuff out
+        Sets up buffers and puts stuff in and gets stuff out.
+        Pipe messages: (dstream, "new"), (dstream, "load"), ("load_batch", stream_token, [dstreams]),
+        ("load_streams", {stream_token: [dstreams]}) (answered with {stream_token: records rejected} of the
+        streams admission control rejected records of), "engine_status" (answered with a status dict on the pipe), "engine_profile" (answered with
+        the rule profile of all templates) or "stop_poison_pill"
         """
         self._init_processors()
         self.run_engine = True
+        self.scheduler = FlushScheduler(self.service_buffer, self._pending, self.flush_workers)
+        self.scheduler.start()
+        self.stats_thread = Thread(target=self._run_batch_stats, name="batch-stats")
+        self.stats_thread.daemon = True
+        self.stats_thread.start()
+        self.windows_thread = Thread(target=self._run_windows, name="windows")
+        self.windows_thread.daemon = True
+        self.windows_thread.start()
+        self.sizer_thread = Thread(target=self._run_sizer, name="batch-sizer")
+        self.sizer_thread.daemon = True
+        self.sizer_thread.start()
+        self._start_intake()
 
         while self.run_engine:
-            if self.pipe_conn.poll():
+            # blocks until the server sends something, no busy polling
+            try:
                 item = self.pipe_conn.recv()
-                # branch 2 - stop engine
-                if item == "stop_poison_pill":
-                    for q in self.buffer_in_qs.keys():
-                        self.buffer_in_qs[q].put("stop_buffer_worker")
-                    self.run_engine = False
-                    break
-                # branch 1 - engine running, good data
-                elif type(item) is tuple:
-                    partition_key = item[0]['stream_token']
-                    new_buffer = self._new_buffer(partition_key)
-                    if new_buffer:
-                        logger.info(f"Initialized buffer for stream {partition_key}")
-                    if item[1] == "new":
-                        if item[0]["data_rules"]["pull"] is True:
-                            new_puller = self._new_data_puller(partition_key, item[0])
-                            if new_puller:
-                                print(f"Initialized data puller for stream {partition_key}")
-                            else:
-                                logger.warn(
-                                    f"Attempting to initialize data puller for stream {partition_key} - puller already exists")
-                    elif item[1] == "load":
-                        self.buffer_in_qs[partition_key].put(item[0])
-                    else:
-                        raise TypeError(
-                            "Invalid tuple in pipe - index 1 must be str 'load' or str 'new'")
+            except EOFError:
+                logger.warning("Engine pipe closed by server")
+                self.run_engine = False
+                self.scheduler.stop()
+                break
+            # branch 2 - stop engine
+            if item == "stop_poison_pill":
+                self.run_engine = False
+                self.scheduler.stop()
+                break
+            elif item == "engine_status":
+                self.pipe_conn.send(self.status())
+            elif item == "engine_profile":
+                with self.profile_lock:
+                    self.pipe_conn.send(self.profiler.report())
+            # branch 3 - batch of dstreams for one stream
+            elif type(item) is tuple and item[0] == "load_batch":
+                self._load_stream(item[1], item[2])
+            # branch 4 - dstreams of an http request by stream, one round trip for all of them
+            elif type(item) is tuple and item[0] == "load_streams":
+                self.pipe_conn.send(self._load_streams(item[1]))
+            # branch 1 - engine running, good data
+            elif type(item) is tuple:
+                partition_key = item[0]['stream_token']
+                new_buffer = self._new_buffer(partition_key, item[0])
+                if new_buffer:
+                    logger.info(f"Initialized buffer for stream {partition_key}")
+                if item[1] == "new":
+                    if not new_buffer:
+                        self._set_template(partition_key, item[0])
+                    if item[0]["data_rules"]["pull"] is True:
+                        new_puller = self._new_data_puller(partition_key, item[0])
+                        if new_puller:
+                            print(f"Initialized data puller for stream {partition_key}")
+                        else:
+                            logger.warn(
+                                f"Attempting to initialize data puller for stream {partition_key} - puller already exists")
+                elif item[1] == "load":
+                    self._load(partition_key, [item[0]])
                 else:
-                    raise TypeError("Invalid item in pipe")
+                    raise TypeError(
+                        "Invalid tuple in pipe - index 1 must be str 'load' or str 'new'")
+            else:
+                raise TypeError("Invalid item in pipe")
         logger.info("Terminating Engine Thread")
         self.stop_engine()
 
-    def run_buffer(self, partition_key):
-        last_col = self.buffer_record_limit - 1
-        last_row = self.number_of_processors - 1
-        cur_row = 0
-        cur_col = 0
-        batch_tracker = {'start_time': time(), 'leftos_collected': False}
+    def _load_stream(self, partition_key, dstreams):
+        """
+        Loads a batch of dstreams of one stream, setting up its buffer on the first one
+        :return: number of dstreams admission control rejected
+        :rtype: int
+        """
+        if not len(dstreams):
+            return 0
+        if self._new_buffer(partition_key, dstreams[0]):
+            logger.info(f"Initialized buffer for stream {partition_key}")
+        return len(dstreams) - self._load(partition_key, dstreams)
 
-        while self.run_engine:
+    def _load_streams(self, batches):
+        """
+        Loads the dstreams of several streams
+        :param batches: dstreams by stream token
+        :type batches: dict
+        :return: number of rejected dstreams by stream token, only streams with rejected dstreams
+        :rtype: dict
+        """
+        rejected = {}
+        for partition_key, dstreams in batches.items():
+            count = self._load_stream(partition_key, dstreams)
+            if count:
+                rejected[partition_key] = count
+        return rejected
+
+    def _load(self, partition_key, dstreams):
+        """
+        Puts dstreams in the input queue of their stream, through the intake thread under the block policy
+        :return: number of dstreams queued, less than given if admission control rejected them
+        :rtype: int
+        """
+        if self.intake_q is not None:
+            self.intake_q.put((partition_key, dstreams))
+            return len(dstreams)
+        return self.buffer_in_qs[partition_key].put_many(dstreams)
+
+    def _set_template(self, partition_key, template):
+        """
+        Queues a new template version behind the records already loaded for the stream, the flush
+        worker swaps it into the buffer in order (see service_buffer)
+        """
+        control = ("set_template", template)
+        if self.intake_q is not None:
+            self.intake_q.put((partition_key, control))
+        else:
+            self.buffer_in_qs[partition_key].put_control(control)
+
+    def _start_intake(self):
+        if self.intake_q is not None:
+            self.intake_thread = Thread(target=self._run_intake, name="intake")
+            self.intake_thread.daemon = True
+            self.intake_thread.start()
+
+    def _run_intake(self):
+        """Puts loaded dstreams in their stream queues, waiting on admission control, None stops it"""
+        while True:
+            item = self.intake_q.get()
+            if item is None:
+                break
+            partition_key, dstreams = item
+            if type(dstreams) is tuple:
+                self.buffer_in_qs[partition_key].put_control(dstreams)
+            else:
+                self.buffer_in_qs[partition_key].put_many(dstreams)
+
+    def _queue_batch(self, partition_key):
+        """
+        Copies the current batch of a buffer out as columns and queues it for the processors. With a
+        shared slab the numeric columns are written into a free slot, waiting up to slab_timeout for
+        processors to free one before sending the batch pickled instead. The batch starts with `overlap`
+        records already sent as the tail of the previous batch. A batch of a stream that moves to
+        another processor takes the transform state of the stream along.
+        """
+        buffer = self.buffers[partition_key]
+        batch = {"stream_token": partition_key, "template": buffer.template, "slot": None, "overlap": buffer.overlap, "records": buffer.new_records}
+        # columns are built before a slot is taken, a batch that fails here holds no slot
+        columns = buffer.batch(copy=self.slab is None)
+        if self.slab is not None:
             try:
-                item = self.buffer_in_qs[partition_key].get(timeout=self.buffer_time_limit_s)
-                # branch 2 - stop engine
-                if item == "stop_buffer_worker":
-                    break
-                # branch 1 - engine running, good data
-                elif isinstance(item, DStream) or (type(item) is dict and "stream_token" in item.keys()):
-                    if "data_rules" in item.keys(): # some unit test data doesnt have this field
-                        if "date_format" in item["data_rules"].keys():
-                            if item["data_rules"]["date_format"] is not None:
-                                item["timestamp"] = datetime.strptime(item["timestamp"], item["data_rules"]["date_format"]).timestamp()
-                    # branch 1.1 - not last row
-                    if cur_row < last_row:
-                        # branch 1.1a - not last column, continue row
-                        if cur_col < last_col:
-                            logger.info("Buffering- row {}".format(cur_row))
-                            self.buffers[partition_key][cur_row, cur_col] = item
-                            cur_col += 1
-                        # branch 1.1b - last column, start new row
-                        else:
-                            self.buffers[partition_key][cur_row, cur_col] = item
-                            if self.test_run:
-                                self.buffers_out_q.put((self.buffers[partition_key][cur_row].copy(), f"{self.test_outfile}_{partition_key}_{self.test_batches[partition_key]}.txt"))
-                                self.test_batches[partition_key] += 1
-                            else:
-                                self.buffers_out_q.put(self.buffers[partition_key][cur_row].copy())
-                            logger.info("New batch queued")
-                            roll_window = self.buffers[partition_key][cur_row, self.buffer_roll_index:]
-                            cur_row += 1
-                            for n in roll_window:
-                                for i in range(abs(self.buffer_roll)):
-                                    self.buffers[partition_key][cur_row, i] = n
-                            cur_col -= cur_col + self.buffer_roll
-                            # REMOVE
-                            batch_tracker['start_time'] = time()
-                    # branch 1.2 - last row
-                    else:
-                        # branch 1.2a - not last column, continue row
-                        if cur_col < last_col:
-                            self.buffers[partition_key][cur_row, cur_col] = item
-                            cur_col += 1
-                        # branch 1.2b - last column, start return to first row in new cycle
-                        else:
-                            self.buffers[partition_key][cur_row, cur_col] = item
-                            if self.test_run:
-                                self.buffers_out_q.put((self.buffers[partition_key][cur_row].copy(), f"{self.test_outfile}_{partition_key}_{self.test_batches[partition_key]}.txt"))
-                                self.test_batches[partition_key] += 1
-                            else:
-                                self.buffers_out_q.put(self.buffers[partition_key][cur_row].copy())
-
-                            roll_window = self.buffers[partition_key][cur_row, self.buffer_roll_index:]
-                            cur_row -= cur_row
-                            for n in roll_window:
-                                for i in range(abs(self.buffer_roll)):
-                                    self.buffers[partition_key][cur_row, i] = n
-                            cur_col -= cur_col + self.buffer_roll
-                            batch_tracker['start_time'] = time()
-                    batch_tracker['leftos_collected'] = False
-                # branch 3 bad data
-                else:
-                    raise TypeError("Queued item is not valid dictionary.")
-            except:
-            # buffer time max reached, engine still running
-                logger.info("Buffer batch timeout exceeded")
-                if self.run_engine is True:
-                    # engine running, batch timeout with new buffer data (partial row)
-                    if cur_col > abs(self.buffer_roll) and batch_tracker['leftos_collected'] is False:
-                        logger.info(
-                            "Collecting leftovers- pushing partial batch to queue after batch timeout")
-                        if self.test_run:
-                            self.buffers_out_q.put((self.buffers[partition_key][cur_row, :cur_col].copy(), f"{self.test_outfile}_{partition_key}_{self.test_batches[partition_key]}.txt"))
-                            self.test_batches[partition_key] += 1
-                        else:
-                            self.buffers_out_q.put(self.buffers[partition_key][cur_row, :cur_col].copy())
-                        if cur_row < last_row:
-                            cur_row += 1
-                        else:
-                            cur_row -= cur_row
+                batch["slot"] = self.slab.acquire(timeout=self.slab_timeout)
+            except Empty:
+                logger.warning(f"No free shared slot after {self.slab_timeout}s, sending batch of {partition_key} pickled")
+                columns = buffer.batch()
+        try:
+            if batch["slot"] is not None:
+                columns = self.slab.pack(batch["slot"], columns)
+            batch["columns"] = columns
+            if self.test_run:
+                batch["outfile"] = f"{self.test_outfile}_{partition_key}_{self.test_batches[partition_key]}.txt"
+                self.test_batches[partition_key] += 1
+            if self.admission is not None:
+                self.admission.dispatched(batch["records"])
+            self.dispatcher.dispatch(partition_key, batch, self._move_state)
+        except Exception:
+            # the processor never sees the batch, nobody else frees its slot
+            if batch["slot"] is not None:
+                self.slab.release(batch["slot"])
+            raise
+
+    def _move_state(self, batch, previous):
+        """Sends the transform state of a stream along with its batch to the processor it moves to, the previous one drops it"""
+        state = self.transform_state.pop(batch["stream_token"], None)
+        batch["transform_state"] = state[0] if state is not None else None
+        self.dispatcher.queues[previous].put(("drop_state", batch["stream_token"]))
+
+    def _expire_state(self, now):
+        """Forgets exported state of streams that stopped sending before they moved"""
+        for partition_key in [key for key, (state, exported) in self.transform_state.items() if now - exported > self.state_ttl]:
+            self.transform_state.pop(partition_key, None)
+
+    def _pending(self, partition_key):
+        return not self.buffer_in_qs[partition_key].empty()
+
+    def service_buffer(self, partition_key):
+        """
+        Drains the input queue of a stream into its buffer, queueing every full batch, and pushes the
+        leftovers of a partial batch once its deadline passed. A new template version is swapped in
+        where it was queued, after the records loaded before it. Run by FlushScheduler workers, never
+        by two workers at once for the same stream.
+        :param partition_key: stream token
+        :type partition_key: str
+        :return: flush deadline of the partial batch in the buffer, None if there is none
+        :rtype: float
+        """
+        buffer = self.buffers[partition_key]
+        dstreams = []
+        for item in self.buffer_in_qs[partition_key].get_all():
+            # branch 1 - engine running, good data
+            # string timestamps are parsed per batch by the buffer, with the stream's date_format
+            if isinstance(item, DStream) or (type(item) is dict and "stream_token" in item.keys()):
+                dstreams.append(item)
+            # branch 2 - new template version, records before it are batched with the old one
+            elif type(item) is tuple and item[0] == "set_template":
+                self._write_batches(partition_key, dstreams)
+                dstreams = []
+                if buffer.schema_changed(item[1]) and buffer.new_records and self.run_engine:
+                    logger.info(f"Template of stream {partition_key} changed its measures, pushing partial batch to queue")
+                    self._queue_batch(partition_key)
+                    buffer.next_batch()
+                buffer.set_template(item[1])
+            # branch 3 bad data
+            else:
+                logger.warning(f"Queued item for stream {partition_key} is not valid dictionary.")
+        self._write_batches(partition_key, dstreams)
+
+        # batch time max reached, push partial batch (leftovers) without roll over
+        if buffer.deadline is not None and buffer.deadline <= time() and self.run_engine:
+            logger.info("Collecting leftovers- pushing partial batch to queue after batch timeout")
+            self._queue_batch(partition_key)
+            buffer.next_batch()
+            buffer.deadline = None
+        return buffer.deadline
+
+    def _write_batches(self, partition_key, dstreams):
+        """Writes dstreams into the buffer of their stream, queueing every batch they fill"""
+        buffer = self.buffers[partition_key]
+        row_len = self.sizer.batch
+        time_limit = self.sizer.seconds
+        while dstreams and self.run_engine:
+            # fill rest of current batch in one go, batch size may have shrunk below what is buffered
+            space = max(row_len - buffer.batch_len, 0)
+            chunk, dstreams = dstreams[:space], dstreams[space:]
+            if chunk:
+                buffer.write_many(chunk)
+            # batch timer starts with the first record that is not roll over
+            if buffer.deadline is None:
+                buffer.deadline = time() + time_limit
+            # batch full, queue it and start next one with its tail as overlap
+            if buffer.batch_len >= row_len:
+                self._queue_batch(partition_key)
+                logger.info("New batch queued")
+                buffer.next_batch(self.buffer_roll)
+                buffer.deadline = None
+
+    def _admission_notify(self, partition_key, overloaded):
+        if self.admission_conn is not None:
+            self.admission_conn.send(("admission", partition_key, overloaded))
+
+    def _queue_depth(self):
+        try:
+            return sum(q.qsize() for q in self.processor_qs)
+        except NotImplementedError:
+            # no sem_getvalue on macOS, treat as idle
+            return 0
+
+    def _run_batch_stats(self):
+        """Collects (processor, stream, records, seconds, transform state, rule profile) of every processed batch, None stops it"""
+        while True:
+            stats = self.batch_stats_q.get()
+            if stats is None:
+                break
+            processor, partition_key, records, elapsed, state, profile = stats
+            if profile is not None:
+                with self.profile_lock:
+                    self.profiler.merge(profile)
+            if partition_key is None:
+                # profile of an idle or stopping processor, no batch
+                continue
+            if state is not None:
+                # kept before the batch counts as done, a stream only moves once nothing is in flight
+                self.transform_state[partition_key] = (state, time())
+            self.dispatcher.done(partition_key, processor)
+            self.sizer.observe(records, elapsed)
+            if self.admission is not None:
+                self.admission.processed(records)
+
+    def _run_windows(self):
+        """Aggregates the window rule rows of processed batches and sends the events of closed windows, None stops it"""
+        sink = QueueSink(self.sink_queue) if self.sink_queue is not None else HTTPSink(EventDispatcher(spool_path=dead_letter_path("windows")))
+        while True:
+            try:
+                item = self.window_q.get(timeout=self.window_tick)
+            except Empty:
+                # no rows for a while, windows held back by streams that went idle can close
+                events = self.windows.tick()
+                if events:
+                    sink.send_events(events)
+                continue
+            if item is None:
+                events = self.windows.flush()
+            else:
+                try:
+                    events = self.windows.add(*item)
+                except Exception as ex:
+                    logger.warning(f"Window rules of template {item[0]} failed - {ex}")
+                    events = []
+            if events:
+                sink.send_events(events)
+            if item is None:
+                break
+
+    def _run_sizer(self):
+        """Adjusts batch sizes and the processor pool to the load every sizer_interval seconds"""
+        last = time()
+        logged = last
+        while self.run_engine:
+            sleep(self.sizer_interval)
+            now = time()
+            if self.profile_log_interval is not None and now - logged >= self.profile_log_interval:
+                with self.profile_lock:
+                    self.profiler.log_summary()
+                logged = now
+            self.sizer.update(self._queue_depth(), now - last)
+            self._expire_state(now)
+            last = now
+            if self.run_engine:
+                self._reap_processors()
+                if self.scaler is not None:
+                    self._scale_processors(self.sizer.utilization)
 
-                        cur_col -= cur_col
-                        batch_tracker['start_time'] = time()
-                        batch_tracker['leftos_collected'] = True
-                    # leftovers already collected
-                    else:
-                        logger.info("No new data- resetting batch timer")
-                        batch_tracker['start_time'] = time()
+    def status(self):
+        """Batch sizing state, processor queue depth and load, and buffered streams"""
+        status = self.sizer.status()
+        status.update(self.dispatcher.status())
+        status["queue_depth"] = self._queue_depth()
+        status["processors"] = self._active_processors()
+        status["processors_retiring"] = len(self.retiring)
+        status["processors_parked"] = len(self.parked)
+        if self.scaler is not None:
+            status["processor_bounds"] = [self.scaler.minimum, self.scaler.maximum]
+            status["processors_added"] = self.scaler.added
+            status["processors_retired"] = self.scaler.retired
+        status["streams"] = len(self.buffers)
+        if self.admission is not None:
+            status["admission"] = self.admission.status()
+        if self.windows.operators:
+            status["windows"] = self.windows.status()
+        with self.profile_lock:
+            # costliest rules, the whole profile is answered to "engine_profile"
+            status["rule_profile"] = [{"template_id": template_id, "rule": rule, "total_ms": round(total_ms, 3), "share": round(share, 3),
+                                       "mean_ms": round(mean_ms, 3), "runs": count}
+                                      for template_id, rule, total_ms, share, mean_ms, count in self.profiler.summary()]
+        return status
 
     def stop_engine(self):
         self.pipe_conn.close()
@@ -242,14 +602,31 @@ class Engine(Process):
             self.run_engine = False
         for p in self.data_pullers.keys():
             self.data_pullers[p].pulling = False
-        logger.info(self.buffers_out_q.qsize())
-        self.buffers_out_q.join()
-        logger.info("Queue joined")
-        for p in self.processors:
-            logger.info("Putting poison pills in Q")
-            self.buffers_out_q.put("666_kIlL_thE_pROCess_666")
-        logger.info("Poison pills done")
-        for p in self.processors:
-            p.join()
-            logger.info("Engine shutdown- processor joined")
+        if self.admission is not None:
+            self.admission.close()
+        if self.intake_thread is not None:
+            self.intake_q.put(None)
+            self.intake_thread.join()
+        logger.info(self._queue_depth())
+        # no processors are added or retired from here on
+        with self.pool_lock:
+            processor_qs = list(self.processor_qs)
+            processors = list(self.processors)
+            for q in processor_qs:
+                q.join()
+            logger.info("Queues joined")
+            for q in processor_qs:
+                logger.info("Putting poison pills in Q")
+                q.put("666_kIlL_thE_pROCess_666")
+            logger.info("Poison pills done")
+            for p in processors:
+                p.join()
+                logger.info("Engine shutdown- processor joined")
+        self.batch_stats_q.put(None)
+        self.stats_thread.join()
+        # processors are done, open windows are closed with what they have
+        self.window_q.put(None)
+        self.windows_thread.join()
+        if self.slab is not None:
+            self.slab.unlink()
         print("done")
\ No newline at end of file
@@ -1,8 +1,16 @@
 import json
 import os
 from multiprocessing import Process
+from queue import Empty
+from time import time
 from strom.coordinator.coordinator import Coordinator
+from strom.coordinator.sink import EventDispatcher, HTTPSink, QueueSink, dead_letter_path
+from strom.dstream.bstream import BStream
+from strom.dstream.transform_plan import PlanCache
+from strom.dstream.transform_state import TransformState
+from .buffer import batch_records
 from strom.utils.logger.logger import logger
+from strom.utils.profiler import RuleProfiler
 
 
 __version__ = "0.1"
@@ -14,18 +22,44 @@ class Processor(Process):
     Based off `multiprocessing.Process`
     Instantiated by `EngineThread`
 
-    Process is started to aggregate + transform data.
+    Process is started to aggregate + transform data. Each processor has its own queue, the batches
+    of a stream all come through one processor queue in order.
     """
 
-    def __init__(self, queue, engine_test_mode):
+    def __init__(self, queue, engine_test_mode, slab=None, stats_queue=None, processor_id=0, sink_queue=None, plan_cache_size=64, window_queue=None, profile_interval=1):
         """
         Initializes Processor with queue from EngineThread.
-        :param queue: Queue instance where data will come from.
+        :param queue: Queue instance where data will come from, owned by this processor.
         :type queue: Queue object
+        :param slab: shared memory slab batch columns are packed in, None if batches are pickled
+        :type slab: SharedSlab
+        :param stats_queue: queue (processor_id, stream_token, records, seconds, transform state, rule profile) of
+        every processed batch is reported on, for stream dispatch, batch sizing, moving streams and profiling.
+        The transform state is None unless the batch asked for it with "export_state". Profiles observed
+        since the last batch report are sent on their own as (processor_id, None, 0, 0.0, None, rule profile)
+        when the processor idles for profile_interval or stops
+        :type stats_queue: Queue object
+        :param processor_id: index of processor in engine
+        :type processor_id: int
+        :param sink_queue: queue to the server process for events and measures, None to post them over HTTP
+        :type sink_queue: Queue object
+        :param plan_cache_size: compiled template transform plans kept by this processor
+        :type plan_cache_size: int
+        :param window_queue: queue to the engine for the window rule rows of processed batches
+        :type window_queue: Queue object
+        :param profile_interval: least seconds between two rule profiles sent with the batch stats
+        :type profile_interval: float
         """
         super().__init__()
         self.daemon = True
         self.q = queue
+        self.slab = slab
+        self.stats_q = stats_queue
+        self.processor_id = processor_id
+        self.sink_q = sink_queue
+        self.plan_cache_size = plan_cache_size
+        self.window_q = window_queue
+        self.profile_interval = profile_interval
         self.is_running = None
         self.test_run = engine_test_mode
 
@@ -40,27 +74,79 @@ class Processor(Process):
         test_output.write(data)
         test_output.close()
 
+    def _send_profile(self, profiler):
+        """Sends the rule profile observed since the last export without a batch, if there is any"""
+        profile = profiler.export()
+        if profile is not None and self.stats_q is not None:
+            self.stats_q.put((self.processor_id, None, 0, 0.0, None, profile))
+
     def run(self):
         """
-        Retrieves list of dstreams with queue, runs process to aggregate + transform dstreams.
+        Retrieves batches of buffer columns with queue, runs process to aggregate + transform dstreams.
         Poison Pill: if item pulled from queue is string, "666_kIlL_thE_pROCess_666",
         while loop will break. Do this intentionally.
+        ("drop_state", stream_token) drops the transform state of a stream that moved to another processor.
         """
-        coordinator = Coordinator()
+        # plans are compiled in this process and stay warm, streams stick to their processor
+        plans = PlanCache(BStream.select_transform, self.plan_cache_size, BStream.select_stream_transform)
+        state = TransformState()
+        profiler = RuleProfiler()
+        profiled = time()
+        if self.sink_q is not None:
+            sink = QueueSink(self.sink_q)
+        else:
+            # the spool is named by processor, a restarted engine replays what its processors left
+            sink = HTTPSink(EventDispatcher(spool_path=dead_letter_path(f"processor{self.processor_id}")))
+        coordinator = Coordinator(sink, plans, state, self.window_q, profiler)
         self.is_running = True
         while self.is_running:
-            queued = self.q.get()
+            try:
+                queued = self.q.get(timeout=self.profile_interval)
+            except Empty:
+                # idle, what was observed since the last batch report is not held back
+                self._send_profile(profiler)
+                profiled = time()
+                continue
             if type(queued) is str:
                 if queued == "666_kIlL_thE_pROCess_666":
                     # self.is_running = False
+                    self._send_profile(profiler)
                     break
+            elif type(queued) is tuple and queued[0] == "drop_state":
+                # the stream moved to another processor with its state
+                state.drop(queued[1])
             else:
 
-                if self.test_run:
-                    data = queued[0].tolist()
-                    self._write_test_data(f"{json.dumps(data)}\n", outfile=queued[1])
-                else:
-                    data = queued.tolist()
-                    coordinator.process_data(data, data[0]["stream_token"])
+                start = time()
+                try:
+                    if queued.get("transform_state") is not None:
+                        # stream moved here from another processor
+                        state.load(queued["stream_token"], queued["transform_state"])
+                    columns = queued["columns"]
+                    if queued["slot"] is not None:
+                        columns = self.slab.unpack(queued["slot"], columns)
+                    if self.test_run:
+                        data = batch_records(columns, queued["template"])
+                        self._write_test_data(f"{json.dumps(data)}\n", outfile=queued["outfile"])
+                    elif "records" in columns:
+                        data = columns["records"].tolist()
+                        coordinator.process_data(data, queued["stream_token"], overlap=queued["overlap"])
+                    else:
+                        coordinator.process_data(columns, queued["stream_token"], queued["template"], queued["overlap"])
+                except Exception:
+                    # one bad batch must not take the processor down, its streams stay pinned to this queue
+                    logger.exception(f"Processor {self.processor_id} failed to process a batch of stream {queued.get('stream_token')}")
+                finally:
+                    # columns are views on the slot, only free it once the batch is processed
+                    if queued["slot"] is not None:
+                        self.slab.release(queued["slot"])
+                    if self.stats_q is not None:
+                        # rule profile observed since the last one sent, at most every profile_interval
+                        profile = None
+                        if time() - profiled >= self.profile_interval:
+                            profile, profiled = profiler.export(), time()
+                        # state only goes back when the stream is about to move
+                        exported = state.export(queued["stream_token"]) if queued.get("export_state") else None
+                        self.stats_q.put((self.processor_id, queued["stream_token"], queued["records"], time() - start, exported, profile))
 
             self.q.task_done()
\ No newline at end of file
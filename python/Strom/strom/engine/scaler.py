@@ -0,0 +1,98 @@
+"""
+Scaler Module
+
+Decides when the engine adds or retires processors. Processors are added while batches back up or
+the running ones are busy, as long as the machine has CPU to spare, and retired one at a time after
+the pool has been idle for a few checks in a row.
+
+Contains...
+- class ProcessorScaler:
+scaling decisions within min/max processor bounds
+"""
+import os
+
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+def cpu_load():
+    """1 minute load average per CPU, None where the platform has no load average"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+class ProcessorScaler(object):
+    """
+    Processor pool sizing from backlog (batches waiting in processor queues), processor utilization
+    (share of time processors spent on batches) and CPU load.
+    """
+
+    def __init__(self, minimum, maximum, busy=0.8, idle=0.3, max_load=0.9, idle_checks=3, cooldown=2):
+        """
+        :param minimum: least processors to keep running
+        :type minimum: int
+        :param maximum: most processors to run
+        :type maximum: int
+        :param busy: utilization above which a processor is added
+        :type busy: float
+        :param idle: utilization below which the pool counts as idle
+        :type idle: float
+        :param max_load: load average per CPU above which no processor is added
+        :type max_load: float
+        :param idle_checks: consecutive idle checks before a processor is retired
+        :type idle_checks: int
+        :param cooldown: checks to wait after any change
+        :type cooldown: int
+        """
+        if minimum < 1 or minimum > maximum:
+            raise ValueError(f"Invalid processor bounds ({minimum}, {maximum})")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.busy = busy
+        self.idle = idle
+        self.max_load = max_load
+        self.idle_checks = idle_checks
+        self.cooldown = cooldown
+        self.idle_count = 0
+        self.wait = 0
+        self.added = 0
+        self.retired = 0
+
+    def decide(self, active, backlog, utilization, load=None):
+        """
+        :param active: processors currently taking batches
+        :type active: int
+        :param backlog: batches waiting in processor queues
+        :type backlog: int
+        :param utilization: share of time processors were busy since the last check
+        :type utilization: float
+        :param load: load average per CPU, None if unknown
+        :type load: float
+        :return: 1 to add a processor, -1 to retire one, 0 to keep the pool
+        :rtype: int
+        """
+        idle = backlog == 0 and utilization < self.idle
+        self.idle_count = self.idle_count + 1 if idle else 0
+        if self.wait > 0:
+            self.wait -= 1
+            return 0
+        change = 0
+        if active < self.maximum and (backlog > active or utilization > self.busy):
+            if load is None or load < self.max_load:
+                change = 1
+            else:
+                logger.info(f"Processor backlog {backlog} but CPU load {load:.2f} is at its limit, not scaling up")
+        elif active > self.minimum and self.idle_count >= self.idle_checks:
+            change = -1
+        if change:
+            self.wait = self.cooldown
+            self.idle_count = 0
+            if change > 0:
+                self.added += 1
+            else:
+                self.retired += 1
+        return change
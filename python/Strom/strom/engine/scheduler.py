@@ -0,0 +1,197 @@
+"""
+Scheduler Module
+
+Event driven servicing of stream buffers. Instead of a thread per stream polling its queue with a
+timeout, every stream queue notifies one FlushScheduler when data arrives, and a small fixed pool of
+workers drains the streams that have data. Batch timeouts are kept in a heap of flush deadlines
+watched by a single timer thread.
+
+Contains...
+- class StreamQueue:
+input queue of a single stream, wakes the scheduler on put
+- class FlushScheduler:
+deadline heap, ready queue and worker pool
+"""
+import heapq
+from queue import Queue
+from threading import Condition, Lock, Thread
+from time import time
+
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+class StreamQueue(Queue):
+    """
+    Input queue of a single stream, schedules the stream for draining whenever an item is put.
+    With admission control every put is admitted first (which may block, reject or drop the oldest
+    queued items) and queued items are counted against the stream and engine watermarks. Control
+    tuples (ie ("set_template", template)) are queued in order with the records but never admitted,
+    counted or dropped.
+    """
+
+    def __init__(self, partition_key, scheduler, admission=None):
+        super().__init__()
+        self.partition_key = partition_key
+        self.scheduler = scheduler
+        self.admission = admission
+
+    def put(self, item, block=True, timeout=None):
+        self.put_many([item])
+
+    def put_many(self, items):
+        """
+        Puts a list of items with one lock round and one scheduler notification
+        :return: number of items queued, less than len(items) if admission control rejected them
+        :rtype: int
+        """
+        if self.admission is not None and self.admission.admit(self.partition_key, len(items)) == 0:
+            return 0
+        with self.not_full:
+            self._extend(items)
+            self.unfinished_tasks += len(items)
+            self.not_empty.notify()
+            if self.admission is not None:
+                self._drop_oldest(self.admission.enqueued(self.partition_key, len(items)))
+        self.scheduler.notify(self.partition_key)
+        return len(items)
+
+    def put_control(self, item):
+        """Queues a control tuple behind the records already queued, without admission"""
+        with self.not_full:
+            self.queue.append(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        self.scheduler.notify(self.partition_key)
+
+    def _drop_oldest(self, count):
+        """Drops `count` oldest records, control tuples stay queued, must hold not_full"""
+        dropped = 0
+        controls = []
+        while dropped < count and self.queue:
+            item = self.queue.popleft()
+            if type(item) is tuple:
+                controls.append(item)
+                continue
+            dropped += 1
+            self.unfinished_tasks -= 1
+        self.queue.extendleft(reversed(controls))
+        if dropped > 0:
+            logger.warning(f"Dropped {dropped} oldest records of stream {self.partition_key}")
+            self.admission.dequeued(self.partition_key, dropped, dropped=True)
+
+    def get_all(self):
+        """Removes and returns all queued items without blocking"""
+        with self.not_empty:
+            items = list(self.queue)
+            self.queue.clear()
+            if items:
+                self.not_full.notify_all()
+        records = sum(1 for item in items if type(item) is not tuple)
+        if records and self.admission is not None:
+            self.admission.dequeued(self.partition_key, records)
+        return items
+
+    def _extend(self, items):
+        self.queue.extend(items)
+
+
+class FlushScheduler(object):
+    """
+    Services stream buffers with a fixed pool of workers.
+
+    A stream is handed to at most one worker at a time, so per stream buffer state needs no locking.
+    The worker calls service(partition_key) which drains the stream queue and flushes the batch if
+    its deadline passed, and returns the next flush deadline for the stream (or None).
+    """
+
+    def __init__(self, service, pending, workers=4):
+        """
+        :param service: callback run by workers, service(partition_key) -> deadline or None
+        :type service: callable
+        :param pending: callback, pending(partition_key) -> True if stream has queued items
+        :type pending: callable
+        :param workers: number of worker threads
+        :type workers: int
+        """
+        self.service = service
+        self.pending = pending
+        self.number_of_workers = workers
+        self.ready = Queue()
+        self.lock = Lock()
+        self.scheduled = set()
+        self.deadlines = []
+        self.deadline_for = {}
+        self.timer_cond = Condition()
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [Thread(target=self._run_timer, name="flush-timer")]
+        self.threads += [Thread(target=self._run_worker, name=f"flush-worker-{n}") for n in range(self.number_of_workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        """Stops the workers and the timer, waits for a worker still servicing a stream to finish it"""
+        self.running = False
+        for _ in range(self.number_of_workers):
+            self.ready.put(None)
+        with self.timer_cond:
+            self.timer_cond.notify()
+        for t in self.threads:
+            t.join()
+
+    def notify(self, partition_key):
+        """Marks stream as ready, queues it for a worker unless it is already queued or being serviced"""
+        with self.lock:
+            if partition_key in self.scheduled:
+                return
+            self.scheduled.add(partition_key)
+        self.ready.put(partition_key)
+
+    def schedule(self, partition_key, deadline):
+        """Sets the flush deadline of a stream, None clears it"""
+        with self.timer_cond:
+            if self.deadline_for.get(partition_key) == deadline:
+                return
+            self.deadline_for[partition_key] = deadline
+            if deadline is not None:
+                heapq.heappush(self.deadlines, (deadline, partition_key))
+                if self.deadlines[0][0] == deadline:
+                    self.timer_cond.notify()
+
+    def _run_timer(self):
+        with self.timer_cond:
+            while self.running:
+                now = time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    deadline, partition_key = heapq.heappop(self.deadlines)
+                    # skip stale entries, deadline was moved or cleared since it was pushed
+                    if self.deadline_for.get(partition_key) == deadline:
+                        self.notify(partition_key)
+                timeout = self.deadlines[0][0] - now if self.deadlines else None
+                self.timer_cond.wait(timeout)
+
+    def _run_worker(self):
+        while self.running:
+            partition_key = self.ready.get()
+            if partition_key is None:
+                break
+            try:
+                deadline = self.service(partition_key)
+                self.schedule(partition_key, deadline)
+            except Exception as ex:
+                logger.warning(f"Flush worker failed on stream {partition_key} - {ex}")
+                # forget the deadline, the next service of the stream schedules its partial batch again
+                with self.timer_cond:
+                    self.deadline_for.pop(partition_key, None)
+            with self.lock:
+                self.scheduled.discard(partition_key)
+            # data arrived while servicing, notify was swallowed, go again
+            if self.pending(partition_key):
+                self.notify(partition_key)
@@ -0,0 +1,141 @@
+"""
+Sizer Module
+
+Adaptive batch sizing for the engine buffers. Every batch has fixed costs (building the DataFrame,
+posting events and data), so under load bigger batches get more records through per unit of work,
+while an idle system is better served by small batches that reach storage sooner.
+
+Contains...
+- class BatchSizer:
+picks batch size (records) and batch timeout (seconds) from processor queue depth and processing time
+"""
+from threading import Lock
+
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class BatchSizer(object):
+    """
+    Controller for the records per batch and seconds per batch of the engine buffers.
+
+    Processors report (records, elapsed seconds) for every batch through `observe`, the engine calls
+    `update` periodically with the processor queue depth. Batches grow multiplicatively while
+    processors are busy or batches are waiting, and shrink gradually once processors are mostly idle
+    and the queue is empty. Without bounds (or with equal bounds) the sizes are fixed.
+    """
+
+    def __init__(self, batch, seconds, batch_bounds=None, seconds_bounds=None, processors=1, grow=2.0, shrink=0.75, busy=0.8, idle=0.3, smoothing=0.3):
+        """
+        :param batch: starting records per batch
+        :type batch: int
+        :param seconds: starting max seconds before a partial batch is pushed
+        :type seconds: float
+        :param batch_bounds: (min, max) records per batch, None to keep batch fixed
+        :type batch_bounds: tuple
+        :param seconds_bounds: (min, max) seconds per batch, None to keep seconds fixed
+        :type seconds_bounds: tuple
+        :param processors: number of processors sharing the queue
+        :type processors: int
+        :param grow: factor sizes are multiplied by under load
+        :type grow: float
+        :param shrink: factor sizes are multiplied by when idle
+        :type shrink: float
+        :param busy: processor utilization above which batches grow
+        :type busy: float
+        :param idle: processor utilization below which batches shrink
+        :type idle: float
+        :param smoothing: weight of the newest sample in the moving averages
+        :type smoothing: float
+        """
+        self.min_batch, self.max_batch = [int(b) for b in (batch_bounds or (batch, batch))]
+        self.min_seconds, self.max_seconds = [float(s) for s in (seconds_bounds or (seconds, seconds))]
+        if self.min_batch < 1 or self.min_batch > self.max_batch or self.min_seconds > self.max_seconds:
+            raise ValueError(f"Invalid batch bounds {batch_bounds} or seconds bounds {seconds_bounds}")
+        self.batch = _clamp(int(batch), self.min_batch, self.max_batch)
+        self.seconds = _clamp(float(seconds), self.min_seconds, self.max_seconds)
+        self.processors = processors
+        self.grow = grow
+        self.shrink = shrink
+        self.busy = busy
+        self.idle = idle
+        self.smoothing = smoothing
+        self.batch_time = None
+        self.record_time = None
+        self.utilization = 0.0
+        self.batches = 0
+        self.busy_time = 0.0
+        self.lock = Lock()
+
+    @property
+    def adaptive(self):
+        return self.min_batch < self.max_batch or self.min_seconds < self.max_seconds
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.smoothing * (sample - average)
+
+    def observe(self, records, elapsed):
+        """
+        Records the processing time of one batch
+        :param records: number of records in batch
+        :type records: int
+        :param elapsed: seconds the processor spent on the batch
+        :type elapsed: float
+        """
+        with self.lock:
+            self.batches += 1
+            self.busy_time += elapsed
+            self.batch_time = self._average(self.batch_time, elapsed)
+            if records > 0:
+                self.record_time = self._average(self.record_time, elapsed / records)
+
+    def update(self, queue_depth, interval):
+        """
+        Adjusts batch size and seconds from the load seen since the last update
+        :param queue_depth: batches waiting for a processor
+        :type queue_depth: int
+        :param interval: seconds since the last update
+        :type interval: float
+        :return: True if the sizes changed
+        :rtype: bool
+        """
+        with self.lock:
+            self.utilization = self.busy_time / (interval * self.processors) if interval > 0 else 0.0
+            self.busy_time = 0.0
+            if not self.adaptive:
+                return False
+            batch, seconds = self.batch, self.seconds
+            if queue_depth > self.processors or self.utilization > self.busy:
+                batch = _clamp(int(batch * self.grow), self.min_batch, self.max_batch)
+                seconds = _clamp(seconds * self.grow, self.min_seconds, self.max_seconds)
+            elif queue_depth == 0 and self.utilization < self.idle:
+                batch = _clamp(int(batch * self.shrink), self.min_batch, self.max_batch)
+                seconds = _clamp(seconds * self.shrink, self.min_seconds, self.max_seconds)
+            changed = (batch, seconds) != (self.batch, self.seconds)
+            if changed:
+                logger.info(f"Batch size {self.batch} -> {batch} records, {self.seconds:.3f} -> {seconds:.3f} s (queue {queue_depth}, utilization {self.utilization:.2f})")
+                self.batch, self.seconds = batch, seconds
+            return changed
+
+    def status(self):
+        """Current sizes and the measurements they are based on"""
+        with self.lock:
+            return {
+                "batch_size": self.batch,
+                "batch_seconds": self.seconds,
+                "batch_bounds": [self.min_batch, self.max_batch],
+                "seconds_bounds": [self.min_seconds, self.max_seconds],
+                "adaptive": self.adaptive,
+                "batch_time_s": self.batch_time,
+                "record_time_s": self.record_time,
+                "utilization": self.utilization,
+                "batches": self.batches,
+            }
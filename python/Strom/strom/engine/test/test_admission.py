@@ -0,0 +1,94 @@
+import unittest
+from threading import Thread
+from time import sleep
+
+from strom.engine.admission import AdmissionControl, Watermark
+from strom.engine.scheduler import StreamQueue
+
+
+class DummyScheduler(object):
+    def notify(self, partition_key):
+        pass
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def setUp(self):
+        self.switches = []
+
+    def admission(self, policy):
+        return AdmissionControl(policy, (4, 2), (10, 5), lambda token, over: self.switches.append((token, over)), block_timeout=0.05)
+
+    def test_watermark(self):
+        watermark = Watermark(4, 2)
+        self.assertFalse(watermark.update(3))
+        self.assertTrue(watermark.update(4))
+        self.assertFalse(watermark.update(3))
+        self.assertTrue(watermark.update(2))
+        self.assertTrue(watermark.update(5))
+        self.assertEqual(watermark.crossings, 2)
+        self.assertRaises(ValueError, lambda: Watermark(2, 2))
+
+    def test_reject(self):
+        admission = self.admission("reject")
+        queue = StreamQueue("abc123", DummyScheduler(), admission)
+        self.assertEqual(queue.put_many(list(range(4))), 4)
+        self.assertEqual(self.switches, [("abc123", True)])
+        self.assertEqual(queue.put_many([4, 5]), 0)
+        self.assertEqual(queue.get_all(), list(range(4)))
+        self.assertEqual(self.switches, [("abc123", True), ("abc123", False)])
+        self.assertEqual(queue.put_many([6]), 1)
+        status = admission.status()
+        self.assertEqual((status["rejected"], status["stream_crossings"], status["records"]), (2, 1, 1))
+
+    def test_drop_oldest(self):
+        admission = self.admission("drop_oldest")
+        queue = StreamQueue("abc123", DummyScheduler(), admission)
+        queue.put_many(list(range(3)))
+        queue.put_many(list(range(3, 6)))
+        # crossed at 6, dropped down to the low watermark
+        self.assertEqual(queue.get_all(), [4, 5])
+        self.assertEqual(admission.status()["dropped"], 4)
+        self.assertEqual(admission.status()["records"], 0)
+        # control tuples are not counted and never dropped
+        queue.put_many(list(range(3)))
+        queue.put_control(("set_template", {}))
+        queue.put_many(list(range(3, 6)))
+        self.assertEqual(queue.get_all(), [("set_template", {}), 4, 5])
+        self.assertEqual(admission.status()["records"], 0)
+
+    def test_block(self):
+        admission = self.admission("block")
+        queue = StreamQueue("abc123", DummyScheduler(), admission)
+        queue.put_many(list(range(4)))
+        writer = Thread(target=queue.put, args=(4,))
+        writer.start()
+        sleep(0.2)
+        self.assertTrue(writer.is_alive())
+        self.assertEqual(queue.get_all(), list(range(4)))
+        writer.join(1)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(queue.get_all(), [4])
+        self.assertEqual(admission.status()["blocked"], 1)
+
+    def test_global(self):
+        admission = self.admission("reject")
+        queues = [StreamQueue(token, DummyScheduler(), admission) for token in ["abc123", "abc1234", "abc12345"]]
+        for q in queues:
+            q.put_many(list(range(3)))
+        admission.dispatched(1)
+        self.assertIn((None, True), self.switches)
+        self.assertTrue(admission.overloaded("abc123"))
+        self.assertEqual(queues[0].put_many([3]), 0)
+        queues[0].get_all()
+        admission.processed(1)
+        self.assertNotIn((None, False), self.switches)
+        queues[1].get_all()
+        self.assertIn((None, False), self.switches)
+        self.assertEqual(admission.status()["global_crossings"], 1)
+
+    def test_policy(self):
+        self.assertRaises(ValueError, lambda: AdmissionControl("drop_newest", (4, 2), (10, 5)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import json
+import unittest
+
+import numpy as np
+
+from strom.engine.buffer import ColumnarBuffer, batch_records, buffer_schema
+
+demo_data_dir = "demo_data/"
+
+
+class TestColumnarBuffer(unittest.TestCase):
+    def setUp(self):
+        self.dstreams = json.load(open(demo_data_dir + "demo_trip26.txt"))[:8]
+        self.buffer = ColumnarBuffer(self.dstreams[0], 8)
+        self.generic = ColumnarBuffer({"stream_token": "abc123", "message": "hi1"}, 8)
+
+    def test_schema(self):
+        schema = buffer_schema(self.dstreams[0])
+        self.assertIn(("timestamp", None, np.float64), schema)
+        self.assertIn(("measures", "location", object), schema)
+        self.assertIn(("user_ids", "driver-id", object), schema)
+        self.assertEqual(buffer_schema({"stream_token": "abc123"}), [("records", None, object)])
+
+    def test_write_batch(self):
+        for dstream in self.dstreams[:4]:
+            self.buffer.write(dstream)
+        batch = self.buffer.batch()
+        self.assertEqual(batch["timestamp"].dtype, np.float64)
+        self.assertEqual(batch["timestamp"].tolist(), [d["timestamp"] for d in self.dstreams[:4]])
+        self.assertEqual(batch["measures"]["location"].tolist(), [d["measures"]["location"]["val"] for d in self.dstreams[:4]])
+        self.assertEqual(batch["user_ids"]["id"].tolist(), [26] * 4)
+        records = batch_records(batch)
+        self.assertEqual(records[1]["measures"]["location"]["val"], self.dstreams[1]["measures"]["location"]["val"])
+        self.assertEqual(records[1]["tags"], self.dstreams[1]["tags"])
+        # with the stream's template the records get back the keys the buffer does not hold
+        for record, dstream in zip(batch_records(batch, self.buffer.template), self.dstreams[:4]):
+            self.assertEqual(list(record), list(self.dstreams[0]))
+            self.assertEqual({key: value for key, value in record.items() if key in dstream}, dstream)
+
+    def test_write_many(self):
+        self.buffer.write_many(self.dstreams[:3])
+        batch = self.buffer.batch()
+        self.assertEqual(self.buffer.batch_len, 3)
+        self.assertEqual(batch["timestamp"].tolist(), [d["timestamp"] for d in self.dstreams[:3]])
+        self.assertEqual(batch["measures"]["location"].tolist(), [d["measures"]["location"]["val"] for d in self.dstreams[:3]])
+
+    def test_overlap(self):
+        self.buffer.write_many(self.dstreams[:4])
+        self.buffer.next_batch(2)
+        self.assertEqual((self.buffer.overlap, self.buffer.new_records, self.buffer.batch_len), (2, 0, 2))
+        self.buffer.write_many(self.dstreams[4:6])
+        batch = self.buffer.batch(copy=False)
+        self.assertEqual(batch["timestamp"].tolist(), [d["timestamp"] for d in self.dstreams[2:6]])
+        # overlap is shared with the previous batch, not copied
+        self.assertTrue(np.shares_memory(batch["timestamp"], self.buffer.columns[("timestamp", None)]))
+        self.buffer.next_batch()
+        self.assertEqual(self.buffer.batch_len, 0)
+
+    def test_wrap(self):
+        self.buffer.write_many(self.dstreams[:6])
+        self.buffer.next_batch(2)
+        # batch of ring records 4-7 and 0-1 spans the end of the ring
+        self.buffer.write_many(self.dstreams[2:6])
+        self.assertEqual(self.buffer.head, 10)
+        batch = self.buffer.batch(copy=False)
+        self.assertEqual(batch["timestamp"].tolist(), [d["timestamp"] for d in self.dstreams[4:6] + self.dstreams[2:6]])
+        self.assertEqual(batch["measures"]["location"][-1], self.dstreams[5]["measures"]["location"]["val"])
+
+    def test_grow(self):
+        buffer = ColumnarBuffer({"measures": {"speed": {"val": None, "dtype": "float"}}}, 1000)
+        self.assertEqual(buffer.capacity, 64)
+        records = [{"timestamp": float(n), "measures": {"speed": {"val": float(n)}}} for n in range(600)]
+        buffer.write_many(records[:60])
+        buffer.next_batch(10)
+        # the batch with its overlap outgrows the ring, it doubles with the records kept in order
+        buffer.write_many(records[60:100])
+        buffer.write(records[100])
+        self.assertEqual(buffer.capacity, 64)
+        buffer.write_many(records[101:160])
+        self.assertEqual(buffer.capacity, 128)
+        self.assertEqual(buffer.batch()["measures"]["speed"].tolist(), [float(n) for n in range(50, 160)])
+        buffer.next_batch()
+        buffer.write_many(records)
+        buffer.write_many(records)
+        # never past the max capacity
+        self.assertEqual(buffer.capacity, 1000)
+        self.assertEqual(buffer.batch()["timestamp"][-1], 599.0)
+
+    def test_set_template(self):
+        buffer = ColumnarBuffer({"measures": {"speed": {"val": None, "dtype": "float"}}}, 8)
+        buffer.write({"timestamp": 1.0, "measures": {"speed": {"val": 3.0}}})
+        buffer.next_batch(1)
+        # same layout, the overlap stays
+        buffer.set_template({"version": 2, "measures": {"speed": {"val": None, "dtype": "float"}}})
+        self.assertEqual((buffer.template["version"], buffer.batch_len), (2, 1))
+        # a new measure and a retyped one rebuild the columns
+        template = {"measures": {"speed": {"val": None, "dtype": "varchar(10)"}, "heading": {"val": None, "dtype": "int"}}}
+        self.assertTrue(buffer.schema_changed(template))
+        buffer.set_template(template)
+        self.assertEqual(buffer.batch_len, 0)
+        buffer.write({"timestamp": 2.0, "measures": {"speed": {"val": "fast"}, "heading": {"val": 90}}})
+        batch = buffer.batch()
+        self.assertEqual(batch["measures"]["speed"].tolist(), ["fast"])
+        self.assertEqual(batch["measures"]["heading"].dtype, np.int64)
+
+    def test_promote(self):
+        buffer = ColumnarBuffer({"measures": {"speed": {"val": None, "dtype": "int"}}}, 2)
+        buffer.write({"timestamp": 1, "measures": {"speed": {"val": 3}}})
+        buffer.write({"timestamp": None, "measures": {"speed": {"val": "fast"}}})
+        batch = buffer.batch()
+        self.assertTrue(np.isnan(batch["timestamp"][1]))
+        self.assertEqual(batch["measures"]["speed"].tolist(), [3, "fast"])
+
+    def test_generic(self):
+        records = [{"stream_token": "abc123", "message": "hi{}".format(i)} for i in range(3)]
+        for record in records:
+            self.generic.write(record)
+        self.assertEqual(batch_records(self.generic.batch()), records)
+
+
+if __name__ == "__main__":
+    unittest.main()
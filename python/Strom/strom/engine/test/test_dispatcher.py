@@ -0,0 +1,97 @@
+import unittest
+from queue import Queue
+
+from strom.engine.dispatcher import StreamDispatcher
+
+
+class TestStreamDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.queues = [Queue() for _ in range(3)]
+        self.dispatcher = StreamDispatcher(self.queues)
+
+    def test_ordering(self):
+        home = self.dispatcher.home("abc123")
+        for n in range(5):
+            self.assertEqual(self.dispatcher.dispatch("abc123", n), home)
+        self.assertEqual(list(self.queues[home].queue), list(range(5)))
+        self.assertEqual(self.dispatcher.load[home], 5)
+
+    def test_no_steal_in_flight(self):
+        owner = self.dispatcher.assign("abc123")
+        # owner is busy, others idle, stream still stays while a batch is in flight
+        self.dispatcher.load[owner] += 10
+        self.assertEqual(self.dispatcher.assign("abc123"), owner)
+        self.assertEqual(self.dispatcher.steals, 0)
+
+    def test_steal_at_boundary(self):
+        owner = self.dispatcher.assign("abc123")
+        self.dispatcher.done("abc123", owner)
+        self.dispatcher.load[owner] += 2
+        moved = self.dispatcher.assign("abc123")
+        self.assertNotEqual(moved, owner)
+        self.assertEqual(self.dispatcher.steals, 1)
+        self.assertEqual(self.dispatcher.status()["streams_in_flight"], 1)
+
+    def test_moved(self):
+        moved = []
+        owner = self.dispatcher.dispatch("abc123", {"n": 1}, lambda batch, previous: moved.append((batch, previous)))
+        self.dispatcher.done("abc123", owner)
+        self.dispatcher.load[owner] += 2
+        # the owner first hands back the state of the stream
+        self.assertEqual(self.dispatcher.dispatch("abc123", {"n": 2}, lambda batch, previous: moved.append((batch, previous))), owner)
+        self.assertEqual(self.queues[owner].queue[-1], {"n": 2, "export_state": True})
+        # batches before the next boundary stay and export too
+        self.assertEqual(self.dispatcher.dispatch("abc123", {"n": 3}, lambda batch, previous: moved.append((batch, previous))), owner)
+        self.assertTrue(self.queues[owner].queue[-1]["export_state"])
+        self.dispatcher.done("abc123", owner)
+        self.dispatcher.done("abc123", owner)
+        self.assertNotEqual(self.dispatcher.dispatch("abc123", {"n": 4}, lambda batch, previous: moved.append((batch, previous))), owner)
+        self.assertEqual(moved, [({"n": 4}, owner)])
+        self.assertEqual(self.dispatcher.steals, 1)
+        self.assertEqual(self.dispatcher.moving, set())
+
+    def test_move_cancelled(self):
+        owner = self.dispatcher.dispatch("abc123", {"n": 1}, lambda batch, previous: None)
+        self.dispatcher.done("abc123", owner)
+        self.dispatcher.load[owner] += 2
+        self.dispatcher.dispatch("abc123", {"n": 2}, lambda batch, previous: None)
+        self.dispatcher.done("abc123", owner)
+        # the others got busier meanwhile, the stream stays
+        self.dispatcher.load = [5, 5, 5]
+        self.dispatcher.load[owner] = 2
+        self.assertEqual(self.dispatcher.dispatch("abc123", {"n": 3}, lambda batch, previous: None), owner)
+        self.assertNotIn("export_state", self.queues[owner].queue[-1])
+        self.assertEqual(self.dispatcher.moving, set())
+
+    def test_done(self):
+        owner = self.dispatcher.assign("abc1234")
+        self.dispatcher.done("abc1234", owner)
+        self.assertEqual(self.dispatcher.load, [0, 0, 0])
+        self.assertEqual(self.dispatcher.in_flight["abc1234"], 0)
+
+    def test_retire(self):
+        owner = self.dispatcher.assign("abc123")
+        self.assertTrue(self.dispatcher.retire(owner))
+        # batch in flight, stream stays on retiring processor and it is not idle yet
+        self.assertEqual(self.dispatcher.assign("abc123"), owner)
+        self.assertFalse(self.dispatcher.idle(owner))
+        self.dispatcher.done("abc123", owner)
+        self.dispatcher.done("abc123", owner)
+        self.assertNotEqual(self.dispatcher.assign("abc123"), owner)
+        self.assertTrue(self.dispatcher.idle(owner))
+
+    def test_activate(self):
+        self.assertTrue(self.dispatcher.retire(1))
+        self.assertTrue(self.dispatcher.idle(1))
+        self.dispatcher.activate(1)
+        self.assertEqual(self.dispatcher.active, {0, 1, 2})
+
+    def test_add(self):
+        self.assertEqual(self.dispatcher.add(Queue()), 3)
+        self.dispatcher.load[:3] = [2, 2, 2]
+        self.assertEqual(self.dispatcher.least_loaded(), 3)
+        self.assertEqual(self.dispatcher.assign("abc123"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
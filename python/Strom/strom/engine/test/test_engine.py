@@ -1,11 +1,14 @@
 import json
 import glob
 import os
+import queue
 import unittest
 from multiprocessing import Pipe
 from time import sleep
 
+from strom.engine.dispatcher import StreamDispatcher
 from strom.engine.engine import Engine
+from strom.engine.transport import SharedSlab
 from strom.dstream.dstream import DStream
 
 demo_data_dir = "demo_data/"
@@ -25,6 +28,11 @@ def remove_outfile(outfile):
     os.remove(outfile)
 
 
+class DummyScheduler(object):
+    def notify(self, partition_key):
+        pass
+
+
 class TestEngineThread(unittest.TestCase):
     def setUp(self):
         self.con1, self.con1b = Pipe()
@@ -210,6 +218,68 @@ class TestEngineThread(unittest.TestCase):
         self.outfiles.extend(outfiles)
         self.con6.send("stop_poison_pill")
 
+    def test_load_batch(self):
+        # whole list in one pipe message
+        con7, con7b = Pipe()
+        engine7 = Engine(con7b, processors=2, buffer_max_batch=4, buffer_max_seconds=5,
+                         test_mode=True, test_outfile='engine_test_output/engine_test7')
+        outfiles = ['engine_test_output/engine_test7_abc123_1.txt', 'engine_test_output/engine_test7_abc123_2.txt']
+        engine7.start()
+        sleep(3)
+        con7.send(("load_batch", "abc123", self.test_batch1 + self.test_batch3))
+        sleep(3)
+        result7 = []
+        for o in outfiles:
+            result7.extend(read_outfile(o))
+
+        self.assertEqual(len(result7), 2)
+        self.assertIn(self.test_batch1, result7)
+        self.assertIn(self.test_batch3, result7)
+
+        self.outfiles.extend(outfiles)
+        con7.send("stop_poison_pill")
+
+    def test_status(self):
+        con8, con8b = Pipe()
+        engine8 = Engine(con8b, processors=2, buffer_max_batch=4, buffer_max_seconds=5, test_mode=True,
+                         test_outfile='engine_test_output/engine_test8', batch_bounds=(4, 40), sizer_interval=0.5)
+        outfiles = ['engine_test_output/engine_test8_abc123_1.txt', 'engine_test_output/engine_test8_abc123_2.txt']
+        engine8.start()
+        sleep(3)
+        con8.send(("load_batch", "abc123", self.test_batch1 + self.test_batch3))
+        sleep(3)
+        con8.send("engine_status")
+        status = con8.recv()
+        self.assertEqual(status["batches"], 2)
+        self.assertEqual(status["batch_bounds"], [4, 40])
+        self.assertEqual(status["processors"], 2)
+        self.assertEqual(status["streams"], 1)
+        # nothing left to do, batches shrink back to the lower bound
+        self.assertEqual(status["batch_size"], 4)
+        self.outfiles.extend(outfiles)
+        con8.send("stop_poison_pill")
+
+    def test_retire_processors(self):
+        con9, con9b = Pipe()
+        engine9 = Engine(con9b, processors=3, buffer_max_batch=4, buffer_max_seconds=5, test_mode=True,
+                         test_outfile='engine_test_output/engine_test9', sizer_interval=0.2, processor_bounds=(1, 3))
+        outfiles = ['engine_test_output/engine_test9_abc123_1.txt', 'engine_test_output/engine_test9_abc123_2.txt']
+        engine9.start()
+        # idle engine retires processors down to the minimum
+        sleep(5)
+        con9.send("engine_status")
+        status = con9.recv()
+        self.assertEqual(status["processors"], 1)
+        self.assertEqual(status["processors_retired"], 2)
+        con9.send(("load_batch", "abc123", self.test_batch1 + self.test_batch3))
+        sleep(3)
+        result9 = []
+        for o in outfiles:
+            result9.extend(read_outfile(o))
+        self.assertEqual(result9, [self.test_batch1, self.test_batch3])
+        self.outfiles.extend(outfiles)
+        con9.send("stop_poison_pill")
+
     def test_new_with_puller(self):
         self.abalone_engine.start()
         sleep(3)
@@ -228,3 +298,110 @@ class TestEngineThread(unittest.TestCase):
 
 
 
+
+    def test_queue_batch_slots(self):
+        con, conb = Pipe()
+        engine = Engine(conb, processors=1, buffer_max_batch=4, buffer_max_seconds=5)
+        engine.slab = SharedSlab(1, 4096)
+        engine.slab_timeout = 0.1
+        engine.dispatcher = StreamDispatcher([queue.Queue()])
+        template = {"measures": {"speed": {"val": None, "dtype": "float"}}}
+        engine._new_buffer("abc123", template)
+        engine.buffers["abc123"].write_many([{"timestamp": t, "measures": {"speed": {"val": 1.0}}} for t in range(4)])
+        try:
+            engine._queue_batch("abc123")
+            # no free slot, the batch goes pickled
+            engine._queue_batch("abc123")
+            batches = [engine.dispatcher.queues[0].get() for _ in range(2)]
+            self.assertEqual([batch["slot"] for batch in batches], [0, None])
+            self.assertEqual(batches[1]["columns"]["measures"]["speed"].tolist(), [1.0] * 4)
+            engine.slab.release(0)
+            # a batch that fails to dispatch gives its slot back
+            engine.dispatcher.dispatch = lambda *args: 1 / 0
+            self.assertRaises(ZeroDivisionError, engine._queue_batch, "abc123")
+            self.assertEqual(engine.slab.acquire(timeout=1), 0)
+        finally:
+            engine.slab.unlink()
+
+    def test_template_change(self):
+        con, conb = Pipe()
+        engine = Engine(conb, processors=1, buffer_max_batch=4, buffer_max_seconds=5)
+        engine.run_engine = True
+        engine.scheduler = DummyScheduler()
+        engine.dispatcher = StreamDispatcher([queue.Queue()])
+        template = {"stream_token": "abc123", "measures": {"speed": {"val": None, "dtype": "float"}}}
+        engine._new_buffer("abc123", template)
+        engine._load("abc123", [{"stream_token": "abc123", "timestamp": t, "measures": {"speed": {"val": 1.0}}} for t in range(2)])
+        new_template = {"stream_token": "abc123", "measures": {"speed": {"val": None, "dtype": "float"}, "heading": {"val": None, "dtype": "int"}}}
+        engine._set_template("abc123", new_template)
+        engine._load("abc123", [{"stream_token": "abc123", "timestamp": 2, "measures": {"speed": {"val": 2.0}, "heading": {"val": 90}}}])
+        engine.service_buffer("abc123")
+        # the records loaded before the new version go out as a partial batch with the old template
+        batch = engine.dispatcher.queues[0].get_nowait()
+        self.assertIs(batch["template"], template)
+        self.assertEqual(list(batch["columns"]["measures"]), ["speed"])
+        buffer = engine.buffers["abc123"]
+        self.assertIs(buffer.template, new_template)
+        self.assertEqual(buffer.batch()["measures"]["heading"].tolist(), [90])
+
+    def test_admission_load(self):
+        con, conb = Pipe()
+        engine = Engine(conb, processors=1, admission_policy="reject", stream_watermarks=(2, 1))
+        engine.scheduler = DummyScheduler()
+        engine._new_buffer("abc123", self.test_batch1[0])
+        self.assertEqual(engine._load("abc123", self.test_batch1), 4)
+        # over the watermark, the engine tells how many it refused
+        self.assertEqual(engine._load("abc123", self.test_batch3), 0)
+        # one message for several streams, answered with the rejected records of each rejected stream
+        self.assertEqual(engine._load_streams({"abc123": self.test_batch3, "abc1234": self.test_batch2[:2]}), {"abc123": 4})
+        self.assertEqual(engine.buffer_in_qs["abc1234"].get_all(), self.test_batch2[:2])
+        # under the block policy the pipe thread hands records on without waiting
+        engine = Engine(conb, processors=1, admission_policy="block", stream_watermarks=(2, 1))
+        engine.scheduler = DummyScheduler()
+        engine._new_buffer("abc123", self.test_batch1[0])
+        engine._start_intake()
+        self.assertEqual(engine._load("abc123", self.test_batch1), 4)
+        self.assertEqual(engine._load("abc123", self.test_batch3), 4)
+        sleep(0.5)
+        self.assertEqual(engine.buffer_in_qs["abc123"].get_all(), self.test_batch1)
+        sleep(0.5)
+        self.assertEqual(engine.buffer_in_qs["abc123"].get_all(), self.test_batch3)
+        engine.admission.close()
+        engine.intake_q.put(None)
+        engine.intake_thread.join(1)
+        self.assertFalse(engine.intake_thread.is_alive())
+
+    def test_move_state(self):
+        con, conb = Pipe()
+        engine = Engine(conb, processors=1, buffer_max_batch=4, buffer_max_seconds=5)
+        engine.dispatcher = StreamDispatcher([queue.Queue(), queue.Queue()])
+        engine.transform_state["abc123"] = ({"rule": {"tail": [1.0]}}, 100.0)
+        engine.transform_state["abc1234"] = ({"rule": {"tail": [2.0]}}, 100.0)
+        batch = {"stream_token": "abc123"}
+        engine._move_state(batch, 0)
+        # the state goes with the batch, the engine keeps no copy and the previous processor drops its own
+        self.assertEqual(batch["transform_state"], {"rule": {"tail": [1.0]}})
+        self.assertNotIn("abc123", engine.transform_state)
+        self.assertEqual(engine.dispatcher.queues[0].get_nowait(), ("drop_state", "abc123"))
+        engine._expire_state(100.0 + engine.state_ttl + 1)
+        self.assertEqual(engine.transform_state, {})
+
+    def test_parked_processors(self):
+        con, conb = Pipe()
+        engine = Engine(conb, processors=1, buffer_max_batch=4, buffer_max_seconds=5, shared_slots=0, processor_bounds=(1, 2))
+        engine._init_processors()
+        try:
+            # every processor is forked up front, the extra one waits parked
+            self.assertTrue(all(p.is_alive() for p in engine.processors))
+            self.assertEqual((len(engine.processors), engine.parked, engine._active_processors()), (2, [1], 1))
+            engine._add_processor()
+            self.assertEqual((engine.parked, engine._active_processors()), ([], 2))
+            engine._retire_processor()
+            engine._reap_processors()
+            self.assertEqual(len(engine.parked), 1)
+            self.assertEqual(len(engine.processors), 2)
+        finally:
+            for q in engine.processor_qs:
+                q.put("666_kIlL_thE_pROCess_666")
+            for p in engine.processors:
+                p.join()
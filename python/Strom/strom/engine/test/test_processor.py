@@ -0,0 +1,42 @@
+import json
+import queue
+import unittest
+
+import numpy as np
+
+from strom.engine.processor import Processor
+
+
+class TestProcessor(unittest.TestCase):
+    def test_bad_batch(self):
+        batches, stats = queue.Queue(), queue.Queue()
+        processor = Processor(batches, False, stats_queue=stats, sink_queue=queue.Queue())
+        bad = {"stream_token": "abc123", "columns": {"measures": {}}, "template": None, "slot": None, "overlap": 0, "records": 1}
+        batches.put(bad)
+        batches.put(dict(bad))
+        batches.put("666_kIlL_thE_pROCess_666")
+        # run in this process, both batches fail and the loop goes on to the poison pill
+        processor.run()
+        self.assertEqual([stats.get_nowait()[1:3] for _ in range(2)], [("abc123", 1)] * 2)
+        self.assertEqual(batches.unfinished_tasks, 1)
+
+    def test_profile_flush(self):
+        batches, stats = queue.Queue(), queue.Queue()
+        processor = Processor(batches, False, stats_queue=stats, sink_queue=queue.Queue(), profile_interval=60)
+        dstreams = json.load(open("demo_data/demo_trip26.txt"))[:10]
+        template = json.load(open("demo_data/demo_template_unit_test.txt"))
+        # the first dstream of a records batch is its template
+        dstreams[0] = dict(dstreams[0], **{key: template[key] for key in ["filters", "dparam_rules", "event_rules", "storage_rules"]})
+        columns = {"records": np.array(dstreams + [None], dtype=object)[:-1]}
+        batches.put({"stream_token": dstreams[0]["stream_token"], "columns": columns, "template": None, "slot": None, "overlap": 0, "records": 10})
+        batches.put("666_kIlL_thE_pROCess_666")
+        processor.run()
+        self.assertIsNone(stats.get_nowait()[5])
+        # the batch's profile was held back by profile_interval, it goes out before the processor stops
+        processor_id, stream_token, records, elapsed, state, profile = stats.get_nowait()
+        self.assertEqual((stream_token, records), (None, 0))
+        self.assertIn("(batch)", profile[dstreams[0]["template_id"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
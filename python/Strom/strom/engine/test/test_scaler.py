@@ -0,0 +1,42 @@
+import unittest
+
+from strom.engine.scaler import ProcessorScaler, cpu_load
+
+
+class TestProcessorScaler(unittest.TestCase):
+    def setUp(self):
+        self.scaler = ProcessorScaler(1, 4, idle_checks=2, cooldown=1)
+
+    def test_add_on_backlog(self):
+        self.assertEqual(self.scaler.decide(2, 5, 0.5, 0.1), 1)
+        # cooldown
+        self.assertEqual(self.scaler.decide(3, 5, 0.5, 0.1), 0)
+        self.assertEqual(self.scaler.decide(3, 5, 0.5, 0.1), 1)
+        self.assertEqual(self.scaler.added, 2)
+
+    def test_add_on_utilization(self):
+        self.assertEqual(self.scaler.decide(2, 0, 0.95, None), 1)
+
+    def test_max(self):
+        self.assertEqual(self.scaler.decide(4, 50, 1.0, 0.1), 0)
+
+    def test_cpu_limit(self):
+        self.assertEqual(self.scaler.decide(2, 5, 0.5, 1.5), 0)
+
+    def test_retire_when_idle(self):
+        self.assertEqual(self.scaler.decide(3, 0, 0.1, 0.1), 0)
+        self.assertEqual(self.scaler.decide(3, 0, 0.1, 0.1), -1)
+        # cooldown, idle streak restarts after a change
+        self.assertEqual(self.scaler.decide(2, 0, 0.1, 0.1), 0)
+        self.assertEqual(self.scaler.decide(2, 0, 0.1, 0.1), -1)
+        self.assertEqual(self.scaler.decide(1, 0, 0.0, 0.1), 0)
+        self.assertEqual(self.scaler.decide(1, 0, 0.0, 0.1), 0)
+
+    def test_bounds(self):
+        self.assertRaises(ValueError, lambda: ProcessorScaler(3, 2))
+        load = cpu_load()
+        self.assertTrue(load is None or load >= 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
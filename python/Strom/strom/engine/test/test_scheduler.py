@@ -0,0 +1,104 @@
+import unittest
+from queue import Empty
+from threading import Event, Lock
+from time import sleep, time
+
+from strom.engine.scheduler import FlushScheduler, StreamQueue
+
+
+class TestFlushScheduler(unittest.TestCase):
+    def setUp(self):
+        self.drained = {}
+        self.serviced = []
+        self.deadlines = {}
+        self.active = set()
+        self.overlap = Event()
+        self.lock = Lock()
+        self.scheduler = FlushScheduler(self.service, self.pending, workers=3)
+        self.queues = {key: StreamQueue(key, self.scheduler) for key in ["abc123", "abc1234"]}
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def service(self, partition_key):
+        with self.lock:
+            if partition_key in self.active:
+                self.overlap.set()
+            self.active.add(partition_key)
+        sleep(0.01)
+        while True:
+            try:
+                self.drained.setdefault(partition_key, []).append(self.queues[partition_key].get_nowait())
+            except Empty:
+                break
+        self.serviced.append((partition_key, time()))
+        with self.lock:
+            self.active.discard(partition_key)
+        return self.deadlines.pop(partition_key, None)
+
+    def pending(self, partition_key):
+        return not self.queues[partition_key].empty()
+
+    def test_drain(self):
+        for i in range(50):
+            self.queues["abc123"].put(i)
+            self.queues["abc1234"].put(i)
+        sleep(0.5)
+        self.assertEqual(self.drained["abc123"], list(range(50)))
+        self.assertEqual(self.drained["abc1234"], list(range(50)))
+        self.assertFalse(self.overlap.is_set())
+
+    def test_put_many(self):
+        self.queues["abc123"].put_many(list(range(20)))
+        sleep(0.3)
+        self.assertEqual(self.drained["abc123"], list(range(20)))
+        self.assertEqual(self.queues["abc123"].get_all(), [])
+
+    def test_deadline(self):
+        start = time()
+        self.deadlines["abc123"] = start + 0.3
+        self.queues["abc123"].put("hi1")
+        sleep(0.6)
+        times = [t for key, t in self.serviced if key == "abc123"]
+        self.assertEqual(len(times), 2)
+        self.assertGreaterEqual(times[1], start + 0.3)
+
+    def test_cleared_deadline(self):
+        self.scheduler.schedule("abc1234", time() + 0.2)
+        self.scheduler.schedule("abc1234", None)
+        sleep(0.4)
+        self.assertEqual(self.serviced, [])
+
+    def test_failed_service(self):
+        calls = []
+
+        def service(partition_key):
+            calls.append(time())
+            if len(calls) == 2:
+                raise ValueError("bad batch")
+            # the partial batch keeps the deadline it got with the first record
+            return deadline
+
+        deadline = time() + 0.2
+        scheduler = FlushScheduler(service, lambda partition_key: False, workers=1)
+        scheduler.start()
+        scheduler.notify("abc123")
+        sleep(0.4)
+        # the flush on the deadline failed, the same deadline is scheduled again with the next data
+        self.assertNotIn("abc123", scheduler.deadline_for)
+        scheduler.notify("abc123")
+        sleep(0.2)
+        self.assertEqual(len(calls), 4)
+        scheduler.stop()
+
+    def test_stop(self):
+        self.queues["abc123"].put_many(list(range(5)))
+        self.scheduler.stop()
+        # stop returns once no worker is servicing a stream any more
+        self.assertFalse(any(t.is_alive() for t in self.scheduler.threads))
+        self.assertEqual(self.active, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from strom.engine.sizer import BatchSizer
+
+
+class TestBatchSizer(unittest.TestCase):
+    def setUp(self):
+        self.sizer = BatchSizer(10, 1, batch_bounds=(5, 100), seconds_bounds=(0.5, 4), processors=2)
+
+    def test_fixed(self):
+        sizer = BatchSizer(10, 1)
+        self.assertFalse(sizer.adaptive)
+        sizer.observe(10, 5.0)
+        self.assertFalse(sizer.update(10, 1))
+        self.assertEqual((sizer.batch, sizer.seconds), (10, 1))
+
+    def test_grow_on_backlog(self):
+        self.assertTrue(self.sizer.update(3, 1))
+        self.assertEqual((self.sizer.batch, self.sizer.seconds), (20, 2))
+        for _ in range(5):
+            self.sizer.update(3, 1)
+        self.assertEqual((self.sizer.batch, self.sizer.seconds), (100, 4))
+
+    def test_grow_on_utilization(self):
+        self.sizer.observe(10, 0.9)
+        self.sizer.observe(10, 0.9)
+        self.assertTrue(self.sizer.update(0, 1))
+        self.assertEqual(self.sizer.batch, 20)
+        self.assertAlmostEqual(self.sizer.status()["utilization"], 0.9)
+
+    def test_shrink_when_idle(self):
+        self.sizer.observe(10, 0.1)
+        self.assertTrue(self.sizer.update(0, 1))
+        self.assertEqual(self.sizer.batch, 7)
+        for _ in range(5):
+            self.sizer.update(0, 1)
+        self.assertEqual((self.sizer.batch, self.sizer.seconds), (5, 0.5))
+
+    def test_hold(self):
+        self.sizer.observe(10, 1.0)
+        self.assertFalse(self.sizer.update(1, 1))
+        self.assertEqual(self.sizer.batch, 10)
+
+    def test_status(self):
+        self.sizer.observe(10, 0.2)
+        self.sizer.observe(20, 0.4)
+        status = self.sizer.status()
+        self.assertEqual(status["batches"], 2)
+        self.assertEqual(status["batch_bounds"], [5, 100])
+        self.assertAlmostEqual(status["record_time_s"], 0.02)
+
+    def test_bad_bounds(self):
+        self.assertRaises(ValueError, lambda: BatchSizer(10, 1, batch_bounds=(50, 5)))
+
+
+if __name__ == "__main__":
+    unittest.main()
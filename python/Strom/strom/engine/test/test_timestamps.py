@@ -0,0 +1,100 @@
+import os
+import time
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from strom.engine.buffer import ColumnarBuffer
+from strom.engine.timestamps import TimestampParser, timestamp_parser
+
+
+def strptimed(values, date_format):
+    return [datetime.strptime(v, date_format).timestamp() for v in values]
+
+
+class TestTimestampParser(unittest.TestCase):
+    def setUp(self):
+        self.tz = os.environ.get("TZ")
+        os.environ["TZ"] = "America/Los_Angeles"
+        time.tzset()
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = self.tz
+        time.tzset()
+
+    def test_kinds(self):
+        self.assertEqual(TimestampParser("%s").kind, "epoch")
+        self.assertEqual(TimestampParser("%Y-%m-%dT%H:%M:%S").kind, "iso")
+        self.assertEqual(TimestampParser("%Y-%m-%d-%H:%M:%S.%f").kind, "pandas")
+        self.assertIs(timestamp_parser("%Y-%m-%d"), timestamp_parser("%Y-%m-%d"))
+        self.assertIsNone(timestamp_parser(None))
+
+    def test_iso(self):
+        values = ["2017-11-13T12:05:51", "2017-11-13T12:05:52", "2017-11-13T12:06:01"]
+        parsed = timestamp_parser("%Y-%m-%dT%H:%M:%S").parse(np.array(values, dtype=object))
+        self.assertEqual(parsed.tolist(), strptimed(values, "%Y-%m-%dT%H:%M:%S"))
+
+    def test_custom_format(self):
+        date_format = "%Y-%m-%d-%H:%M:%S.%f"
+        values = ["2018-03-02-10:15:01.250000", "2018-03-02-10:15:02.500000"]
+        parsed = timestamp_parser(date_format).parse(np.array(values, dtype=object))
+        np.testing.assert_allclose(parsed, strptimed(values, date_format))
+
+    def test_dst_change(self):
+        values = ["2018-03-11 01:59:00", "2018-03-11 03:01:00"]
+        parsed = timestamp_parser("%Y-%m-%d %H:%M:%S").parse(np.array(values, dtype=object))
+        self.assertEqual(parsed.tolist(), strptimed(values, "%Y-%m-%d %H:%M:%S"))
+        self.assertEqual(parsed[1] - parsed[0], 120)
+
+    def test_unsorted_and_long_batches(self):
+        date_format = "%Y-%m-%d %H:%M:%S"
+        # both ends are summer time, the middle record is not
+        unsorted = ["2018-03-11 03:01:00", "2018-03-10 12:00:00", "2018-03-11 03:30:00"]
+        self.assertEqual(timestamp_parser(date_format).parse(np.array(unsorted, dtype=object)).tolist(), strptimed(unsorted, date_format))
+        # sorted, but spring and fall changes both fall inside
+        year = ["2018-01-10 12:00:00", "2018-06-10 12:00:00", "2018-12-10 12:00:00"]
+        self.assertEqual(timestamp_parser(date_format).parse(np.array(year, dtype=object)).tolist(), strptimed(year, date_format))
+
+    def test_iso_offsets(self):
+        values = ["2017-11-13T12:05:51Z", "2017-11-13T12:05:51+01:00", "2017-11-13T12:05:51"]
+        parsed = timestamp_parser("%Y-%m-%dT%H:%M:%S").parse(np.array(values, dtype=object))
+        # values with an offset are read in their own zone, not as local wall clock time
+        self.assertEqual(parsed.tolist(), [1510574751.0, 1510571151.0, strptimed(values[2:], "%Y-%m-%dT%H:%M:%S")[0]])
+
+    def test_epoch_and_numbers(self):
+        self.assertEqual(timestamp_parser("%s").parse(np.array(["1510603551.5"], dtype=object)).tolist(), [1510603551.5])
+        self.assertEqual(timestamp_parser("%d/%m/%Y").parse(np.array([1.0, 2.0])).tolist(), [1.0, 2.0])
+
+    def test_fallback(self):
+        values = ["13/11/2017", 1510603551.0]
+        parsed = timestamp_parser("%d/%m/%Y").parse(np.array(values, dtype=object))
+        self.assertEqual(parsed.tolist(), [datetime(2017, 11, 13).timestamp(), 1510603551.0])
+
+    def test_malformed(self):
+        values = ["2017-11-13 12:05:51", "not a date", None]
+        parsed = timestamp_parser("%Y-%m-%d %H:%M:%S").parse(np.array(values, dtype=object))
+        self.assertEqual(parsed[0], strptimed(values[:1], "%Y-%m-%d %H:%M:%S")[0])
+        self.assertTrue(np.isnan(parsed[1:]).all())
+        self.assertTrue(np.isnan(timestamp_parser("%s").parse(np.array(["1510603551.5", "x"], dtype=object))[1]))
+        # one bad record doesn't fail the batch of the stream
+        template = {"measures": {"speed": {"val": None, "dtype": "float"}}, "data_rules": {"date_format": "%d/%m/%Y"}}
+        buffer = ColumnarBuffer(template, 2)
+        buffer.write_many([{"timestamp": v, "measures": {"speed": {"val": 1.0}}} for v in ["13/11/2017", "13-11-2017"]])
+        batch = buffer.batch()["timestamp"]
+        self.assertEqual(batch[0], datetime(2017, 11, 13).timestamp())
+        self.assertTrue(np.isnan(batch[1]))
+
+    def test_buffer_batch(self):
+        template = {"measures": {"speed": {"val": None, "dtype": "float"}}, "data_rules": {"date_format": "%Y-%m-%d %H:%M:%S"}}
+        buffer = ColumnarBuffer(template, 2)
+        values = ["2017-11-13 12:05:51", "2017-11-13 12:05:52"]
+        buffer.write_many([{"timestamp": v, "measures": {"speed": {"val": 1.0}}} for v in values])
+        self.assertEqual(buffer.batch()["timestamp"].tolist(), strptimed(values, "%Y-%m-%d %H:%M:%S"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import queue
+import unittest
+
+import numpy as np
+
+from strom.engine.transport import SharedSlab
+
+
+class TestSharedSlab(unittest.TestCase):
+    def setUp(self):
+        self.slab = SharedSlab(2, 256)
+        self.columns = {
+            "timestamp": np.arange(4, dtype=np.float64),
+            "measures": {"speed": np.array([1, 2, 3, 4], dtype=np.int64), "location": np.array([[1, 2]] * 4, dtype=object)},
+            "tags": np.array([{}, {}, {}, {}], dtype=object),
+        }
+
+    def tearDown(self):
+        self.slab.unlink()
+
+    def test_pack_unpack(self):
+        slot = self.slab.acquire()
+        descriptor = self.slab.pack(slot, self.columns)
+        self.assertEqual(descriptor["timestamp"][0], "shm")
+        self.assertEqual(descriptor["measures"]["speed"][0], "shm")
+        self.assertIsInstance(descriptor["measures"]["location"], np.ndarray)
+        unpacked = self.slab.unpack(slot, descriptor)
+        self.assertEqual(unpacked["timestamp"].tolist(), [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(unpacked["measures"]["speed"].tolist(), [1, 2, 3, 4])
+        self.assertEqual(unpacked["tags"].tolist(), [{}, {}, {}, {}])
+        self.slab.release(slot)
+
+    def test_too_big(self):
+        slot = self.slab.acquire()
+        descriptor = self.slab.pack(slot, {"big": np.zeros(64), "small": np.ones(2)})
+        self.assertIsInstance(descriptor["big"], np.ndarray)
+        self.assertEqual(descriptor["small"][0], "shm")
+        self.slab.release(slot)
+
+    def test_backpressure(self):
+        first = self.slab.acquire()
+        second = self.slab.acquire()
+        self.assertNotEqual(first, second)
+        self.assertRaises(queue.Empty, lambda: self.slab.acquire(timeout=0.1))
+        self.slab.release(first)
+        self.assertEqual(self.slab.acquire(timeout=1), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import json
+import unittest
+
+import numpy as np
+
+from strom.engine.window import Partial, WindowAggregator, WindowOperator
+
+
+class TestWindow(unittest.TestCase):
+    def params(self, window, aggregate="count", threshold_value=0, comparison_operator=">", **params):
+        params.update({"window": window, "aggregate": aggregate, "threshold_value": threshold_value,
+                       "comparison_operator": comparison_operator})
+        return params
+
+    @staticmethod
+    def rows(timestamps, keys, values=None):
+        timestamps = np.array(timestamps)
+        return timestamps, np.array(keys, dtype=object), np.ones(timestamps.shape[0]) if values is None else np.array(values, dtype=float)
+
+    def test_partial(self):
+        values = np.array([3.0, np.nan, 1.0, 8.0])
+        for aggregate, expected in [("count", 4), ("sum", 12.0), ("mean", 4.0), ("min", 1.0), ("max", 8.0), ("percentile", 3.0)]:
+            first, second = Partial(aggregate), Partial(aggregate)
+            first.add(values[:2])
+            second.add(values[2:])
+            first.merge(second)
+            self.assertEqual(first.result(), expected, aggregate)
+        self.assertTrue(np.isnan(Partial("max").result()))
+        distinct = Partial("distinct")
+        distinct.add(np.array(["car1", "car2", "car1"], dtype=object))
+        self.assertEqual(distinct.result(), 2)
+
+    def test_tumbling(self):
+        operator = WindowOperator("fleet", "busy", self.params({"type": "tumbling", "size": 10}, "distinct", 2, measure="id"))
+        events = operator.add(*self.rows([1, 2, 5, 11], ["fleet"] * 4, [1, 2, 3, 1]))
+        self.assertEqual([e["data"]["window_start"] for e in events], [0])
+        self.assertEqual(events[0]["data"]["value"], 3)
+        self.assertEqual(events[0]["event"], "busy_fleet")
+        json.dumps(events)
+        # window 10-20 only has 2 distinct ids, it closes without an event
+        self.assertEqual(operator.add(*self.rows([14, 25], ["fleet"] * 2, [1, 4])), [])
+        self.assertEqual(operator.windows, 2)
+        # rows for closed windows are dropped
+        operator.add(*self.rows([3], ["fleet"], [9]))
+        self.assertEqual(operator.late, 1)
+        # the open window 20-30 is closed on flush, one id is not enough for an event
+        self.assertEqual(operator.close(float("inf")), [])
+        self.assertEqual((operator.windows, operator.panes), (3, {}))
+
+    def test_sliding(self):
+        operator = WindowOperator("temp", "many", self.params({"type": "sliding", "size": 20, "slide": 10}, "count", 2))
+        events = operator.add(*self.rows([1, 5, 12, 31], ["a", "a", "a", "a"]))
+        # windows ending at 10, 20 and 30 are closed, those with more than 2 rows give events
+        self.assertEqual([(e["data"]["window_start"], e["data"]["value"]) for e in events], [(0, 3)])
+        self.assertEqual(operator.windows, 3)
+        self.assertEqual(set(operator.panes), {("a", 3)})
+        self.assertRaises(ValueError, lambda: WindowOperator("temp", "bad", self.params({"type": "sliding", "size": 20, "slide": 7})))
+
+    def test_session(self):
+        operator = WindowOperator("temp", "trip", self.params({"type": "session", "gap": 5}, "max", 10, measure="speed"))
+        events = operator.add(*self.rows([1, 3, 4, 20, 2], ["a", "a", "a", "a", "b"], [5, 12, 7, 3, 20]))
+        # session 1-4 of a closes when its next row comes 16 later, b closes once the watermark passes 7
+        self.assertEqual(sorted((e["data"]["key"], e["data"]["window_start"], e["data"]["window_end"], e["data"]["value"]) for e in events),
+                         [("a", 1, 4, 12.0), ("b", 2, 2, 20.0)])
+        self.assertEqual(list(operator.sessions), ["a"])
+        self.assertEqual(operator.close(float("inf")), [])
+
+    def test_float_timestamps(self):
+        # parsed date strings are float seconds
+        operator = WindowOperator("temp", "many", self.params({"type": "sliding", "size": 20, "slide": 10}, "count", 2))
+        events = operator.add(*self.rows([1.5, 5.25, 12.0, 31.75], ["a"] * 4))
+        self.assertEqual([(e["data"]["window_start"], e["data"]["value"]) for e in events], [(0, 3)])
+        self.assertEqual(set(operator.panes), {("a", 3)})
+        json.dumps(events)
+
+    def test_streams(self):
+        operator = WindowOperator("fleet", "busy", self.params({"type": "tumbling", "size": 10}, "count", 0, idle_seconds=60))
+        # car2 runs ahead, windows stay open for car1
+        self.assertEqual(operator.add(*self.rows([2], ["fleet"]), stream="car1", now=0), [])
+        self.assertEqual(operator.add(*self.rows([1, 25], ["fleet"] * 2), stream="car2", now=1), [])
+        events = operator.add(*self.rows([8, 14], ["fleet"] * 2), stream="car1", now=2)
+        self.assertEqual([(e["data"]["window_start"], e["data"]["value"]) for e in events], [(0, 3)])
+        self.assertEqual(operator.late, 0)
+        # car1 goes idle, windows close on car2's watermark
+        self.assertEqual(operator.add(*self.rows([26], ["fleet"]), stream="car2", now=40), [])
+        events = operator.tick(now=64)
+        self.assertEqual([(e["data"]["window_start"], e["data"]["value"]) for e in events], [(10, 1)])
+        self.assertEqual(list(operator.streams), ["car2"])
+        # car1's rows for the closed window are late
+        operator.add(*self.rows([15], ["fleet"]), stream="car1", now=65)
+        self.assertEqual(operator.late, 1)
+
+    def test_nan_timestamps(self):
+        operator = WindowOperator("fleet", "busy", self.params({"type": "tumbling", "size": 10}, "count", 0))
+        # a timestamp that failed to parse neither opens a pane nor holds the stream's watermark
+        self.assertEqual(operator.add(*self.rows([np.nan, 3.0], ["fleet"] * 2), stream="s1", now=0), [])
+        self.assertEqual(set(operator.panes), {("fleet", 0)})
+        self.assertEqual(operator.streams["s1"][0], 3.0)
+        self.assertEqual(operator.add(*self.rows([np.nan], ["fleet"]), stream="s1", now=1), [])
+        events = operator.add(*self.rows([12.0, np.nan], ["fleet"] * 2), stream="s1", now=2)
+        self.assertEqual([(e["data"]["window_start"], e["data"]["value"]) for e in events], [(0, 1)])
+        session = WindowOperator("temp", "trip", self.params({"type": "session", "gap": 5}, "count", 0))
+        session.add(*self.rows([1.0, np.nan], ["a"] * 2), stream="s1", now=0)
+        self.assertEqual(session.streams["s1"][0], 1.0)
+
+    def test_aggregator(self):
+        aggregator = WindowAggregator()
+        params = self.params({"type": "tumbling", "size": 10}, "count", 1)
+        timestamps, keys, values = self.rows([1, 2, 15], ["x"] * 3)
+        events = aggregator.add("temp", {"busy": {"params": params, "timestamp": timestamps, "key": keys, "value": values}})
+        self.assertEqual(len(events), 1)
+        self.assertEqual(aggregator.status(), {"temp/busy": {"windows": 1, "fired": 1, "late": 0, "open": 1, "streams": 1}})
+        self.assertEqual(aggregator.flush(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
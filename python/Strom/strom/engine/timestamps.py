@@ -0,0 +1,156 @@
+"""
+Timestamps Module
+
+Batch parsing of string timestamps into epoch seconds, using the date_format from a template's
+data_rules. Results match datetime.strptime(ts, date_format).timestamp(), so naive formats are read
+as local time.
+
+- epoch formats ("%s") are a plain float conversion
+- ISO formats numpy can read are parsed by numpy's datetime64 parser, unless values carry a utc offset
+("Z", "+hh:mm") numpy would convert to utc, those go value by value
+- anything else goes through pandas.to_datetime with the explicit format
+- strptime per element is only the fallback for values none of the above can read, values it can't
+read either become NaN (with a warning) rather than failing the whole batch
+"""
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+EPOCH_FORMATS = {"%s"}
+ISO_FORMATS = {
+    "%Y-%m-%d",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f",
+}
+EPOCH = datetime(1970, 1, 1)
+# utc offset at the end of an ISO timestamp
+OFFSET_SUFFIX = r"(?:Z|[+-]\d\d:?\d\d)$"
+DAY = 86400
+
+
+def _local_epoch(naive_seconds):
+    """Epoch seconds of a naive local time given as seconds since 1970-01-01 00:00 (no timezone)"""
+    return (EPOCH + timedelta(seconds=float(naive_seconds))).timestamp()
+
+
+def localize(naive_seconds):
+    """
+    Converts naive (wall clock) seconds to epoch seconds in local time. For a sorted batch spanning less
+    than a day (at most one DST change) the utc offset is computed at both ends, elements are only
+    converted one by one if they differ. Other batches are converted value by value.
+    :param naive_seconds: seconds since 1970-01-01 00:00 wall clock
+    :type naive_seconds: numpy float array
+    :rtype: numpy float array
+    """
+    if naive_seconds.shape[0] == 0:
+        return naive_seconds
+    if naive_seconds[-1] - naive_seconds[0] < DAY and (np.diff(naive_seconds) >= 0).all():
+        first = naive_seconds[0] - _local_epoch(naive_seconds[0])
+        last = naive_seconds[-1] - _local_epoch(naive_seconds[-1])
+        if first == last:
+            return naive_seconds - first
+    # repeated values are converted once
+    unique, inverse = np.unique(naive_seconds, return_inverse=True)
+    return np.array([_local_epoch(s) for s in unique])[inverse]
+
+
+class TimestampParser(object):
+    """Parser compiled for one date_format, shared by all streams using that format"""
+
+    def __init__(self, date_format):
+        self.date_format = date_format
+        if date_format in EPOCH_FORMATS:
+            self.kind = "epoch"
+        elif date_format in ISO_FORMATS:
+            self.kind = "iso"
+        else:
+            self.kind = "pandas"
+        self.aware = "%z" in date_format
+
+    def _strptime(self, value):
+        try:
+            if isinstance(value, str):
+                try:
+                    return datetime.strptime(value, self.date_format).timestamp()
+                except ValueError:
+                    if self.kind != "iso":
+                        raise
+                    # ISO value with a utc offset the naive format leaves out
+                    parsed = datetime.fromisoformat(value)
+                    if parsed.tzinfo is None:
+                        raise
+                    return parsed.timestamp()
+            return float(value)
+        except (TypeError, ValueError, OverflowError):
+            return np.nan
+
+    def _parse_iso(self, values):
+        if pd.Series(values, dtype=object).str.contains(OFFSET_SUFFIX, regex=True, na=False).any():
+            # numpy converts them to utc, they would then be localized again as wall clock time
+            raise ValueError("timestamps with utc offsets")
+        naive = np.array(values, dtype="datetime64[us]")
+        if np.isnat(naive).any():
+            raise ValueError("unparsed timestamps")
+        return localize(naive.astype(np.int64) / 1e6)
+
+    def _parse_pandas(self, values):
+        parsed = pd.to_datetime(pd.Series(values), format=self.date_format)
+        if self.aware:
+            parsed = parsed.dt.tz_convert("UTC").dt.tz_localize(None)
+        seconds = (parsed - pd.Timestamp(EPOCH)).dt.total_seconds().values
+        return seconds if self.aware else localize(seconds)
+
+    def parse(self, values):
+        """
+        Parses a batch of timestamps
+        :param values: timestamps, strings or numbers
+        :type values: numpy array
+        :return: epoch seconds, NaN for values that can't be parsed
+        :rtype: numpy float64 array
+        """
+        if values.dtype.kind in "fiu":
+            return values.astype(np.float64)
+        try:
+            if self.kind == "epoch":
+                return values.astype(np.float64)
+            elif self.kind == "iso":
+                return self._parse_iso(values)
+            else:
+                return self._parse_pandas(values)
+        except (TypeError, ValueError) as ex:
+            logger.debug(f"Vectorized timestamp parsing failed for {self.date_format} - {ex}")
+            parsed = np.array([self._strptime(v) for v in values], dtype=np.float64)
+            failed = np.isnan(parsed).sum()
+            if failed:
+                logger.warning(f"{failed} of {parsed.shape[0]} timestamps don't match {self.date_format}, set to NaN")
+            return parsed
+
+
+@lru_cache(maxsize=64)
+def timestamp_parser(date_format):
+    """Returns the cached parser for a date_format, None if there is no format"""
+    if date_format is None:
+        return None
+    return TimestampParser(date_format)
+
+
+def template_date_format(template):
+    """date_format from a template's data_rules, None if it has none"""
+    if not isinstance(template, dict):
+        return None
+    data_rules = template.get("data_rules")
+    if not isinstance(data_rules, dict):
+        return None
+    return data_rules.get("date_format")
@@ -0,0 +1,108 @@
+"""
+Transport Module
+
+Shared memory handoff of buffer batches between Engine and Processors.
+The SharedSlab is one shared memory block split into fixed size batch slots. The engine copies the
+numeric columns of a batch into a free slot and only sends a small slot descriptor over the queue,
+the processor maps the columns back as arrays on the slot and frees it when processing is done.
+It is not zero-copy: numeric columns are copied once into shared memory instead of being pickled,
+written to the queue pipe and unpickled, object columns are still pickled with the descriptor.
+Slots are recycled through a queue of free slot ids, so the engine blocks when processors fall
+behind instead of piling up batches.
+"""
+from multiprocessing import Queue
+
+import numpy as np
+
+from strom.utils.logger.logger import logger
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+ALIGN = 8
+
+
+class SharedSlab(object):
+    def __init__(self, slots, slot_bytes):
+        """
+        Creates shared memory block for slots, to be called in the engine process before
+        processors are started
+        :param slots: number of batch slots
+        :type slots: int
+        :param slot_bytes: size of each slot in bytes
+        :type slot_bytes: int
+        """
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory not available (python >= 3.8 required)")
+        self.slots = int(slots)
+        self.slot_bytes = int(slot_bytes)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_bytes)
+        self.free_slots = Queue()
+        for slot in range(self.slots):
+            self.free_slots.put(slot)
+        logger.info(f"Shared slab {self.shm.name}: {self.slots} slots of {self.slot_bytes} bytes")
+
+    def acquire(self, timeout=None):
+        """Takes a free slot id, blocks while all slots are in use by processors"""
+        return self.free_slots.get(timeout=timeout)
+
+    def release(self, slot):
+        """Returns slot to the free pool"""
+        if slot is not None:
+            self.free_slots.put(slot)
+
+    def _slot_view(self, slot, offset, dtype, shape):
+        start = slot * self.slot_bytes + offset
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=start)
+
+    def pack(self, slot, columns):
+        """
+        Copies numeric arrays of a batch into a slot, one copy per column in place of a pickle over the
+        queue pipe. Arrays that are object dtype, or do not fit in the slot, stay in the descriptor and
+        are pickled with it.
+        :param slot: slot id from acquire
+        :type slot: int
+        :param columns: batch columns, arrays nested in dicts
+        :type columns: dict
+        :return: descriptor of batch columns
+        :rtype: dict
+        """
+        offset = [0]
+
+        def _pack(value):
+            if isinstance(value, dict):
+                return {k: _pack(v) for k, v in value.items()}
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                if offset[0] + value.nbytes <= self.slot_bytes:
+                    view = self._slot_view(slot, offset[0], value.dtype, value.shape)
+                    view[...] = value
+                    packed = ("shm", offset[0], value.dtype.str, value.shape)
+                    offset[0] += -(-value.nbytes // ALIGN) * ALIGN
+                    return packed
+                logger.warning("Batch does not fit in shared slot, pickling column")
+            if isinstance(value, np.ndarray):
+                return value.copy()
+            return value
+
+        return _pack(columns)
+
+    def unpack(self, slot, descriptor):
+        """Maps a packed batch back to arrays, shm columns are views on the slot (valid until release)"""
+        if isinstance(descriptor, dict):
+            return {k: self.unpack(slot, v) for k, v in descriptor.items()}
+        if isinstance(descriptor, tuple) and descriptor[0] == "shm":
+            return self._slot_view(slot, descriptor[1], np.dtype(descriptor[2]), descriptor[3])
+        return descriptor
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,368 @@
+"""
+Window Module
+
+Windowed aggregation over the streams of the engine. Window rules are part of a template
+("window_rules", like event_rules) and see the rows of every stream using the template, so they can
+raise fleet level alerts such as "more than 5 vehicles in the box within 60s". Processors hand the
+engine the rows of each window rule of a batch (timestamp, key and measure value of the rows in the
+rule's partition), the engine keeps the aggregates of the open windows and emits an event for every
+window that closes with its aggregate past the rule's threshold.
+
+Windows run on the record timestamps. Every stream sending rows to a rule has its own watermark, the
+largest timestamp it sent less the rule's lateness, and a window closes once the smallest watermark
+of the streams passes its end, so a stream whose batches run ahead does not close windows other
+streams are still sending rows for. The price is that windows wait for the slowest stream: a stream
+that sent nothing for idle_seconds (wall clock) stops holding windows back, its later rows for
+windows closed in the meantime are dropped (counted as late). The watermark only moves forward.
+- "tumbling": windows of `size`
+- "sliding": windows of `size` every `slide`, size a multiple of slide
+- "session": a window per key that closes after `gap` without rows
+Rows are grouped by group_by: None for all streams of the template (the key is the template_id),
+"stream_token" or a measure (a user id such as "driver-id").
+
+Aggregates are incremental, closing a window never goes back to its rows. Tumbling and sliding
+windows are made of panes `slide` long that each hold the partial aggregate of their rows, a closing
+window merges the partials of its panes. Sessions hold one partial each.
+
+Contains...
+- class Partial:
+count, sum, min, max (values for percentile, distinct values) of some rows, mergeable
+- class WindowOperator:
+open windows and partials of one window rule
+- class WindowAggregator:
+window operators of all templates, by (template_id, rule name)
+"""
+import math
+from threading import Lock
+from time import monotonic
+
+import numpy as np
+import pandas as pd
+
+from strom.dstream.predicate import comparisons
+from strom.utils.logger.logger import logger
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+AGGREGATES = ("count", "sum", "mean", "min", "max", "percentile", "distinct")
+WINDOWS = ("tumbling", "sliding", "session")
+
+
+def scalar(value):
+    """Python value of a numpy scalar, events are json encoded"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class Partial(object):
+    """Partial aggregate of some rows, only keeps what the aggregate of its rule needs"""
+
+    __slots__ = ("aggregate", "count", "valued", "sum", "min", "max", "values", "distinct")
+
+    def __init__(self, aggregate):
+        """
+        :param aggregate: one of AGGREGATES
+        :type aggregate: str
+        """
+        self.aggregate = aggregate
+        self.count = 0
+        self.valued = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.values = []
+        self.distinct = set()
+
+    def add(self, values):
+        """Adds the values of some rows, NaN values count as rows but not as values"""
+        if self.aggregate == "count":
+            self.count += len(values)
+        elif self.aggregate == "distinct":
+            self.count += len(values)
+            self.distinct.update(values.tolist())
+        else:
+            self.count += len(values)
+            values = values.astype(np.float64)
+            values = values[~np.isnan(values)]
+            if values.shape[0]:
+                self.valued += values.shape[0]
+                self.sum += float(values.sum())
+                self.min = min(self.min, float(values.min()))
+                self.max = max(self.max, float(values.max()))
+                if self.aggregate == "percentile":
+                    self.values.append(values)
+
+    def merge(self, other):
+        """Adds the rows of another partial"""
+        self.count += other.count
+        self.valued += other.valued
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.values.extend(other.values)
+        self.distinct |= other.distinct
+
+    def result(self, percentile=50):
+        """Aggregate of the rows, NaN if there is no value to aggregate"""
+        if self.aggregate == "count":
+            return self.count
+        if self.aggregate == "distinct":
+            return len(self.distinct)
+        if self.min > self.max:
+            return math.nan
+        if self.aggregate == "sum":
+            return self.sum
+        if self.aggregate == "mean":
+            return self.sum / self.valued
+        if self.aggregate == "min":
+            return self.min
+        if self.aggregate == "max":
+            return self.max
+        return float(np.percentile(np.concatenate(self.values), percentile))
+
+
+class WindowOperator(object):
+    """Open windows of one window rule with their partial aggregates"""
+
+    def __init__(self, template_id, name, params):
+        """
+        :param template_id: template the rule belongs to
+        :type template_id: str
+        :param name: key of the rule in window_rules
+        :type name: str
+        :param params: param_dict of the rule
+        :type params: dict
+        """
+        self.template_id = template_id
+        self.name = name
+        self.params = params
+        window = params["window"]
+        self.window_type = window.get("type", "tumbling")
+        if self.window_type not in WINDOWS:
+            raise ValueError(f"{self.window_type} is not a supported window, expected one of {WINDOWS}")
+        self.aggregate = params.get("aggregate", "count")
+        if self.aggregate not in AGGREGATES:
+            raise ValueError(f"{self.aggregate} is not a supported aggregate, expected one of {AGGREGATES}")
+        self.percentile = params.get("percentile", 50)
+        self.compare = comparisons[params.get("comparison_operator", ">")]
+        self.threshold = params["threshold_value"]
+        self.lateness = params.get("lateness", 0)
+        self.idle_seconds = params.get("idle_seconds", 60)
+        # stream -> [watermark, monotonic time of its last rows]
+        self.streams = {}
+        if self.window_type == "session":
+            self.gap = window["gap"]
+            self.sessions = {}
+        else:
+            self.size = window["size"]
+            self.slide = window.get("slide", self.size) if self.window_type == "sliding" else self.size
+            if self.size % self.slide:
+                raise ValueError(f"Window size {self.size} is not a multiple of slide {self.slide}")
+            self.panes_per_window = self.size // self.slide
+            self.panes = {}
+            # last pane a window closed at, windows ending at or before it were emitted
+            self.closed = None
+        self.watermark = -math.inf
+        self.windows = 0
+        self.late = 0
+        self.fired = 0
+
+    def _event(self, key, start, end, partial):
+        value = partial.result(self.percentile)
+        self.windows += 1
+        if isinstance(value, float) and math.isnan(value) or not self.compare(value, self.threshold):
+            return None
+        self.fired += 1
+        return {"event": f"{self.name}_{self.template_id}",
+                "data": {"template_id": self.template_id, "rule": self.name, "key": scalar(key), "window_start": scalar(start),
+                         "window_end": scalar(end), "aggregate": self.aggregate, "value": scalar(value), "count": partial.count}}
+
+    def add(self, timestamps, keys, values, stream=None, now=None):
+        """
+        Adds the rows of a batch
+        :param timestamps: timestamps of the rows
+        :type timestamps: numpy array
+        :param keys: group key of every row
+        :type keys: numpy array
+        :param values: measure value of every row
+        :type values: numpy array
+        :param stream: stream token the rows came from, streams have their own watermark
+        :type stream: str
+        :param now: monotonic clock reading, for tests
+        :type now: float
+        :return: events of the windows closed by the rows
+        :rtype: list of dicts
+        """
+        now = monotonic() if now is None else now
+        events = []
+        timestamps = np.asarray(timestamps)
+        if timestamps.dtype.kind not in "iuf":
+            timestamps = timestamps.astype(np.float64)
+        finite = np.isfinite(timestamps)
+        if not finite.all():
+            # timestamps that failed to parse are NaN, they belong to no window and must not hold the watermark
+            logger.warning(f"Window rule {self.name} of template {self.template_id} dropped {int((~finite).sum())} rows without a valid timestamp")
+            timestamps, keys, values = timestamps[finite], np.asarray(keys)[finite], np.asarray(values)[finite]
+        if timestamps.shape[0]:
+            if self.window_type == "session":
+                events = self._add_sessions(timestamps, keys, values)
+            else:
+                self._add_panes(timestamps, keys, values)
+            mark = float(np.nanmax(timestamps)) - self.lateness
+            previous = self.streams.get(stream)
+            self.streams[stream] = [mark if previous is None else max(previous[0], mark), now]
+        return events + self.tick(now)
+
+    def tick(self, now=None):
+        """
+        Expires idle streams and closes the windows the watermark passed
+        :return: events of the closed windows
+        :rtype: list of dicts
+        """
+        now = monotonic() if now is None else now
+        marks = [mark for mark, seen in self.streams.values()]
+        for stream in [stream for stream, (mark, seen) in self.streams.items() if now - seen > self.idle_seconds]:
+            del self.streams[stream]
+        if self.streams:
+            self.watermark = max(self.watermark, min(mark for mark, seen in self.streams.values()))
+        elif marks:
+            # every stream went idle, nothing more is coming for what they sent
+            self.watermark = max(self.watermark, max(marks))
+        return self.close(self.watermark)
+
+    def _add_panes(self, timestamps, keys, values):
+        # float timestamps (parsed date strings) still give integer panes, windows are named by pane
+        rows = pd.DataFrame({"key": keys, "pane": np.floor_divide(timestamps, self.slide).astype(np.int64), "value": values})
+        if self.closed is not None:
+            # a row is late if every window its pane belongs to is closed
+            late = rows["pane"].to_numpy() + self.panes_per_window - 1 <= self.closed
+            if late.any():
+                self.late += int(late.sum())
+                rows = rows[~late]
+        for (key, pane), group in rows.groupby(["key", "pane"], sort=False, dropna=False):
+            pane = int(pane)
+            partial = self.panes.get((key, pane))
+            if partial is None:
+                partial = self.panes[(key, pane)] = Partial(self.aggregate)
+            partial.add(group["value"].to_numpy())
+
+    def _add_sessions(self, timestamps, keys, values):
+        """Adds rows to the sessions of their keys, returns the events of sessions the rows ended"""
+        events = []
+        rows = pd.DataFrame({"key": keys, "timestamp": timestamps, "value": values}).sort_values("timestamp", kind="stable")
+        for key, group in rows.groupby("key", sort=False, dropna=False):
+            times = group["timestamp"].to_numpy()
+            group_values = group["value"].to_numpy()
+            # a new session starts after every gap longer than the rule's gap
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(times) > self.gap) + 1, [times.shape[0]]))
+            for start, stop in zip(starts[:-1], starts[1:]):
+                session = self.sessions.get(key)
+                if session is not None and times[start] - session[1] > self.gap:
+                    events.extend(self._close_session(key))
+                    session = None
+                if session is None:
+                    session = self.sessions[key] = [times[start], times[stop - 1], Partial(self.aggregate)]
+                session[0] = min(session[0], times[start])
+                session[1] = max(session[1], times[stop - 1])
+                session[2].add(group_values[start:stop])
+        return events
+
+    def _close_session(self, key):
+        start, end, partial = self.sessions.pop(key)
+        event = self._event(key, start, end, partial)
+        return [] if event is None else [event]
+
+    def close(self, watermark):
+        """
+        Closes the windows ending at or before watermark
+        :return: events of the closed windows
+        :rtype: list of dicts
+        """
+        events = []
+        if self.window_type == "session":
+            for key in [key for key, session in self.sessions.items() if session[1] + self.gap < watermark]:
+                events.extend(self._close_session(key))
+            return events
+        if not self.panes:
+            return events
+        # windows are named by their last pane, the window ending at pane p ends at (p + 1) * slide
+        if watermark == -math.inf:
+            return events
+        last = math.floor(watermark / self.slide) - 1 if watermark != math.inf else max(pane for _, pane in self.panes) + self.panes_per_window - 1
+        first = min(pane for _, pane in self.panes) if self.closed is None else self.closed + 1
+        if last < first:
+            return events
+        ends = {}
+        for key, pane in self.panes:
+            for end in range(max(pane, first), min(pane + self.panes_per_window - 1, last) + 1):
+                ends.setdefault(end, set()).add(key)
+        for end in sorted(ends):
+            for key in ends[end]:
+                partial = Partial(self.aggregate)
+                for pane in range(end - self.panes_per_window + 1, end + 1):
+                    if (key, pane) in self.panes:
+                        partial.merge(self.panes[(key, pane)])
+                event = self._event(key, (end - self.panes_per_window + 1) * self.slide, (end + 1) * self.slide, partial)
+                if event is not None:
+                    events.append(event)
+        self.closed = last
+        for key, pane in [item for item in self.panes if item[1] + self.panes_per_window - 1 <= last]:
+            del self.panes[(key, pane)]
+        return events
+
+    def status(self):
+        return {"windows": self.windows, "fired": self.fired, "late": self.late,
+                "open": len(self.sessions) if self.window_type == "session" else len(self.panes), "streams": len(self.streams)}
+
+
+class WindowAggregator(object):
+    """Window operators of the engine, created on the first rows of a rule"""
+
+    def __init__(self):
+        self.operators = {}
+        self.lock = Lock()
+
+    def add(self, template_id, rules, stream_token=None):
+        """
+        Adds the window rule rows of a processed batch
+        :param template_id: template of the batch
+        :type template_id: str
+        :param rules: rows by rule name, as {"params": param_dict, "timestamp": array, "key": array, "value": array}
+        :type rules: dict
+        :param stream_token: stream of the batch
+        :type stream_token: str
+        :return: events of the windows closed by the rows
+        :rtype: list of dicts
+        """
+        events = []
+        with self.lock:
+            for name, rows in rules.items():
+                operator = self.operators.get((template_id, name))
+                if operator is None or operator.params != rows["params"]:
+                    if operator is not None:
+                        # rule changed with a new template version, its open windows are dropped
+                        logger.info(f"Window rule {name} of template {template_id} changed")
+                    operator = self.operators[(template_id, name)] = WindowOperator(template_id, name, rows["params"])
+                events.extend(operator.add(rows["timestamp"], rows["key"], rows["value"], stream_token))
+        return events
+
+    def tick(self):
+        """Closes windows held back only by streams that went idle, called when no rows come in"""
+        events = []
+        with self.lock:
+            for operator in self.operators.values():
+                events.extend(operator.tick())
+        return events
+
+    def flush(self):
+        """Closes every open window, for shutdown"""
+        events = []
+        with self.lock:
+            for operator in self.operators.values():
+                events.extend(operator.close(math.inf))
+        return events
+
+    def status(self):
+        with self.lock:
+            return {f"{template_id}/{name}": operator.status() for (template_id, name), operator in self.operators.items()}
@@ -79,7 +79,7 @@ class MQTTClient(mqtt.Client):
         :param transport: str: 'tcp' or 'websockets'
         :param asynch: bool: flag for non-blocking usage
         """
-        self.async=asynch
+        self.asynch=asynch
         super().__init__(
             client_id=uid,
             clean_session=False,
@@ -88,7 +88,7 @@ class MQTTClient(mqtt.Client):
             transport=transport
         )
         super().enable_logger(logger=logger)
-        if self.async:
+        if self.asynch:
             super().connect_async(host=kws["host"], port=kws["port"], keepalive=kws["keepalive"])
 
     def _set_throughput(self, inflight, queued):
@@ -119,7 +119,7 @@ class MQTTClient(mqtt.Client):
         }
 
     def run(self, **kws):
-        if self.async:
+        if self.asynch:
             print("async")
             super().loop_start()
         else:
@@ -31,6 +31,11 @@ def engine_status(url):
 
     return r.status_code, payload
 
+def rule_profile(url):
+    r = requests.get(f"{url}/rule_profile")
+
+    return r.status_code, r.json()
+
 def stop_engine(url):
     r = requests.get(f"{url}/stop_engine")
 
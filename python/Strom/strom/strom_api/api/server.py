@@ -2,14 +2,16 @@
 import datetime
 import json
 import pickle
-from multiprocessing import Pipe
+from multiprocessing import Pipe, Queue as ProcessQueue
 from queue import Queue
+from threading import Lock, Thread
 
 from flask import Flask, request, Response, jsonify
 from flask_restful import reqparse
 from flask_socketio import SocketIO
 
 from strom.coordinator.coordinator import Coordinator
+from strom.coordinator.sink import IDEMPOTENCY_HEADER, EventLedger, SinkReader
 from strom.dstream.dstream import DStream
 from strom.engine.engine import Engine
 from strom.storage.sqlite_interface import SqliteInterface
@@ -36,14 +38,25 @@ class Server():
 
         # ENGINE
         self.server_conn, self.engine_conn = Pipe()
-        self.engine = Engine(self.engine_conn, buffer_max_batch=10, buffer_max_seconds=1)
+        self.engine_lock = Lock()
+        # streams the engine refuses data for, None when the whole engine is over its watermark
+        self.admission_conn, engine_admission_conn = Pipe(duplex=False)
+        self.overloaded = set()
+        # processors hand events and measures back through this queue instead of the HTTP API
+        self.sink_queue = ProcessQueue()
+        self.engine = Engine(self.engine_conn, buffer_max_batch=10, buffer_max_seconds=1, batch_bounds=(10, 500), seconds_bounds=(0.25, 5), processor_bounds=(2, 8),
+                             admission_policy="reject", stream_watermarks=(5000, 2500), global_watermarks=(50000, 25000), admission_conn=engine_admission_conn, sink_queue=self.sink_queue)
         self.engine.start()# NOTE  POSSIBLE ISSUE WHEN MODIFYING BUFFER PROPS FROM TEST
         self.engine_start = datetime.datetime.now()
         self.engine_stopped = None
+        self.admission_thread = Thread(target=self._watch_admission, daemon=True)
+        self.admission_thread.start()
         # STORAGE QUEUE, WORKER AND INTERFACE
         self.storage_queue = Queue()
         self.storage_worker = StorageWorker(self.storage_queue, storage_config, config['storage_type'])
         self.storage_worker.start()
+        self.sink_reader = SinkReader(self.sink_queue, self.storage_queue, socketio.emit)
+        self.sink_reader.start()
 
         # NOTE TODO MAKE MORE FLEXIBLE?
         self.storage_interface = SqliteInterface(storage_config['local']['args'][0])
@@ -58,6 +71,47 @@ class Server():
         tk['Server._dstream_new'].stop()
         return dstream
 
+    def send_engine(self, message):
+        """ Sends message down the engine pipe, one writer at a time """
+        with self.engine_lock:
+            self.server_conn.send(message)
+
+    def _watch_admission(self):
+        """ Keeps track of the streams the engine is rejecting data for """
+        while True:
+            try:
+                _, token, overloaded = self.admission_conn.recv()
+            except EOFError:
+                break
+            if overloaded:
+                self.overloaded.add(token)
+            else:
+                self.overloaded.discard(token)
+
+    def rejects(self, token):
+        """ True if the engine is over its watermark for this stream or overall """
+        return None in self.overloaded or token in self.overloaded
+
+    def load_engine(self, batches):
+        """ Sends the dstreams of every stream of a request to the engine in one message,
+        returns the number of records it rejected by stream token (streams without rejections left out) """
+        rejected = self.request_engine(("load_streams", batches))
+        if rejected is None:
+            logger.warning(f"No answer from engine for load of streams {', '.join(batches)}, taking them as accepted")
+            return {}
+        return rejected
+
+    def request_engine(self, message, timeout=5):
+        """ Sends message down the engine pipe and waits for the engine's reply, None on timeout """
+        with self.engine_lock:
+            # drop late replies to requests that timed out
+            while self.server_conn.poll():
+                self.server_conn.recv()
+            self.server_conn.send(message)
+            if self.server_conn.poll(timeout):
+                return self.server_conn.recv()
+        return None
+
     def parse(self):
         """ Wrapper function for reqparse.parse_args """
         tk['Server.parse'].start()
@@ -85,7 +139,7 @@ def define():
         logger.debug("define: json.loads done")
         cur_dstream.load_from_json(json_template)
         # sends template to engine to init buffer stuff + data puller, if applicable
-        srv.server_conn.send((cur_dstream, "new"))
+        srv.send_engine((cur_dstream, "new"))
         logger.debug("define: dstream.load_from_json done")
         template_df = srv.coordinator.process_template(cur_dstream)
         srv.storage_queue.put(('template', template_df))
@@ -104,6 +158,18 @@ def define():
         tk['define'].stop()
         return resp
 
+def overloaded_response(streams=None, accepted=None):
+    """ 429 answer when every stream of a request was rejected. When only some were, the records of the
+    accepted streams are buffered already: 207 naming the rejected streams, only those are to be sent again """
+    if accepted:
+        resp = Response(json.dumps({'accepted': accepted, 'rejected': streams}), 207, mimetype='application/json')
+    else:
+        resp = Response('Engine overloaded, retry later.', 429)
+    resp.headers['Access-Control-Allow-Origin']='*'
+    resp.headers['Retry-After']='1'
+    return resp
+
+
 def load():
     """ Collect tokenized data.
     Expects 'data' argument containing user dataset to process.
@@ -118,10 +184,20 @@ def load():
         logger.debug("load: json.loads done")
         logger.debug("load: got token")
         if type(unjson_data) is dict:
-            srv.server_conn.send((unjson_data,"load"))# NOTE CHECK DATA FORMATS COMPARED TO LOAD_KAFKA
-        elif type(unjson_data) is list:
+            unjson_data = [unjson_data]
+        if type(unjson_data) is list:
+            # one pipe message for the whole request instead of one per dstream
+            batches = {}
             for d in unjson_data:
-                srv.server_conn.send((d, "load"))
+                batches.setdefault(d["stream_token"], []).append(d)
+            # streams the engine said it is over its watermark for are not sent at all
+            rejected = [token for token in batches.keys() if srv.rejects(token)]
+            loading = {token: dstreams for token, dstreams in batches.items() if token not in rejected}
+            # the engine may still reject records when it crossed its watermark after the last notification
+            if loading:
+                rejected += list(srv.load_engine(loading).keys())
+            if rejected:
+                return overloaded_response(rejected, [token for token in batches.keys() if token not in rejected])
         logger.debug("load: data piped to engine buffer")
     except Exception as ex:
         logger.warning("Server Error in load: Data loading/processing - {}".format(ex))
@@ -150,20 +226,32 @@ def get(this):
         return res.to_json(), 200
 
 
+def emit_event(json_data):
+    """ Emits a single event posted to /new_event """
+    if "event" in json_data:
+        if "data" in json_data:
+            tk['handle_event_detection : start time'].time()
+            tk['handle_event_detection : socketio.emit'].start()
+            socketio.emit(json_data["event"], json.dumps(json_data["data"]))
+            tk['handle_event_detection : socketio.emit'].stop()
+        else:
+            raise ValueError('Missing event data field: data')
+    else:
+        raise ValueError('Missing event name field: event')
+
+
+event_ledger = EventLedger()
+
+
 def handle_event_detection():
+    """ Emits one event, or a list of events posted in one request (events a retry of the list already emitted are skipped) """
     tk['handle_event_detection'].start()
     json_data = request.get_json()
     if json_data is not None:
-        if "event" in json_data:
-            if "data" in json_data:
-                tk['handle_event_detection : start time'].time()
-                tk['handle_event_detection : socketio.emit'].start()
-                socketio.emit(json_data["event"], json.dumps(json_data["data"]))
-                tk['handle_event_detection : socketio.emit'].stop()
-            else:
-                raise ValueError('Missing event data field: data')
+        if type(json_data) is list:
+            event_ledger.emit(request.headers.get(IDEMPOTENCY_HEADER), json_data, emit_event)
         else:
-            raise ValueError('Missing event name field: event')
+            emit_event(json_data)
     else:
         raise RuntimeError("No event data to return")
     tk['handle_event_detection'].stop()
@@ -223,15 +311,23 @@ def engine_status():
         stopped = None
         delta_t = datetime.datetime.now() - srv.engine_start
         delta_text = "time_running"
+        batching = srv.request_engine("engine_status")
     else:
         started = None
         stopped = srv.engine_stopped
         delta_t = datetime.datetime.now() - srv.engine_stopped
         delta_text = "time_stopped"
-    return jsonify({"running": status, "started": started, "stopped": stopped, delta_text: {"days": delta_t.days, "seconds": delta_t.seconds}})
+        batching = None
+    return jsonify({"running": status, "started": started, "stopped": stopped, delta_text: {"days": delta_t.days, "seconds": delta_t.seconds}, "batching": batching})
+
+def rule_profile():
+    """ Wall time, rows and bytes of every transform rule, by template, costliest rules first """
+    if not srv.engine.is_alive():
+        return jsonify({"running": False, "rule_profile": None})
+    return jsonify({"running": True, "rule_profile": srv.request_engine("engine_profile")})
 
 def stop_engine():
-    srv.server_conn.send("stop_poison_pill")
+    srv.send_engine("stop_poison_pill")
     while srv.engine.is_alive():
         pass
     srv.engine_stopped = datetime.datetime.now()
@@ -248,6 +344,7 @@ app.add_url_rule('/template_storage', 'template_storage', template_storage, meth
 # GET
 app.add_url_rule('/', 'index', index, methods=['GET'])
 app.add_url_rule('/api/engine_status', 'engine_status', engine_status, methods=['GET'])
+app.add_url_rule('/api/rule_profile', 'rule_profile', rule_profile, methods=['GET'])
 app.add_url_rule('/api/stop_engine', 'stop_engine', stop_engine, methods=['GET'])
 app.add_url_rule('/api/get/<this>', 'get', get, methods=['GET'])
 app.add_url_rule('/api/retrieve/<which>', 'retrieve_templates', retrieve_templates, methods=['GET'])
@@ -5,13 +5,20 @@ such as finding distance from a positional measure or the slope of an input meas
 measures may be of difference dimension than their inputs.
 These DeriveParam functions are called by apply_transformer on BStream data and the results are
 stored as BStream["derived_measures"]
+
+The *Stream variants are run by the engine and carry state across the batches of a stream (a dict kept
+per stream and rule): the running sum, the window tail, the last sample. Differences are placed on the
+later of the two samples, so the first sample of a batch gets its change from the last sample of the
+previous batch and only the first sample of the stream has none. Windowed outputs use trailing windows.
+The first `skip` rows of a batch were already processed with the previous batch (buffer_roll overlap),
+they are left out of the output.
 """
 
 import numpy as np
 import pandas as pd
 
 from strom.utils.logger.logger import logger
-from .filter_data import window_data
+from .filter_data import trailing_window, window_data, window_stream
 
 
 def sloper(rise_array, run_array, window_len=1):
@@ -180,6 +187,30 @@ def great_circle(position_array, window_len=1, units="mi"):
     return great_dist
 
 
+def spatial_block(data_frame, spatial_measure, swap_lon_lat=False):
+    """
+    Positions of a geo measure as an N x 2 array. BStream hands geo measures to transforms as complex
+    columns viewing its (N, 2) block, these are viewed back without copying, columns of [lon, lat]
+    lists are converted.
+    :param data_frame: transform input
+    :type data_frame: pandas DataFrame
+    :param spatial_measure: name of the geo measure
+    :type spatial_measure: str
+    :param swap_lon_lat: swap the two coordinates, returned as a view
+    :type swap_lon_lat: Boolean
+    :return: positions
+    :rtype: N x 2 numpy array
+    """
+    values = data_frame[spatial_measure].to_numpy()
+    if values.dtype == np.complex128:
+        position_array = np.ascontiguousarray(values).view(np.float64).reshape(-1, 2)
+    else:
+        position_array = pd.DataFrame(values.tolist()).values
+    if swap_lon_lat:
+        return position_array[:, ::-1]
+    return position_array
+
+
 def DeriveDistance(data_frame, params=None):
     logger.debug("initialized DeriveDistance. Use get_params() to see parameter values")
     if params == None:
@@ -202,10 +233,7 @@ def DeriveDistance(data_frame, params=None):
         window_len = params["func_params"]["window_len"]
     else:
         window_len = 1
-    position_array = pd.DataFrame(data_frame[params["measure_rules"]["spatial_measure"]].tolist()).values
-
-    if params["func_params"]["swap_lon_lat"]:
-        position_array = position_array[:,[1, 0]]
+    position_array = spatial_block(data_frame, params["measure_rules"]["spatial_measure"], params["func_params"]["swap_lon_lat"])
     if params["func_params"]["distance_func"] == "euclidean":
         dist_array = euclidean_dist(position_array, window_len)
     elif params["func_params"]["distance_func"] == "great_circle":
@@ -290,10 +318,7 @@ def DeriveHeading(data_frame, params=None):
         window_len = params["func_params"]["window_len"]
     else:
         window_len = 1
-    position_array = pd.DataFrame(data_frame[params["measure_rules"]["spatial_measure"]].tolist()).values
-
-    if params["func_params"]["swap_lon_lat"]:
-        position_array = position_array[:,[1, 0]]
+    position_array = spatial_block(data_frame, params["measure_rules"]["spatial_measure"], params["func_params"]["swap_lon_lat"])
     if params["func_params"]["heading_type"] == "bearing":
         angle_array = bearing(position_array, window_len, params["func_params"]["units"])
     elif params["func_params"]["heading_type"] == "flat_angle":
@@ -407,7 +432,7 @@ def DeriveInBox(data_frame, params=None):
 
 
     logger.debug("transforming data to %s" % (params["measure_rules"]["output_name"]))
-    position_array = pd.DataFrame(data_frame[params["measure_rules"]["spatial_measure"]].tolist()).values
+    position_array = spatial_block(data_frame, params["measure_rules"]["spatial_measure"])
     box_bool = in_box(position_array, params["func_params"]["upper_left_corner"], params["func_params"]["lower_right_corner"])
     return pd.DataFrame(data=box_bool, columns=[params["measure_rules"]["output_name"]], index=data_frame.index)
 
@@ -492,3 +517,82 @@ def DeriveLogicalCombination(data_frame, params=None):
 
 
 
+
+
+def _smooth_stream(values, window_len, state):
+    """Trailing window average of a derived array, window tail carried in state"""
+    if window_len > 1:
+        values, state["tail"] = window_stream(values, window_len, state.get("tail"))
+    return values
+
+
+def _changes(values, state, differ):
+    """
+    Applies differ to the values with the last value of the previous batch in front, keeps the new last value
+    :return: one change per value, the first value of the stream has none
+    """
+    last = state.get("last")
+    if values.shape[0] == 0:
+        return np.zeros((0,))
+    extended = values if last is None else np.concatenate((last[np.newaxis], values))
+    state["last"] = np.array(values[-1], copy=True)
+    return differ(extended)
+
+
+def _stream_output(data_frame, skip, values, output_name):
+    """DataFrame of derived values, which belong to the last len(values) rows of the batch"""
+    index = data_frame.index[skip:]
+    return pd.DataFrame(data=values, columns=[output_name], index=index[index.shape[0] - values.shape[0]:])
+
+
+def DeriveChangeStream(data_frame, params, state, skip=0):
+    """Streaming DeriveChange, last sample and window tail carried in `state`"""
+    logger.debug("transforming data to %s" % (params["measure_rules"]["output_name"]))
+    target_array = data_frame[params["measure_rules"]["target_measure"]].values[skip:].astype(np.float64)
+    diffed_data = _changes(target_array, state, lambda values: diff_data(values, 1, params["func_params"].get("angle_change", False)))
+    diffed_data = _smooth_stream(diffed_data, params["func_params"].get("window_len", 1), state)
+    return _stream_output(data_frame, skip, diffed_data, params["measure_rules"]["output_name"])
+
+
+def DeriveCumsumStream(data_frame, params, state, skip=0):
+    """Streaming DeriveCumsum, running sum carried in `state`, NaN samples do not reset the sum"""
+    logger.debug("transforming data to %s" % (params["measure_rules"]["output_name"]))
+    target_array = data_frame[params["measure_rules"]["target_measure"]].values[skip:].astype(np.float64)
+    total = state.get("sum", params["func_params"].get("offset", 0))
+    cumsum_array = np.nancumsum(target_array) + total
+    if cumsum_array.shape[0]:
+        state["sum"] = cumsum_array[-1]
+    cumsum_array[np.isnan(target_array)] = np.nan
+    return _stream_output(data_frame, skip, cumsum_array, params["measure_rules"]["output_name"])
+
+
+def DeriveWindowSumStream(data_frame, params, state, skip=0):
+    """Streaming DeriveWindowSum over trailing windows, window tail carried in `state`"""
+    logger.debug("transforming data to %s" % (params["measure_rules"]["output_name"]))
+    target_array = data_frame[params["measure_rules"]["target_measure"]].values[skip:]
+    summed_data, _, state["tail"] = trailing_window(target_array, params["func_params"].get("window_len", 1), state.get("tail"))
+    return _stream_output(data_frame, skip, summed_data, params["measure_rules"]["output_name"])
+
+
+def DeriveDistanceStream(data_frame, params, state, skip=0):
+    """Streaming DeriveDistance, last position and window tail carried in `state`"""
+    logger.debug("transforming data to %s" % (params["measure_rules"]["output_name"]))
+    distance_funcs = {"euclidean": euclidean_dist, "great_circle": great_circle}
+    if params["func_params"]["distance_func"] not in distance_funcs:
+        raise ValueError("Not suported distance function")
+    distance_func = distance_funcs[params["func_params"]["distance_func"]]
+    position_array = spatial_block(data_frame, params["measure_rules"]["spatial_measure"], params["func_params"]["swap_lon_lat"])[skip:]
+    dist_array = _changes(position_array, state, distance_func)
+    dist_array = _smooth_stream(dist_array, params["func_params"].get("window_len", 1), state)
+    return _stream_output(data_frame, skip, dist_array, params["measure_rules"]["output_name"])
+
+
+def DeriveHeadingStream(data_frame, params, state, skip=0):
+    """Streaming DeriveHeading, last position and window tail carried in `state`"""
+    logger.debug("transforming data to %s" % (params["measure_rules"]["output_name"]))
+    heading_funcs = {"bearing": bearing, "flat_angle": flat_angle}
+    heading_func = heading_funcs[params["func_params"]["heading_type"]]
+    position_array = spatial_block(data_frame, params["measure_rules"]["spatial_measure"], params["func_params"]["swap_lon_lat"])[skip:]
+    angle_array = _changes(position_array, state, lambda positions: heading_func(positions, 1, params["func_params"]["units"]))
+    angle_array = _smooth_stream(angle_array, params["func_params"].get("window_len", 1), state)
+    return _stream_output(data_frame, skip, angle_array, params["measure_rules"]["output_name"])
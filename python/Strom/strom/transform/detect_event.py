@@ -5,7 +5,20 @@ the input measures.
 
 apply_transformers calls the DetectEvent class on BStreams and stores output list of Events as
 BStream["events"]
+
+DetectThreshold gives an event for every sample past the threshold. DetectStateChange keeps an
+active/inactive state per rule and only gives events when that state changes:
+- hysteresis: the state switches on past threshold_value and only switches off again once the
+  measure no longer passes clear_value (the two make a band, clear_value defaults to threshold_value)
+- min_duration: a change only counts once the new raw state held for min_duration (timestamp units),
+  shorter excursions are ignored
+- edge: "rising", "falling" or "both", the state changes that give events
+- cooldown: no event less than cooldown (timestamp units) after the previous event of the rule
+DetectStateChangeStream is the variant the engine runs, it carries the detector state from one batch
+of a stream to the next so a state that started in one batch is not reported again in the next.
 """
+import numpy as np
+import pandas as pd
 
 from strom.transform.derive_param import compare_threshold
 from strom.utils.logger.logger import logger
@@ -60,3 +73,122 @@ def DetectThreshold(data_frame, params):
     event_times["event_name"] = params["event_name"]
     logger.debug(event_times.to_string())
     return event_times
+
+
+def hysteresis(on, off, active=False):
+    """
+    Raw state per sample, switched on where `on`, off where `off` and as the previous sample elsewhere
+    :param on: samples switching the state on, wins where both are set
+    :type on: boolean numpy array
+    :param off: samples switching the state off
+    :type off: boolean numpy array
+    :param active: state before the first sample
+    :type active: bool
+    :rtype: boolean numpy array
+    """
+    decided = on | off
+    last = np.maximum.accumulate(np.where(decided, np.arange(on.shape[0]), -1))
+    return np.where(last >= 0, on[np.maximum(last, 0)], active)
+
+
+def detect_transitions(values, timestamps, rules, state):
+    """
+    Confirmed state changes of a measure, see DetectStateChange for the rules. Updates `state`.
+    :param values: measure samples
+    :type values: numpy array
+    :param timestamps: timestamps of the samples, ascending
+    :type timestamps: numpy array
+    :param rules: event_rules of the rule
+    :type rules: dict
+    :param state: detector state, empty for a new stream
+    :type state: dict
+    :return: positions of the events and their edges ("rising" or "falling")
+    :rtype: tuple of numpy array and list
+    """
+    operator = rules.get("comparison_operator", ">=")
+    threshold = rules["threshold_value"]
+    clear = rules.get("clear_value", threshold)
+    absolute = rules.get("absolute_compare", False)
+    min_duration = rules.get("min_duration", 0)
+    cooldown = rules.get("cooldown", 0)
+    edge = rules.get("edge", "rising")
+    if edge not in ("rising", "falling", "both"):
+        raise ValueError("{} is not a supported edge".format(edge))
+
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    # missing samples neither set nor clear the state
+    on = compare_threshold(values, operator, threshold, absolute) & ~missing
+    off = ~compare_threshold(values, operator, clear, absolute) & ~missing
+    previous = state.get("raw", False)
+    raw = hysteresis(on, off, previous)
+
+    active = state.get("active", False)
+    last_event = state.get("last_event")
+    run_start = state.get("run_start")
+    positions, edges = [], []
+    changes = np.flatnonzero(raw != np.concatenate(([previous], raw[:-1])))
+    starts = changes.tolist()
+    # the first rows continue the raw run of the previous batch unless the state changes right away
+    continued = not starts or starts[0] != 0
+    if continued:
+        starts.insert(0, 0)
+    for segment, (start, end) in enumerate(zip(starts, starts[1:] + [raw.shape[0]])):
+        if segment or not continued or run_start is None:
+            run_start = timestamps[start]
+        if raw[start] == active:
+            continue
+        # first sample at which the new raw state held for min_duration
+        confirmed = start + np.searchsorted(timestamps[start:end], run_start + min_duration)
+        if confirmed >= end:
+            continue
+        active = bool(raw[start])
+        direction = "rising" if active else "falling"
+        if edge not in (direction, "both"):
+            continue
+        if last_event is not None and timestamps[confirmed] - last_event < cooldown:
+            continue
+        positions.append(confirmed)
+        edges.append(direction)
+        last_event = timestamps[confirmed]
+
+    if raw.shape[0]:
+        state["raw"] = bool(raw[-1])
+        state["run_start"] = run_start.item() if hasattr(run_start, "item") else run_start
+    state["active"] = active
+    state["last_event"] = last_event.item() if hasattr(last_event, "item") else last_event
+    return np.array(positions, dtype=np.int64), edges
+
+
+def DetectStateChangeStream(data_frame, params, state, skip=0):
+    """Streaming DetectStateChange, detector state carried in `state`, the first `skip` rows were seen with the previous batch"""
+    logger.debug("Finding state changes")
+    rules = params["event_rules"]
+    rows = data_frame.iloc[skip:]
+    positions, edges = detect_transitions(rows[rules["measure"]].values, rows["timestamp"].values, rules, state)
+    event_times = rows[["timestamp"]].iloc[positions]
+    event_times["stream_id"] = params["stream_id"]
+    event_times["event_name"] = params["event_name"]
+    event_times["edge"] = edges
+    logger.debug(event_times.to_string())
+    return event_times
+
+
+def DetectStateChange(data_frame, params):
+    logger.debug("staring DetectStateChange")
+    if params == None:
+        params = {}
+        params["event_rules"] = {
+                                    "measure":("name of measure to be thresholded","measure_name", True),
+                                    "threshold_value":("value at which the state switches on",0,True),
+                                    "comparison_operator":("one of == != >= <= > <", ">=",True),
+                                    "clear_value":("value at which the state switches off again, hysteresis band with threshold_value","threshold_value",False),
+                                    "absolute_compare":("whether to compare against absolute value instead of raw value",False,False),
+                                    "edge":("state changes giving events, one of rising falling both","rising",False),
+                                    "min_duration":("time a new state has to hold before it counts",0,False),
+                                    "cooldown":("shortest time between two events",0,False)}
+        params["event_name"] = ("name of event","state_event",True)
+        params["stream_id"] = ("stream_token that this event was found in","UUID",True)
+        return params
+
+    return DetectStateChangeStream(data_frame, params, {})
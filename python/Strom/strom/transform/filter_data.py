@@ -6,15 +6,68 @@ These filters are called by apply_transformer on BStream data and the results ar
 as BStream["filtered_measures"]
 
 window_data is used as a filter but also has uses in other Transformer subclasses so it is a top
-level function for easier importing by those subclasses"""
+level function for easier importing by those subclasses
+
+The filters work on all their columns at once: the measures are one 2-D block, filtfilt runs along
+axis 0 of it with Butterworth coefficients cached per (order, nyquist), and window_block takes the
+windowed means of every column from one cumulative sum.
+
+ButterLowpassStream and WindowAverageStream are the streaming variants the engine runs: they carry
+filter state from one batch of a stream to the next (state is a dict kept per stream and rule), so
+there are no discontinuities at batch boundaries. They are causal, the Butterworth filter runs
+forward only (lfilter) and the window average is a trailing window, where the batch versions are
+zero phase and centered. The first `skip` rows of a batch were already filtered with the previous
+batch (buffer_roll overlap), they are not fed to the filter again and come out as NaN."""
+
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, filtfilt, lfilter, lfilter_zi
 
 from strom.utils.logger.logger import logger
 
 
+def window_block(in_block, window_len):
+    """
+    Windowed average of every column of a 2-D array, from one cumulative sum over the block. Like a
+    convolution, only the windows holding a NaN sample are NaN.
+    :param in_block: input data, one column per measure
+    :type in_block: N x M numpy array
+    :param window_len: length of window for averaging
+    :type window_len: int
+    :return: windowed average of the data
+    :rtype: N x M numpy array
+    """
+    if in_block.shape[0] < window_len*2:
+        return in_block
+    logger.debug("Windowing data with window length {:d}".format(window_len))
+    # sums are taken relative to the first sample, large values (epoch timestamps) keep their precision
+    offset = np.where(np.isfinite(in_block[0]), in_block[0], 0)
+    shifted = in_block - offset
+    # NaN samples are summed as 0 and counted, a difference of cumsums would spread them to every later window
+    missing = np.isnan(shifted)
+    sums = np.nancumsum(shifted, axis=0)
+    w_data = np.empty((in_block.shape[0] - window_len + 1, in_block.shape[1]))
+    w_data[0] = sums[window_len - 1]
+    w_data[1:] = sums[window_len:] - sums[:-window_len]
+    w_data /= window_len
+    # Dealing with the special case for endpoints of in_block
+    ends_divisor = np.arange(1, window_len, 2)[:, np.newaxis]
+    start = sums[:window_len - 1][::2] / ends_divisor
+    tail = shifted[:-window_len:-1]
+    stop = np.nancumsum(tail, axis=0)[::2] / ends_divisor
+    if missing.any():
+        gaps = np.cumsum(missing, axis=0)
+        w_data[gaps[window_len - 1:] - np.concatenate((np.zeros((1, gaps.shape[1]), dtype=gaps.dtype), gaps[:-window_len])) > 0] = np.nan
+        start[gaps[:window_len - 1][::2] > 0] = np.nan
+        stop[np.cumsum(np.isnan(tail), axis=0)[::2] > 0] = np.nan
+    stop = stop[::-1]
+    if in_block.shape[0] - w_data.shape[0] - start.shape[0] < stop.shape[0]:
+        stop = stop[1:]
+    return np.concatenate((start, w_data, stop)) + offset
+
+
 def window_data(in_array, window_len):
     """
     Function that calculates the windowed average of a vector
@@ -27,16 +80,20 @@ def window_data(in_array, window_len):
     """
     if in_array.shape[0] < window_len*2:
         return in_array
-    else:
-        logger.debug("Windowing data with window length {:d}".format(window_len))
-        w_data = np.convolve(in_array, np.ones(window_len), "valid") / window_len
-        # Dealing with the special case for endpoints of in_array
-        ends_divisor = np.arange(1, window_len, 2)
-        start = np.cumsum(in_array[:window_len - 1])[::2] / ends_divisor
-        stop = (np.cumsum(in_array[:-window_len:-1])[::2] / ends_divisor)[::-1]
-        if in_array.shape[0] - w_data.shape[0] - start.shape[0] < stop.shape[0]:
-            stop = stop[1:]
-        return np.concatenate((start, w_data, stop))
+    return window_block(in_array[:, np.newaxis], window_len)[:, 0]
+
+
+@lru_cache(maxsize=128)
+def butter_coefficients(order, nyquist):
+    """
+    Butterworth lowpass coefficients, computed once per (order, nyquist)
+    :return: numerator and denominator, read only
+    :rtype: tuple of numpy arrays
+    """
+    b, a = butter(order, nyquist)
+    b.flags.writeable = False
+    a.flags.writeable = False
+    return b, a
 
 
 def butter_data(data_array, order, nyquist):
@@ -52,8 +109,8 @@ def butter_data(data_array, order, nyquist):
     :rtype: numpy array
     """
     logger.debug("buttering data")
-    b, a = butter(order, nyquist)
-    return filtfilt(b, a, data_array)
+    b, a = butter_coefficients(order, nyquist)
+    return filtfilt(b, a, data_array, axis=0)
 
 
 
@@ -67,12 +124,8 @@ def ButterLowpass(data_frame, params=None):
         params["filter_name"] = "_buttered"
 
     logger.debug("transforming_data")
-    buttered_data = np.zeros(data_frame.shape)
-    output_names = []
-    for col_ind, df_col in enumerate(data_frame):
-        buttered_data[:, col_ind] = butter_data(data_frame[df_col].values, params["order"], params["nyquist"])
-        output_names.append(df_col+params["filter_name"])
-
+    buttered_data = butter_data(data_frame.to_numpy(dtype=np.float64), params["order"], params["nyquist"])
+    output_names = [df_col + params["filter_name"] for df_col in data_frame]
     return pd.DataFrame(data=buttered_data, columns=output_names, index=data_frame.index)
 
 
@@ -86,10 +139,110 @@ def WindowAverage(data_frame, params=None):
         params["filter_name"] = "_windowed"
 
     logger.debug("transforming_data")
-    windowed_data = np.zeros(data_frame.shape)
+    windowed_data = window_block(data_frame.to_numpy(dtype=np.float64), params["window_len"])
+    output_names = [df_col + params["filter_name"] for df_col in data_frame]
+    return pd.DataFrame(data=windowed_data, columns=output_names, index=data_frame.index)
+
+
+def butter_stream(data_array, b, a, zi=None):
+    """
+    Applies a lowpass filter forward only, continuing from the filter state of the previous batch
+    :param data_array: array of data to be filtered, NaN samples are passed over
+    :type data_array: numpy array
+    :param b: numerator coefficients
+    :type b: numpy array
+    :param a: denominator coefficients
+    :type a: numpy array
+    :param zi: filter state after the previous batch, None to start at steady state on the first sample
+    :type zi: numpy array
+    :return: filtered data, filter state after the last sample
+    :rtype: tuple
+    """
+    filtered = np.full(data_array.shape, np.nan)
+    finite = np.isfinite(data_array)
+    if not finite.any():
+        return filtered, zi
+    samples = data_array[finite]
+    if zi is None:
+        zi = lfilter_zi(b, a) * samples[0]
+    filtered[finite], zi = lfilter(b, a, samples, zi=zi)
+    return filtered, zi
+
+
+def trailing_window(in_array, window_len, tail=None):
+    """
+    Sums and sample counts of trailing windows, continuing from the last samples of the previous batch
+    :param in_array: input array, NaN samples are left out of the sums and counts
+    :type in_array: numpy array
+    :param window_len: length of window
+    :type window_len: int
+    :param tail: last window_len - 1 samples of the previous batch, None at the start of the stream
+    :type tail: numpy array
+    :return: window sums, window counts, tail for the next batch
+    :rtype: tuple
+    """
+    if tail is None:
+        tail = np.zeros((0,))
+    extended = np.concatenate((tail, in_array)).astype(np.float64)
+    valid = np.isfinite(extended)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, extended, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    end = np.arange(tail.shape[0] + 1, extended.shape[0] + 1)
+    start = np.maximum(end - window_len, 0)
+    tail = extended[max(extended.shape[0] - (window_len - 1), 0):] if window_len > 1 else extended[:0]
+    return sums[end] - sums[start], counts[end] - counts[start], tail
+
+
+def window_stream(in_array, window_len, tail=None):
+    """
+    Trailing windowed average, continuing from the last samples of the previous batch
+    :param in_array: input array, NaN samples are left out of the averages
+    :type in_array: numpy array
+    :param window_len: length of window for averaging
+    :type window_len: int
+    :param tail: last window_len - 1 samples of the previous batch, None at the start of the stream
+    :type tail: numpy array
+    :return: windowed average of the data, tail for the next batch
+    :rtype: tuple
+    """
+    sums, counts, tail = trailing_window(in_array, window_len, tail)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts, tail
+
+
+def _stream_columns(data_frame, params, state, skip, filter_column):
+    """Runs filter_column(values, column_state) on every column from row `skip` on, NaN before it"""
+    filtered_data = np.full(data_frame.shape, np.nan)
     output_names = []
     for col_ind, df_col in enumerate(data_frame):
-        windowed_data[:, col_ind] = window_data(data_frame[df_col].values, params["window_len"])
+        column_state = state.setdefault(df_col, {})
+        filtered_data[skip:, col_ind] = filter_column(data_frame[df_col].values[skip:].astype(np.float64), column_state)
         output_names.append(df_col + params["filter_name"])
+    return pd.DataFrame(data=filtered_data, columns=output_names, index=data_frame.index)
 
-    return pd.DataFrame(data=windowed_data, columns=output_names, index=data_frame.index)
+
+def ButterLowpassStream(data_frame, params, state, skip=0):
+    """Streaming ButterLowpass, filter state of every column carried in `state`"""
+    logger.debug("Calculating ButterLowpassStream.")
+    if "filter_name" not in params:
+        params["filter_name"] = "_buttered"
+    b, a = butter_coefficients(params["order"], params["nyquist"])
+
+    def filter_column(values, column_state):
+        filtered, column_state["zi"] = butter_stream(values, b, a, column_state.get("zi"))
+        return filtered
+
+    return _stream_columns(data_frame, params, state, skip, filter_column)
+
+
+def WindowAverageStream(data_frame, params, state, skip=0):
+    """Streaming WindowAverage, window tail of every column carried in `state`"""
+    logger.debug("Calculating WindowAverageStream.")
+    if "filter_name" not in params:
+        params["filter_name"] = "_windowed"
+
+    def filter_column(values, column_state):
+        windowed, column_state["tail"] = window_stream(values, params["window_len"], column_state.get("tail"))
+        return windowed
+
+    return _stream_columns(data_frame, params, state, skip, filter_column)
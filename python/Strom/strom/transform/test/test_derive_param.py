@@ -143,6 +143,49 @@ class TestDeriveDataFrame(unittest.TestCase):
         self.assertEqual(self.bstream["measures"].shape[0], head_df.shape[0]+1)
 
 
+    def test_stream_carry(self):
+        measures = self.bstream["measures"]
+        params = {"func_params": {"offset": 10}, "measure_rules": {"target_measure": "timestamp", "output_name": "time_sum"}}
+        state = {}
+        first = DeriveCumsumStream(measures.iloc[:100], params, state)
+        second = DeriveCumsumStream(measures.iloc[100:], params, state)
+        self.assertTrue(np.array_equal(pd.concat([first, second])["time_sum"].values, np.cumsum(measures["timestamp"].values) + 10))
+
+        params = {"func_params": {"window_len": 1, "angle_change": False}, "measure_rules": {"target_measure": "timestamp", "output_name": "time_change"}}
+        state = {}
+        first = DeriveChangeStream(measures.iloc[:100], params, state)
+        # the first sample of the second batch changes from the last one of the first batch
+        second = DeriveChangeStream(measures.iloc[100:], params, state)
+        self.assertEqual(second.index[0], 100)
+        self.assertTrue(np.array_equal(pd.concat([first, second])["time_change"].values, np.diff(measures["timestamp"].values)))
+
+        params = {"func_params": {"window_len": 3}, "measure_rules": {"target_measure": "timestamp", "output_name": "time_window_sum"}}
+        state = {}
+        first = DeriveWindowSumStream(measures.iloc[:100], params, state)
+        second = DeriveWindowSumStream(measures.iloc[95:], params, state, skip=5)
+        self.assertEqual(second.index[0], 100)
+        expected = measures["timestamp"].rolling(3, min_periods=1).sum().values
+        self.assertTrue(np.array_equal(pd.concat([first, second])["time_window_sum"].values, expected))
+
+        params = {"func_params": {"window_len": 1, "distance_func": "euclidean", "swap_lon_lat": True}, "measure_rules": {"spatial_measure": "location", "output_name": "dist1"}}
+        state = {}
+        first = DeriveDistanceStream(measures.iloc[:100], params, state)
+        second = DeriveDistanceStream(measures.iloc[100:], params, state)
+        expected = DeriveDistance(measures, params)["dist1"].values
+        self.assertTrue(np.allclose(pd.concat([first, second])["dist1"].values, expected, equal_nan=True))
+
+    def test_spatial_block(self):
+        lists = self.bstream["measures"][["location"]]
+        geo_template = dict(self.dstream_template, measures=dict(self.dstream_template["measures"]))
+        geo_template["measures"]["location"] = dict(geo_template["measures"]["location"], dtype="geo")
+        geo = BStream(geo_template, self.dstreams)
+        geo.aggregate
+        block = geo.measure_store().select(["location"])
+        self.assertTrue(np.array_equal(spatial_block(lists, "location"), spatial_block(block, "location"), equal_nan=True))
+        swapped = spatial_block(block, "location", swap_lon_lat=True)
+        self.assertTrue(np.shares_memory(swapped, block["location"].to_numpy()))
+        self.assertTrue(np.array_equal(swapped, spatial_block(lists, "location")[:, [1, 0]], equal_nan=True))
+
     def test_in_box(self):
         box_rules = {
             "partition_list":[],
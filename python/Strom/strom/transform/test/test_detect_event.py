@@ -1,6 +1,9 @@
 import json
 import unittest
 
+import numpy as np
+import pandas as pd
+
 from strom.dstream.bstream import BStream
 from strom.transform.detect_event import *
 
@@ -39,6 +42,49 @@ class TestDeriveDataFrame(unittest.TestCase):
         self.assertIn("stream_id", threshold_df.columns)
         self.assertIn("event_name", threshold_df.columns)
 
+    def test_hysteresis(self):
+        values = np.array([0, 6, 4, 2, 4, 6, 1, np.nan, 7], dtype=float)
+        raw = hysteresis(values >= 5, values < 3, False)
+        self.assertEqual(raw.tolist(), [False, True, True, False, False, True, False, False, True])
+
+    def test_state_change(self):
+        timestamps = np.arange(12) * 10
+        values = np.array([0, 6, 4, 6, 0, 0, 6, 6, 6, 6, 0, 6], dtype=float)
+        frame = pd.DataFrame({"timestamp": timestamps, "speed": values})
+        params = {"event_rules": {"measure": "speed", "threshold_value": 5, "comparison_operator": ">=", "clear_value": 3},
+                  "event_name": "fast", "stream_id": "abc123"}
+        # a signal sitting above threshold gives one event, the dip to 4 is inside the band
+        events = DetectStateChange(frame, params)
+        self.assertEqual(events["timestamp"].tolist(), [10, 60, 110])
+        self.assertEqual(events["edge"].tolist(), ["rising"] * 3)
+        self.assertEqual(set(events.columns), {"timestamp", "stream_id", "event_name", "edge"})
+
+        params["event_rules"]["edge"] = "both"
+        self.assertEqual(DetectStateChange(frame, params)["edge"].tolist(), ["rising", "falling", "rising", "falling", "rising"])
+        # short excursions above threshold are ignored
+        params["event_rules"]["min_duration"] = 30
+        self.assertEqual(DetectStateChange(frame, params)["timestamp"].tolist(), [90])
+        params["event_rules"]["min_duration"] = 0
+        params["event_rules"]["edge"] = "rising"
+        params["event_rules"]["cooldown"] = 60
+        self.assertEqual(DetectStateChange(frame, params)["timestamp"].tolist(), [10, 110])
+
+    def test_state_change_stream(self):
+        timestamps = np.arange(12) * 10
+        values = np.array([0, 6, 4, 6, 0, 0, 6, 6, 6, 6, 0, 6], dtype=float)
+        frame = pd.DataFrame({"timestamp": timestamps, "speed": values})
+        params = {"event_rules": {"measure": "speed", "threshold_value": 5, "clear_value": 3, "edge": "both", "min_duration": 10},
+                  "event_name": "fast", "stream_id": "abc123"}
+        whole = DetectStateChange(frame, params)
+        for split in range(1, 12):
+            state = {}
+            first = DetectStateChangeStream(frame.iloc[:split], params, state)
+            # the second batch repeats two rows of the first as overlap
+            start = max(split - 2, 0)
+            second = DetectStateChangeStream(frame.iloc[start:], params, state, skip=split - start)
+            self.assertEqual(pd.concat([first, second])["timestamp"].tolist(), whole["timestamp"].tolist())
+        self.assertEqual(whole["timestamp"].tolist(), [20, 50, 70])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -5,6 +5,17 @@ from strom.dstream.bstream import BStream
 from strom.transform.filter_data import *
 
 
+def convolved(in_array, window_len):
+    """Windowed average by convolution, as window_data computed it before the cumsum block"""
+    w_data = np.convolve(in_array, np.ones(window_len), "valid") / window_len
+    ends_divisor = np.arange(1, window_len, 2)
+    start = np.cumsum(in_array[:window_len - 1])[::2] / ends_divisor
+    stop = (np.cumsum(in_array[:-window_len:-1])[::2] / ends_divisor)[::-1]
+    if in_array.shape[0] - w_data.shape[0] - start.shape[0] < stop.shape[0]:
+        stop = stop[1:]
+    return np.concatenate((start, w_data, stop))
+
+
 class TestFilter(unittest.TestCase):
     def setUp(self):
         demo_data_dir = "demo_data/"
@@ -47,6 +58,53 @@ class TestFilter(unittest.TestCase):
             self.assertIn(measure_name+window_rule["param_dict"]["filter_name"], window_df.columns)
         self.assertEqual(self.bstream["measures"].shape[0], window_df.shape[0])
 
+    def test_block(self):
+        measures = pd.DataFrame(np.random.default_rng(7).normal(size=(200, 6)), columns=list("abcdef"))
+        buttered = ButterLowpass(measures, {"order": 2, "nyquist": 0.05, "filter_name": "_buttery"})
+        windowed = WindowAverage(measures, {"window_len": 5, "filter_name": "_winning"})
+        self.assertEqual(list(buttered.columns), [column + "_buttery" for column in measures])
+        for column in measures:
+            # the whole block at once gives what filtering every column on its own gives
+            b, a = butter(2, 0.05)
+            self.assertTrue(np.allclose(buttered[column + "_buttery"].values, filtfilt(b, a, measures[column].values)))
+            self.assertTrue(np.allclose(windowed[column + "_winning"].values, convolved(measures[column].values, 5)))
+        self.assertEqual(window_data(np.arange(6.0), 2).tolist(), [0.0, 0.5, 1.5, 2.5, 3.5, 4.5])
+        # a NaN sample only spoils the windows holding it
+        data = np.arange(20.0)
+        data[3] = np.nan
+        for window_len in (2, 3, 4, 5):
+            self.assertTrue(np.allclose(window_data(data, window_len), convolved(data, window_len), equal_nan=True))
+        self.assertEqual(window_data(data, 4)[6:8].tolist(), [5.5, 6.5])
+        self.assertIs(butter_coefficients(2, 0.05), butter_coefficients(2, 0.05))
+
+    def test_butter_stream(self):
+        params = {"order": 2, "nyquist": 0.05, "filter_name": "_buttery"}
+        measures = self.bstream["measures"][["timestamp"]]
+        whole = ButterLowpassStream(measures, params, {})
+        state = {}
+        first = ButterLowpassStream(measures.iloc[:100], params, state)
+        # second batch repeats 5 rows of the first as overlap, they are not filtered again
+        second = ButterLowpassStream(measures.iloc[95:], params, state, skip=5)
+        self.assertTrue(second["timestamp_buttery"].iloc[:5].isna().all())
+        joined = pd.concat([first, second.iloc[5:]])
+        self.assertTrue(np.allclose(joined["timestamp_buttery"].values, whole["timestamp_buttery"].values))
+
+    def test_window_stream(self):
+        data = np.array([1.0, 2.0, np.nan, 4.0, 5.0, 6.0, 7.0])
+        windowed, tail = window_stream(data[:2], 3)
+        self.assertEqual(windowed.tolist(), [1.0, 1.5])
+        windowed, tail = window_stream(data[2:], 3, tail)
+        self.assertEqual(windowed.tolist(), [1.5, 3.0, 4.5, 5.0, 6.0])
+        self.assertEqual(tail.tolist(), [6.0, 7.0])
+
+        params = {"window_len": 3, "filter_name": "_winning"}
+        measures = self.bstream["measures"][["timestamp"]]
+        state = {}
+        first = WindowAverageStream(measures.iloc[:10], params, state)
+        second = WindowAverageStream(measures.iloc[10:], params, state)
+        expected = measures["timestamp"].rolling(3, min_periods=1).mean().values
+        self.assertTrue(np.allclose(pd.concat([first, second])["timestamp_winning"].values, expected))
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+"""
+Rule profiler
+
+Per rule cost of the transform plans: wall time, rows in and out, and bytes of the DataFrames the rule
+allocates (the rows its partition copies out of the store and its output frame), aggregated per
+template. Wall times go into histograms with fixed buckets so profiles of processors can be merged
+by adding counts.
+
+It is meant to stay on in production: one perf_counter pair and a few additions per rule and batch,
+no tracemalloc (which slows down every allocation of the process) and no logging per rule. Times are
+in milliseconds, like the timers of strom.utils.stopwatch.
+
+Processors profile their batches and hand the engine what they observed since their last export,
+the engine merges it, logs a summary of the costliest rules every so often and answers
+"engine_profile" requests with the whole profile (/api/rule_profile).
+
+Contains...
+- class RuleStats:
+counts, totals and wall time histogram of one rule
+- class RuleProfiler:
+RuleStats by template and rule, export/merge for moving them between processes
+"""
+from time import perf_counter
+
+from strom.utils.logger.logger import logger
+from strom.utils.stopwatch import MILLI_SECONDS
+
+__version__ = "0.1"
+__author__ = "Molly <molly@tura.io>"
+
+
+# upper bounds of the wall time histogram buckets in ms, the last bucket takes everything slower
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+BATCH = "(batch)"
+
+
+def elapsed_ms(start):
+    """Milliseconds since a perf_counter() reading"""
+    return (perf_counter() - start) * MILLI_SECONDS
+
+
+class RuleStats(object):
+    """Accumulated cost of one rule"""
+
+    __slots__ = ("count", "total_ms", "max_ms", "rows_in", "rows_out", "bytes", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes = 0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def observe(self, ms, rows_in=0, rows_out=0, nbytes=0):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.rows_in += rows_in
+        self.rows_out += rows_out
+        self.bytes += nbytes
+        bucket = 0
+        while bucket < len(BUCKETS_MS) and ms > BUCKETS_MS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def merge(self, other):
+        """Adds the counts of another RuleStats, or of its export"""
+        if isinstance(other, dict):
+            other = RuleStats.load(other)
+        self.count += other.count
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+        self.rows_in += other.rows_in
+        self.rows_out += other.rows_out
+        self.bytes += other.bytes
+        self.histogram = [mine + theirs for mine, theirs in zip(self.histogram, other.histogram)]
+
+    def export(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def load(cls, exported):
+        stats = cls()
+        for slot in cls.__slots__:
+            setattr(stats, slot, exported[slot])
+        return stats
+
+    def report(self):
+        """Export with the mean time and the histogram keyed by bucket bound"""
+        report = self.export()
+        report["mean_ms"] = self.total_ms / self.count if self.count else 0.0
+        report["histogram"] = {f"<={bound}": count for bound, count in zip(BUCKETS_MS, self.histogram)}
+        report["histogram"][f">{BUCKETS_MS[-1]}"] = self.histogram[-1]
+        return report
+
+
+class RuleProfiler(object):
+    """RuleStats by template_id and rule label"""
+
+    def __init__(self):
+        self.templates = {}
+
+    def observe(self, template_id, rule, ms, rows_in=0, rows_out=0, nbytes=0):
+        """
+        Records one run of a rule
+        :param template_id: template the rule belongs to
+        :type template_id: str
+        :param rule: rule label, see CompiledRule.label, BATCH for the whole batch
+        :type rule: str
+        :param ms: wall time in milliseconds
+        :type ms: float
+        :param rows_in: rows the rule read
+        :type rows_in: int
+        :param rows_out: rows of the rule's output
+        :type rows_out: int
+        :param nbytes: bytes of the DataFrames the rule allocated
+        :type nbytes: int
+        """
+        rules = self.templates.setdefault(template_id, {})
+        stats = rules.get(rule)
+        if stats is None:
+            stats = rules[rule] = RuleStats()
+        stats.observe(ms, rows_in, rows_out, nbytes)
+
+    def export(self, reset=True):
+        """
+        Profile as plain dicts, to send to another process
+        :param reset: start over, the next export only has what was observed after this one
+        :type reset: bool
+        :return: exported RuleStats by template and rule, None if nothing was observed
+        :rtype: dict
+        """
+        if not self.templates:
+            return None
+        exported = {template_id: {rule: stats.export() for rule, stats in rules.items()} for template_id, rules in self.templates.items()}
+        if reset:
+            self.templates = {}
+        return exported
+
+    def merge(self, exported):
+        """Adds an export of another profiler"""
+        for template_id, rules in exported.items():
+            mine = self.templates.setdefault(template_id, {})
+            for rule, stats in rules.items():
+                if rule in mine:
+                    mine[rule].merge(stats)
+                else:
+                    mine[rule] = RuleStats.load(stats)
+
+    def report(self):
+        """Whole profile, rules of a template costliest first"""
+        return {template_id: {rule: stats.report() for rule, stats in sorted(rules.items(), key=lambda item: -item[1].total_ms)}
+                for template_id, rules in self.templates.items()}
+
+    def summary(self, top=5):
+        """
+        Costliest rules of every template
+        :param top: rules per template
+        :type top: int
+        :return: (template_id, rule, total ms, share of the template's rule time, mean ms, runs) tuples
+        :rtype: list
+        """
+        summary = []
+        for template_id, rules in self.templates.items():
+            rule_time = sum(stats.total_ms for rule, stats in rules.items() if rule != BATCH) or 1.0
+            costliest = sorted(((rule, stats) for rule, stats in rules.items() if rule != BATCH), key=lambda item: -item[1].total_ms)[:top]
+            summary.extend((template_id, rule, stats.total_ms, stats.total_ms / rule_time, stats.total_ms / stats.count, stats.count)
+                           for rule, stats in costliest)
+        return summary
+
+    def log_summary(self, top=5):
+        for template_id, rule, total_ms, share, mean_ms, count in self.summary(top):
+            logger.info(f"Rule profile {template_id} {rule}: {total_ms:.1f} ms total ({share:.0%}), {mean_ms:.3f} ms mean over {count} runs")